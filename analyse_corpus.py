@@ -0,0 +1,52 @@
+"""
+Analyses every book that has not been analysed yet.
+
+Books are downloaded, analysed in the process pool and written in batches at the same time, and each
+batch marks its books analysed, so running it again after it stops carries on with the books left.
+"""
+
+import argparse
+import asyncio
+
+from app.services.analysis_pool import analysis_pool
+from app.services.corpus_pipeline import DOWNLOAD_CONCURRENCY, WRITE_BATCH_SIZE, CorpusPipeline
+from app.services.gutendex_service import gutendex_service
+
+async def main(download_concurrency: int, analysis_workers: int, batch_size: int, limit: int):
+    analysis_pool.max_workers = analysis_workers or analysis_pool.max_workers
+    analysis_pool.start()
+    try:
+        pipeline = CorpusPipeline(
+            download_concurrency=download_concurrency,
+            write_batch_size=batch_size,
+            limit=limit
+        )
+        return await pipeline.run()
+    finally:
+        await gutendex_service.close()
+        analysis_pool.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse every book that has not been analysed yet")
+    parser.add_argument("--concurrency", type=int, default=DOWNLOAD_CONCURRENCY, help="Gutenberg downloads at once")
+    parser.add_argument("--workers", type=int, default=None, help="analysis processes, one per core by default")
+    parser.add_argument("--batch-size", type=int, default=WRITE_BATCH_SIZE, help="books written per transaction")
+    parser.add_argument("--limit", type=int, default=None, help="stop after this many books")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("Scriptum - Corpus Analysis")
+    print("="*60)
+
+    try:
+        stats = asyncio.run(main(args.concurrency, args.workers, args.batch_size, args.limit))
+    except KeyboardInterrupt:
+        print("\n\nAnalysis stopped, run again to carry on")
+        raise SystemExit(1)
+
+    print(f"\n{'='*60}")
+    print("Corpus Analysis Finished")
+    print(f"{'='*60}")
+    for stage, values in stats.items():
+        print(f"{stage.capitalize()}: " + ", ".join(f"{key.replace('_', ' ')} {value}" for key, value in values.items()))
+    print(f"{'='*60}")
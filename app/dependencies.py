@@ -0,0 +1,19 @@
+'''
+    This file has the dependencies shared by the routers
+'''
+
+import hmac
+import os
+from typing import Optional
+
+from fastapi import Header, HTTPException, status
+
+#Admin endpoints need ADMIN_TOKEN in the X-Admin-Token header, and are refused while it is not set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin token required"
+        )
@@ -1,20 +1,69 @@
 '''
     This creates the FastAPI and registers all routers and sets up CORS
 '''
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.database import engine, Base
+from app.database import engine, Base, SessionLocal
 from app.routers import users, books
 from app.routers import stylometry  # Add this import
+from app.routers import recommendations
+from app.services.analysis_pool import analysis_pool
+from app.services.catalog_facets import ensure_facet_schema
+from app.services.catalog_search import ensure_search_schema
+from app.services.delta_service import delta_index
+from app.services.gutendex_service import gutendex_service
+from app.services.style_index import style_index
 
 #Createa database tables
 Base.metadata.create_all(bind=engine)
 
+#Loads the in-memory similarity indexes so the first request does not pay for it
+def warm_indexes():
+    db = SessionLocal()
+    try:
+        style_index.sync(db)
+        delta_index.sync(db)
+        print(f"Indexes loaded: {len(style_index)} style profiles, {len(delta_index)} function word profiles")
+    except Exception as e:
+        print(f"Could not load indexes, they will load on first use: {e}")
+    finally:
+        db.close()
+
+#Adds the catalog search column and index, and the download count column, to a books table made before they existed
+def prepare_catalog_search():
+    db = SessionLocal()
+    try:
+        ensure_search_schema(db)
+    except Exception as e:
+        db.rollback()
+        print(f"Could not prepare catalog search, searches will go to Gutendex: {e}")
+    try:
+        ensure_facet_schema(db)
+    except Exception as e:
+        db.rollback()
+        print(f"Could not prepare subject and language facets: {e}")
+    finally:
+        db.close()
+
+#Starts shared resources when the app starts and stops them on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    analysis_pool.start()
+    gutendex_service.start()
+    await asyncio.to_thread(prepare_catalog_search)
+    await asyncio.to_thread(warm_indexes)
+    yield
+    await gutendex_service.close()
+    analysis_pool.shutdown()
+
 #This initialize FastAPI app
 app = FastAPI(
     title="Scriptum API",
     description="Book recommendation API based on writing style",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 #CORS middleware - this allows requests from any origin 
@@ -49,3 +98,4 @@ def read_root():
 app.include_router(users.router)
 app.include_router(books.router)
 app.include_router(stylometry.router)
+app.include_router(recommendations.router)
@@ -2,10 +2,10 @@
     This file defines what the database looks like in PostgreSQL and converts it to Python also known as ORM(Object Relational Mapping)
 '''
 
-from sqlalchemy import Column, String, Integer, Boolean, TIMESTAMP, DECIMAL, Text, ForeignKey
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, String, Integer, Boolean, TIMESTAMP, DECIMAL, Text, ForeignKey, LargeBinary, JSON, Computed, Index
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 import uuid
 from app.database import Base
 
@@ -26,9 +26,19 @@ class User(Base):
     ratings = relationship("Rating", back_populates="user", cascade="all, delete-orphan")
     recommendations = relationship("Recommendation", back_populates="user", cascade="all, delete-orphan")
 
+#Full-text search document of a book, titles weigh most then authors then summaries. Author names are not stemmed
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(author, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(summary, '')), 'C')"
+)
+
 #Book table
 class Book(Base):
     __tablename__ = "books"
+    __table_args__ = (
+        Index("idx_books_search_vector", "search_vector", postgresql_using="gin"),
+    )
     
     book_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     gutenberg_id = Column(Integer, unique=True, nullable=True, index=True)
@@ -42,12 +52,56 @@ class Book(Base):
     text_source = Column(String(100), nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
     analysed = Column(Boolean, default=False, index=True)
+    download_count = Column(Integer, nullable=True)
+    
+    #Generated by PostgreSQL and only loaded when a query asks for it
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True)))
     
     # Relationships
     stylometric_profile = relationship("StylometricProfile", back_populates="book", uselist=False, cascade="all, delete-orphan")
+    function_word_profile = relationship("FunctionWordProfile", back_populates="book", uselist=False, cascade="all, delete-orphan")
+    stylometric_timeline = relationship("StylometricTimeline", back_populates="book", uselist=False, cascade="all, delete-orphan")
     ratings = relationship("Rating", back_populates="book", cascade="all, delete-orphan")
     recommendations = relationship("Recommendation", back_populates="book", cascade="all, delete-orphan")
 
+#Subject headings of the catalog, each stored once however many books have it
+class Subject(Base):
+    __tablename__ = "subjects"
+    
+    subject_id = Column(Integer, primary_key=True)
+    name = Column(Text, unique=True, nullable=False)
+
+#Links books to their subjects. The second index finds the books of a subject
+class BookSubject(Base):
+    __tablename__ = "book_subjects"
+    __table_args__ = (
+        Index("idx_book_subjects_subject", "subject_id", "book_id"),
+    )
+    
+    book_id = Column(UUID(as_uuid=True), ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True)
+    subject_id = Column(Integer, ForeignKey("subjects.subject_id", ondelete="CASCADE"), primary_key=True)
+
+#Language codes of each book, a book in several languages has a row for each
+class BookLanguage(Base):
+    __tablename__ = "book_languages"
+    __table_args__ = (
+        Index("idx_book_languages_language", "language", "book_id"),
+    )
+    
+    book_id = Column(UUID(as_uuid=True), ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True)
+    language = Column(String(10), primary_key=True)
+
+#Books per subject and per language, kept up to date on import so browsing never counts over the link tables
+class FacetCount(Base):
+    __tablename__ = "facet_counts"
+    __table_args__ = (
+        Index("idx_facet_counts_facet_count", "facet", "book_count"),
+    )
+    
+    facet = Column(String(20), primary_key=True)
+    value = Column(Text, primary_key=True)
+    book_count = Column(Integer, nullable=False, default=0)
+
 #Stylometric profile table
 class StylometricProfile(Base):
     __tablename__ = "stylometric_profiles"
@@ -71,6 +125,64 @@ class StylometricProfile(Base):
     #Relationships
     book = relationship("Book", back_populates="stylometric_profile")
 
+#Function word frequencies for Burrows' Delta, stored as packed float32 values in FUNCTION_WORDS order
+class FunctionWordProfile(Base):
+    __tablename__ = "function_word_profiles"
+    
+    book_id = Column(UUID(as_uuid=True), ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True)
+    frequencies = Column(LargeBinary, nullable=False)
+    vocabulary_version = Column(String(20), nullable=False)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now(), index=True)
+    
+    #Relationships
+    book = relationship("Book", back_populates="function_word_profile")
+
+#Metrics of every fixed-size word window of a book, stored as one packed float32 windows x TIMELINE_METRICS array
+class StylometricTimeline(Base):
+    __tablename__ = "stylometric_timelines"
+    
+    book_id = Column(UUID(as_uuid=True), ForeignKey("books.book_id", ondelete="CASCADE"), primary_key=True)
+    window_words = Column(Integer, nullable=False)
+    windows = Column(Integer, nullable=False)
+    metrics = Column(LargeBinary, nullable=False)
+    analysis_version = Column(String(20), nullable=True)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+    
+    #Relationships
+    book = relationship("Book", back_populates="stylometric_timeline")
+
+#Analysis results keyed by a hash of the analysed text, so identical texts are never analysed twice
+class AnalysisCacheEntry(Base):
+    __tablename__ = "analysis_cache"
+    
+    text_hash = Column(String(64), primary_key=True)
+    analysis_version = Column(String(20), primary_key=True)
+    metrics = Column(JSON, nullable=False)
+    frequencies = Column(LargeBinary, nullable=False)
+    timeline = Column(LargeBinary, nullable=True)
+    vocabulary_version = Column(String(20), nullable=False)
+    hit_count = Column(Integer, default=0)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    last_used_at = Column(TIMESTAMP, server_default=func.now(), index=True)
+
+#Progress of a bulk re-analysis, so a run that stops can carry on from the last finished batch
+class ReanalysisJob(Base):
+    __tablename__ = "reanalysis_jobs"
+    
+    job_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    target_version = Column(String(20), nullable=False, index=True)
+    status = Column(String(20), nullable=False, default="running")
+    total = Column(Integer, default=0)
+    processed = Column(Integer, default=0)
+    updated = Column(Integer, default=0)
+    skipped = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    last_book_id = Column(UUID(as_uuid=True), nullable=True)
+    error = Column(Text, nullable=True)
+    started_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+    finished_at = Column(TIMESTAMP, nullable=True)
+
 #Rating table
 class Rating(Base):
     __tablename__ = "ratings"
@@ -107,3 +219,12 @@ class Recommendation(Base):
     #Relationships
     user = relationship("User", back_populates="recommendations")
     book = relationship("Book", back_populates="recommendations")
+
+#When each user's recommendations were last generated, kept even when none could be made so the user is not
+#picked up again until their ratings change
+class RecommendationRun(Base):
+    __tablename__ = "recommendation_runs"
+    
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    generated_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
+    recommendations = Column(Integer, default=0)
@@ -1,55 +1,78 @@
 '''
     This file includes the book end points for managing and importing books and the Gutendex integration - it searches through Project Gutenberg
 '''
+import asyncio
+
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import List, Optional, Set
 from uuid import UUID
 
 from app.database import get_db
 from app.models import Book, StylometricProfile
-from app.schemas import BookCreate, BookResponse, BookUpdate
+from app.schemas import BookCreate, BookResponse, BookUpdate, parse_fields, project_fields
+from app.services.catalog_facets import facet_values, filter_by_facets, set_book_facets
+from app.services.catalog_search import search_catalog
+from app.services.delta_service import delta_index
 from app.services.gutendex_service import gutendex_service
+from app.services.style_index import style_index
 
 router = APIRouter(prefix="/books", tags=["books"])
 
 
+#Converts a stored metric to a float for the response
+def _metric(value):
+    return float(value) if value else None
+
+#Builds the response for a book together with its stylometric profile
+def _analysed_book_row(book: Book, profile: StylometricProfile) -> dict:
+    return {
+        "book_id": book.book_id,
+        "title": book.title,
+        "author": book.author,
+        "publication_year": book.publication_year,
+        "created_at": book.created_at,
+        "analysed": book.analysed,
+        "cover_url": book.cover_url,
+        "summary": book.summary,
+        "text_source": book.text_source,
+        "pacing_score": _metric(profile.pacing_score),
+        "tone_score": _metric(profile.tone_score),
+        "vocabulary_richness": _metric(profile.vocabulary_richness),
+        "avg_sentence_length": _metric(profile.avg_sentence_length),
+        "avg_word_length": _metric(profile.avg_word_length),
+        "lexical_diversity": _metric(profile.lexical_diversity)
+    }
+
+#Returns only the requested fields, skipping response_model validation which would require every field
+def _projected_response(rows: List[dict], fields: Set[str]) -> JSONResponse:
+    return JSONResponse(content=jsonable_encoder([project_fields(row, fields) for row in rows]))
+
 @router.get("/analysed", response_model=List[BookResponse])
-def get_analysed_books(limit: int = 10, db: Session = Depends(get_db)):
+def get_analysed_books(limit: int = 10, fields: Optional[str] = None, db: Session = Depends(get_db)):
     """
-    Get books that have been analysed with their stylometric profiles
+    Get books that have been analysed with their stylometric profiles.
+    Pass fields=title,pacing_score to only get those fields back.
     """
+    wanted = parse_fields(fields, BookResponse.model_fields)
+
     try:
-        books = db.query(Book).filter(Book.analysed == True).limit(limit).all()
-        
-        result = []
-        for book in books:
-            profile = db.query(StylometricProfile).filter(
-                StylometricProfile.book_id == book.book_id
-            ).first()
-            
-            if profile:
-                result.append({
-                    "book_id": book.book_id,
-                    "title": book.title,
-                    "author": book.author,
-                    "publication_year": book.publication_year,
-                    "created_at": book.created_at,
-                    "analysed": book.analysed,
-                    "cover_url": book.cover_url,
-                    "summary": book.summary,
-                    "text_source": book.text_source,
-                    "pacing_score": float(profile.pacing_score) if profile.pacing_score else None,
-                    "tone_score": float(profile.tone_score) if profile.tone_score else None,
-                    "vocabulary_richness": float(profile.vocabulary_richness) if profile.vocabulary_richness else None,
-                    "avg_sentence_length": float(profile.avg_sentence_length) if profile.avg_sentence_length else None,
-                    "avg_word_length": float(profile.avg_word_length) if profile.avg_word_length else None,
-                    "lexical_diversity": float(profile.lexical_diversity) if profile.lexical_diversity else None
-                })
-        
+        #One joined query instead of a profile lookup per book
+        rows = db.query(Book, StylometricProfile).join(
+            StylometricProfile, StylometricProfile.book_id == Book.book_id
+        ).filter(Book.analysed == True).limit(limit).all()
+
+        result = [_analysed_book_row(book, profile) for book, profile in rows]
+
         print(f"Returning {len(result)} analysed books")
+        if wanted is not None:
+            return _projected_response(result, wanted)
         return result
-        
+
     except Exception as e:
         print(f"Error fetching analysed books: {str(e)}")
         raise HTTPException(
@@ -57,11 +80,23 @@ def get_analysed_books(limit: int = 10, db: Session = Depends(get_db)):
             detail=f"Failed to fetch books: {str(e)}"
         )
 
-#This searches gutenberg for a book which a user inputs the name of
+#This searches gutenberg for a book which a user inputs the name of.
+#Searches the imported catalog, and an empty list when that fails so gutendex.com is asked instead.
+#Runs in a thread, as the full-text query would block the event loop
+def _search_catalog(db: Session, query: str, limit: int) -> List[dict]:
+    try:
+        return search_catalog(db, query, limit)
+    except Exception as e:
+        print(f"Catalog search failed, searching Gutendex instead: {e}")
+        db.rollback()
+        return []
+
+#The imported catalog answers with prefix matching, gutendex.com is only asked when it has no results
 @router.get("/search-gutendex")
 async def search_gutendex(
     query: Optional[str] = None,
-    limit: int = 10
+    limit: int = 10,
+    db: Session = Depends(get_db)
 ):
     if not query:
         raise HTTPException(
@@ -69,6 +104,15 @@ async def search_gutendex(
             detail="Query parameter is required"
         )
     
+    books = await asyncio.to_thread(_search_catalog, db, query, limit)
+    if books:
+        return {
+            "count": len(books),
+            "query": query,
+            "source": "catalog",
+            "books": books
+        }
+    
     try:
         books = await gutendex_service.search_books(
             search=query,
@@ -77,6 +121,7 @@ async def search_gutendex(
         return {
             "count": len(books),
             "query": query,
+            "source": "gutendex",
             "books": books
         }
     except Exception as e:
@@ -85,14 +130,35 @@ async def search_gutendex(
             detail=f"Failed to search Gutendex: {str(e)}"
         )
 
+#This returns the hit and miss counters of this worker's Gutendex metadata cache with its current number of entries
+@router.get("/search-gutendex/cache/stats")
+def get_gutendex_cache_stats():
+    return gutendex_service.metadata_cache.stats()
+
+#This returns the circuit breaker state, retries and throttling of this worker's requests to each Gutenberg host
+@router.get("/search-gutendex/upstream/stats")
+def get_gutendex_upstream_stats():
+    return gutendex_service.upstream.stats()
+
+#This returns the subjects and languages with the most books and how many books each has, for browsing.
+#The counts are stored, so this never counts over the books
+@router.get("/facets")
+def get_book_facets(limit: int = 50, db: Session = Depends(get_db)):
+    return facet_values(db, limit)
+
+#subject and language are exact values from /books/facets
 @router.get("/", response_model=List[BookResponse])
 def get_books(
     skip: int = 0, 
     limit: int = 100,
     author: Optional[str] = None,
     analysed: Optional[bool] = None,
+    subject: Optional[str] = None,
+    language: Optional[str] = None,
+    fields: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
+    wanted = parse_fields(fields, BookResponse.model_fields)
     query = db.query(Book)
     
     if author:
@@ -101,9 +167,62 @@ def get_books(
     if analysed is not None:
         query = query.filter(Book.analysed == analysed)
     
+    query = filter_by_facets(query, subject, language)
+    
     books = query.offset(skip).limit(limit).all()
+    if wanted is not None:
+        return _projected_response([BookResponse.model_validate(book).model_dump() for book in books], wanted)
     return books
 
+#Saves an imported book with its subjects and languages, or fills in the ones an existing book is missing.
+#The queries, upserts and commits run together in a thread so they do not block the event loop
+def _save_imported_book(db: Session, gutenberg_id: int, book_data: dict) -> Book:
+    title = book_data["title"]
+    author = book_data["author"]
+    cover_url = book_data.get("cover_url")
+    
+    #Check if it is already in te database
+    existing_book = db.query(Book).filter(or_(
+        Book.gutenberg_id == gutenberg_id,
+        and_(Book.title == title, Book.author == author)
+    )).first()
+    
+    if existing_book:
+        if not existing_book.cover_url and cover_url:
+            existing_book.cover_url = cover_url
+        #Fills in the subjects, languages and download count of books imported without them
+        existing_book.download_count = book_data.get("download_count")
+        set_book_facets(db, existing_book.book_id, book_data.get("subjects"), book_data.get("languages"))
+        db.commit()
+        db.refresh(existing_book)
+        return existing_book
+    
+    #Create a new book entry
+    new_book = Book(
+        title=title,
+        author=author,
+        gutenberg_id=gutenberg_id,
+        text_source=f"Project Gutenberg (ID: {gutenberg_id})",
+        cover_url=cover_url,
+        download_count=book_data.get("download_count")
+    )
+    
+    db.add(new_book)
+    try:
+        db.commit()
+    except IntegrityError:
+        #Another request imported the same book first, so its row is returned
+        db.rollback()
+        existing_book = db.query(Book).filter(Book.gutenberg_id == gutenberg_id).first()
+        if existing_book is None:
+            raise
+        return existing_book
+    
+    set_book_facets(db, new_book.book_id, book_data.get("subjects"), book_data.get("languages"))
+    db.commit()
+    db.refresh(new_book)
+    return new_book
+
 #This gets book from gutendex by its book ID
 @router.post("/import-from-gutendex/{gutenberg_id}", response_model=BookResponse)
 async def import_book_from_gutendex(gutenberg_id: int, db: Session = Depends(get_db)):
@@ -122,42 +241,12 @@ async def import_book_from_gutendex(gutenberg_id: int, db: Session = Depends(get
                 detail=f"Book with Gutenberg ID {gutenberg_id} not found"
             )
         
-        #Check if it is already in te database
-        title = book_data["title"]
-        author = book_data["author"]
-        cover_url = book_data.get("cover_url")
-        
-        existing_book = db.query(Book).filter(
-            Book.title == title,
-            Book.author == author
-        ).first()
-        
-        if existing_book:
-            if not existing_book.cover_url and cover_url:
-                existing_book.cover_url = cover_url
-                db.commit()
-                db.refresh(existing_book)
-            return existing_book
-        
-        #Create a new book entry
-        new_book = Book(
-            title=title,
-            author=author,
-            text_source=f"Project Gutenberg (ID: {gutenberg_id})",
-            text_file_path=f"gutenberg_{gutenberg_id}",
-            cover_url=cover_url
-        )
-        
-        db.add(new_book)
-        db.commit()
-        db.refresh(new_book)
-        
-        return new_book
+        return await asyncio.to_thread(_save_imported_book, db, gutenberg_id, book_data)
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await asyncio.to_thread(db.rollback)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to import book: {str(e)}"
@@ -205,7 +294,13 @@ def delete_book(book_id: UUID, db: Session = Depends(get_db)):
             detail="Book not found"
         )
     
+    #Takes the book out of the facet counts before its links are deleted with it
+    set_book_facets(db, book.book_id, [], [])
     db.delete(book)
     db.commit()
     
+    #Other workers drop it on their next recount
+    style_index.remove(book_id)
+    delta_index.remove(book_id)
+    
     return None
\ No newline at end of file
@@ -0,0 +1,69 @@
+'''
+    This file has the endpoints to generate and read the stored style based recommendations for each user
+'''
+
+from uuid import UUID
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal, get_db
+from app.dependencies import require_admin
+from app.models import Book, Recommendation
+from app.services.recommendation_service import generate_recommendations
+
+router = APIRouter(prefix="/recommendations", tags=["recommendations"])
+
+#Runs with its own session because the request's session is closed once the response is sent
+def _run_generation(top_n: int, only_stale: bool):
+    db = SessionLocal()
+    try:
+        stats = generate_recommendations(db, top_n=top_n, only_stale=only_stale)
+        print(f"Recommendation run finished: {stats}")
+    except Exception as e:
+        print(f"Recommendation run failed: {e}")
+    finally:
+        db.close()
+
+#This starts a recommendation run in the background, by default only for users whose ratings changed
+@router.post("/generate", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(require_admin)])
+def start_generation(background_tasks: BackgroundTasks, top_n: int = 20, all_users: bool = False):
+    if top_n < 1 or top_n > 100:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="top_n must be between 1 and 100"
+        )
+
+    background_tasks.add_task(_run_generation, top_n, not all_users)
+    return {
+        "message": "Recommendation generation started",
+        "top_n": top_n,
+        "all_users": all_users
+    }
+
+#This gets a user's stored recommendations in rank order
+@router.get("/{user_id}")
+def get_recommendations(user_id: UUID, limit: int = 20, db: Session = Depends(get_db)):
+    rows = db.query(Recommendation, Book).join(
+        Book, Book.book_id == Recommendation.book_id
+    ).filter(Recommendation.user_id == user_id).order_by(Recommendation.rank).limit(limit).all()
+
+    return {
+        "user_id": str(user_id),
+        "generated_at": rows[0][0].generated_at if rows else None,
+        "recommendations": [
+            {
+                "book_id": str(book.book_id),
+                "title": book.title,
+                "author": book.author,
+                "cover_url": book.cover_url,
+                "rank": recommendation.rank,
+                "similarity_score": float(recommendation.similarity_score),
+                "pacing_similarity": float(recommendation.pacing_similarity) if recommendation.pacing_similarity is not None else None,
+                "tone_similarity": float(recommendation.tone_similarity) if recommendation.tone_similarity is not None else None,
+                "vocabulary_similarity": float(recommendation.vocabulary_similarity) if recommendation.vocabulary_similarity is not None else None,
+                "sentence_length_similarity": float(recommendation.sentence_length_similarity) if recommendation.sentence_length_similarity is not None else None
+            }
+            for recommendation, book in rows
+        ]
+    }
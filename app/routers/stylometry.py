@@ -2,176 +2,331 @@
     This file is the endpoints to trigger analysis and retrieve results
 '''
 
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
+import numpy as np
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from typing import Optional
 from uuid import UUID
 
-from app.database import get_db
-from app.models import Book, StylometricProfile
-from app.services.stylometry_service import stylometry_analyzer
-from app.services.gutendex_service import gutendex_service
+from app.database import SessionLocal, engine, get_db
+from app.dependencies import require_admin
+from app.models import Book, FunctionWordProfile, ReanalysisJob, StylometricProfile, StylometricTimeline
+from app.schemas import parse_fields, project_fields
+from app.services.analysis_cache import analysis_cache
+from app.services.analysis_pool import analysis_pool
+from app.services.book_text_service import download_flights, gutenberg_id_of, load_book_text, store_book_text
+from app.services.corpus_store import corpus_store, is_blob_path, text_hash
+from app.services.delta_service import delta_index, pack_frequencies
+from app.services.reanalysis_service import DEFAULT_BATCH_SIZE, DEFAULT_CONCURRENCY, job_progress, run_reanalysis, start_reanalysis
+from app.services.single_flight import SingleFlight, advisory_key, advisory_lock
+from app.services.style_index import style_index
+from app.services.stylometry_service import ANALYSIS_VERSION, FUNCTION_WORDS_VERSION, PROFILE_DTYPE, SAMPLED_VERSION_SUFFIX, TIMELINE_METRICS, TIMELINE_WINDOW_WORDS, is_sampled_version
+from app.services.timeline_service import downsample_timeline, pack_timeline, unpack_timeline
 
 router = APIRouter(prefix="/stylometry", tags=["stylometry"])
 
-#This fetches the book text from gutenberg and analyses it
-@router.post("/analyze-from-gutenberg/{book_id}", response_model=dict)
-async def analyze_book_from_gutenberg(
-    book_id: UUID,
-    db: Session = Depends(get_db)
-):
-    #Get books from database
-    book = db.query(Book).filter(Book.book_id == book_id).first()
-    if not book:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Book not found"
-        )
+#Concurrent analyses of the same book in this worker share one download and analysis
+analysis_flights = SingleFlight()
+
+#Stores the analysis results as the book's stylometric profile, replacing an earlier one, and marks it analysed.
+#Sampled previews have no function word frequencies or timeline, so those are only stored by an exact analysis
+def _save_analysis(
+    db: Session,
+    book: Book,
+    analysis_results: dict,
+    frequencies: Optional[np.ndarray] = None,
+    timeline: Optional[np.ndarray] = None,
+    analysis_version: str = ANALYSIS_VERSION
+) -> StylometricProfile:
+    profile = db.query(StylometricProfile).filter(StylometricProfile.book_id == book.book_id).first()
+    if profile is None:
+        #Creates a stylometric profile
+        profile = StylometricProfile(book_id=book.book_id)
+        db.add(profile)
+    else:
+        #A re-analysis counts as new for the index syncs
+        profile.analysed_at = func.now()
+    
+    for name in PROFILE_DTYPE.names:
+        setattr(profile, name, analysis_results[name])
+    profile.analysis_version = analysis_version
+    
+    #Stores the function word frequencies so Delta never has to re-tokenise the book
+    if frequencies is not None:
+        db.merge(FunctionWordProfile(
+            book_id=book.book_id,
+            frequencies=pack_frequencies(frequencies),
+            vocabulary_version=FUNCTION_WORDS_VERSION
+        ))
+    
+    #Stores the per-window timeline as one packed array
+    if timeline is not None:
+        db.merge(StylometricTimeline(
+            book_id=book.book_id,
+            window_words=TIMELINE_WINDOW_WORDS,
+            windows=len(timeline),
+            metrics=pack_timeline(timeline),
+            analysis_version=analysis_version
+        ))
     
-    #Check if it has already been analysed
+    #Updates book as analysed
+    book.analysed = True
+    
+    db.commit()
+    db.refresh(profile)
+    
+    #Keeps the in-memory indexes current without waiting for their next sync
+    if frequencies is not None:
+        delta_index.add(book.book_id, frequencies)
+    style_index.add(book.book_id, analysis_results)
+    
+    return profile
+
+#Only a missing profile, a sampled preview or one from an older analysis version can be analysed again
+def _check_can_analyse(db: Session, book_id: UUID):
     existing_profile = db.query(StylometricProfile).filter(
         StylometricProfile.book_id == book_id
     ).first()
     
-    if existing_profile:
+    if existing_profile and existing_profile.analysis_version == ANALYSIS_VERSION:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Book has already been analysed"
         )
-    
-    #Extracts the Gutenberg ID from text_source
-    if not book.text_source or "gutenberg_" not in book.text_file_path:
+
+def _check_sample_rate(sample_rate: float):
+    if sample_rate <= 0 or sample_rate > 0.5:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Book is not from Project Gutenberg. Import from Gutenberg first."
+            detail="sample_rate must be greater than 0 and at most 0.5"
         )
+
+#Runs after a preview response has been sent and replaces the sampled profile with the exact one.
+#Uses its own session because the request's session is closed by then
+async def _complete_exact_analysis(book_id: UUID, text: str):
+    try:
+        analysis_results, frequencies, timeline = await analysis_pool.analyze_book(text)
+    except Exception as e:
+        print(f"Exact analysis of {book_id} failed: {e}")
+        return
     
+    await asyncio.to_thread(_save_exact_analysis, book_id, text_hash(text), analysis_results, frequencies, timeline)
+
+def _save_exact_analysis(book_id: UUID, key: str, analysis_results: dict, frequencies: np.ndarray, timeline: np.ndarray):
+    db = SessionLocal()
     try:
-        gutenberg_id = int(book.text_file_path.replace("gutenberg_", ""))
-    except:
+        analysis_cache.put(db, key, analysis_results, frequencies, timeline)
+        book = db.query(Book).filter(Book.book_id == book_id).first()
+        if book:
+            _save_analysis(db, book, analysis_results, frequencies, timeline)
+            print(f"Exact analysis of {book_id} replaced its preview")
+    except Exception as e:
+        db.rollback()
+        print(f"Saving exact analysis of {book_id} failed: {e}")
+    finally:
+        db.close()
+
+#Looks the text up in the analysis cache and commits, keeping the text path the caller set, so the session
+#holds no transaction while the text is analysed
+def _cached_analysis(db: Session, key: str):
+    cached = analysis_cache.get(db, key)
+    db.commit()
+    return cached
+
+def _save_new_analysis(db: Session, book: Book, key: str, analysis_results: dict, frequencies: np.ndarray, timeline: np.ndarray):
+    analysis_cache.put(db, key, analysis_results, frequencies, timeline)
+    _save_analysis(db, book, analysis_results, frequencies, timeline)
+
+#Analyses the text in a worker process so other requests keep being served. Texts analysed before are read
+#from the analysis cache instead. A preview saves estimates from a sample of the text straight away and
+#schedules the exact analysis to replace them. The session's queries run in threads
+async def _analyse_book(
+    db: Session,
+    book: Book,
+    text: str,
+    preview: bool,
+    sample_rate: float,
+    background_tasks: BackgroundTasks
+) -> dict:
+    book_id = book.book_id
+    key = text_hash(text)
+    cached = await asyncio.to_thread(_cached_analysis, db, key)
+    if cached is not None:
+        analysis_results, frequencies, timeline = cached
+        await asyncio.to_thread(_save_analysis, db, book, analysis_results, frequencies, timeline)
+        return {"analysis": analysis_results, "cached": True}
+    
+    if not preview:
+        analysis_results, frequencies, timeline = await analysis_pool.analyze_book(text)
+        await asyncio.to_thread(_save_new_analysis, db, book, key, analysis_results, frequencies, timeline)
+        return {"analysis": analysis_results, "cached": False}
+    
+    estimates, intervals = await analysis_pool.analyze_sample(text, sample_rate)
+    await asyncio.to_thread(
+        _save_analysis, db, book, estimates, analysis_version=ANALYSIS_VERSION + SAMPLED_VERSION_SUFFIX
+    )
+    background_tasks.add_task(_complete_exact_analysis, book_id, text)
+    return {
+        "analysis": estimates,
+        "sampled": True,
+        "sample_rate": sample_rate,
+        "confidence_intervals": intervals
+    }
+
+#The book to analyse, once it is known to exist and to have no current profile
+def _book_to_analyse(db: Session, book_id: UUID) -> Book:
+    book = db.query(Book).filter(Book.book_id == book_id).first()
+    if not book:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Book not found"
+        )
+    
+    #Check if it has already been analysed, a sampled or outdated profile can be replaced
+    _check_can_analyse(db, book_id)
+    return book
+
+#This fetches the book text from gutenberg and analyses it
+@router.post("/analyze-from-gutenberg/{book_id}", response_model=dict)
+async def analyze_book_from_gutenberg(
+    book_id: UUID,
+    background_tasks: BackgroundTasks,
+    preview: bool = False,
+    sample_rate: float = 0.05,
+    db: Session = Depends(get_db)
+):
+    _check_sample_rate(sample_rate)
+    
+    #Get books from database
+    book = await asyncio.to_thread(_book_to_analyse, db, book_id)
+    book_title = book.title
+    
+    #Needs a stored text or a Gutenberg ID to download it from
+    gutenberg_id = gutenberg_id_of(book)
+    if gutenberg_id is None and not is_blob_path(book.text_file_path):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid Gutenberg ID format"
+            detail="Book is not from Project Gutenberg. Import from Gutenberg first."
         )
     
-    #Fetches the book text
+    #The analysis has its own sessions, so this one gives its connection back instead of holding it throughout
+    await asyncio.to_thread(db.rollback)
+    
+    #Requests for the same book share one download and analysis, in this worker and across workers. A preview
+    #and an exact analysis give different results, so only requests asking for the same one are joined
     try:
-        text = await gutendex_service.get_book_text(gutenberg_id)
+        result = await analysis_flights.run(
+            (book_id, preview, sample_rate if preview else None),
+            lambda: _analyse_from_gutenberg(book_id, preview, sample_rate, background_tasks)
+        )
         
-        if not text:
+        if result is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Could not download text for Gutenberg ID {gutenberg_id}"
             )
         
-        #Analyses the text
-        analysis_results = stylometry_analyzer.analyze_text(text)
-        
-        #Creates a stylometric profile
-        profile = StylometricProfile(
-            book_id=book_id,
-            pacing_score=analysis_results["pacing_score"],
-            tone_score=analysis_results["tone_score"],
-            vocabulary_richness=analysis_results["vocabulary_richness"],
-            avg_sentence_length=analysis_results["avg_sentence_length"],
-            avg_word_length=analysis_results["avg_word_length"],
-            lexical_diversity=analysis_results["lexical_diversity"],
-            total_words=analysis_results["total_words"],
-            total_sentences=analysis_results["total_sentences"],
-            unique_words=analysis_results["unique_words"],
-            analysis_version="1.0"
-        )
-        
-        #This adds any optional fields if they exist
-        if hasattr(StylometricProfile, 'punctuation_density'):
-            profile.punctuation_density = analysis_results.get("punctuation_density")
-        if hasattr(StylometricProfile, 'dialogue_percentage'):
-            profile.dialogue_percentage = analysis_results.get("dialogue_percentage")
-        
-        db.add(profile)
-        
-        #Updatse book as analysed
-        book.analysed = True
-        
-        db.commit()
-        db.refresh(profile)
-        
         return {
-            "message": "Book analysed successfully",
+            "message": "Preview analysed, exact analysis scheduled" if result.get("sampled") else "Book analysed successfully",
             "book_id": str(book_id),
-            "book_title": book.title,
+            "book_title": book_title,
             "gutenberg_id": gutenberg_id,
-            "analysis": analysis_results
+            **result
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Analysis failed: {str(e)}"
         )
+
+#Reads the book detached from a session, so the session can be closed while its text downloads
+def _detached_book(db: Session, book_id: UUID) -> Optional[Book]:
+    book = db.query(Book).filter(Book.book_id == book_id).first()
+    if book is not None:
+        db.expunge(book)
+    db.rollback()
+    return book
+
+#The current profile another worker wrote while this one waited for the lock, as a result
+def _analysed_by_another_worker(db: Session, book_id: UUID) -> Optional[dict]:
+    profile = db.query(StylometricProfile).filter(StylometricProfile.book_id == book_id).first()
+    if profile is None or profile.analysis_version != ANALYSIS_VERSION:
+        return None
+    return {
+        "analysis": {name: getattr(profile, name) for name in PROFILE_DTYPE.names},
+        "analysed_by_another_worker": True
+    }
+
+#Reads or downloads the book text, then analyses it while holding the book's advisory lock. It has its own
+#sessions because requests that joined it can outlive the one that started it. No connection is held during a
+#download, which can take minutes, and the locked part only uses the lock's connection. Workers that race for
+#a book not stored yet may both download it, the corpus store keeps one copy. Returns None when the text
+#could not be downloaded
+async def _analyse_from_gutenberg(
+    book_id: UUID,
+    preview: bool,
+    sample_rate: float,
+    background_tasks: BackgroundTasks
+) -> Optional[dict]:
+    db = SessionLocal()
+    try:
+        book = await asyncio.to_thread(_detached_book, db, book_id)
+        text = await load_book_text(db, book) if book is not None else None
+    finally:
+        await asyncio.to_thread(db.close)
+    if not text:
+        return None
+    
+    async with advisory_lock(engine, advisory_key("analyse", str(book_id))) as connection:
+        db = SessionLocal(bind=connection)
+        try:
+            #Another worker may have analysed the book while this one waited for the lock
+            result = await asyncio.to_thread(_analysed_by_another_worker, db, book_id)
+            if result is not None:
+                return result
+            
+            #Carries over the text path the download pointed the book at
+            book = await asyncio.to_thread(db.merge, book)
+            return await _analyse_book(db, book, text, preview, sample_rate, background_tasks)
+        except Exception:
+            await asyncio.to_thread(db.rollback)
+            raise
+        finally:
+            db.close()
+
 #This analyses a book with its provided text
 @router.post("/analyze/{book_id}", response_model=dict)
-def analyze_book_with_text(
+async def analyze_book_with_text(
     book_id: UUID,
     text: str,
+    background_tasks: BackgroundTasks,
+    preview: bool = False,
+    sample_rate: float = 0.05,
     db: Session = Depends(get_db)
 ):
-    #Checks if book exists
-    book = db.query(Book).filter(Book.book_id == book_id).first()
-    if not book:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Book not found"
-        )
-    
-    #Checks if it already has been analysed
-    existing_profile = db.query(StylometricProfile).filter(
-        StylometricProfile.book_id == book_id
-    ).first()
+    _check_sample_rate(sample_rate)
     
-    if existing_profile:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Book has already been analysed"
-        )
+    #Checks the book exists and has no current profile. Its queries run in a thread, like the rest of the
+    #session's work, so the event loop keeps serving
+    book = await asyncio.to_thread(_book_to_analyse, db, book_id)
     
     try:
-        #Analysee the text
-        analysis_results = stylometry_analyzer.analyze_text(text)
-        
-        #Creates a stylometric profile
-        profile = StylometricProfile(
-            book_id=book_id,
-            pacing_score=analysis_results["pacing_score"],
-            tone_score=analysis_results["tone_score"],
-            vocabulary_richness=analysis_results["vocabulary_richness"],
-            avg_sentence_length=analysis_results["avg_sentence_length"],
-            avg_word_length=analysis_results["avg_word_length"],
-            lexical_diversity=analysis_results["lexical_diversity"],
-            total_words=analysis_results["total_words"],
-            total_sentences=analysis_results["total_sentences"],
-            unique_words=analysis_results["unique_words"],
-            analysis_version="1.0"
-        )
+        #Keeps the text in the corpus store so the book can be re-analysed later without sending it again
+        if text.strip():
+            await store_book_text(db, book, text)
         
-        if hasattr(StylometricProfile, 'punctuation_density'):
-            profile.punctuation_density = analysis_results.get("punctuation_density")
-        if hasattr(StylometricProfile, 'dialogue_percentage'):
-            profile.dialogue_percentage = analysis_results.get("dialogue_percentage")
-        
-        db.add(profile)
-        book.analysed = True
-        
-        db.commit()
-        db.refresh(profile)
+        result = await _analyse_book(db, book, text, preview, sample_rate, background_tasks)
         
         return {
-            "message": "Book analysed successfully",
+            "message": "Preview analysed, exact analysis scheduled" if result.get("sampled") else "Book analysed successfully",
             "book_id": str(book_id),
-            "analysis": analysis_results
+            **result
         }
         
     except ValueError as e:
@@ -180,15 +335,93 @@ def analyze_book_with_text(
             detail=str(e)
         )
     except Exception as e:
-        db.rollback()
+        await asyncio.to_thread(db.rollback)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Analysis failed: {str(e)}"
         )
 
-@router.get("/profile/{book_id}")
-def get_stylometric_profile(book_id: UUID, db: Session = Depends(get_db)):
+#This returns the analysis cache and corpus store hit and miss counters of this worker with their current sizes,
+#and how many analyses and downloads were shared between concurrent requests
+@router.get("/cache/stats")
+def get_analysis_cache_stats(db: Session = Depends(get_db)):
+    return {
+        **analysis_cache.stats(db),
+        "corpus": corpus_store.stats(),
+        "analysis_flights": analysis_flights.stats(),
+        "download_flights": download_flights.stats()
+    }
+
+#This re-analyses every profile from an older analysis version in the background, carrying on an unfinished run
+@router.post("/reanalysis", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(require_admin)])
+def start_bulk_reanalysis(
+    background_tasks: BackgroundTasks,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    db: Session = Depends(get_db)
+):
+    if batch_size < 1 or batch_size > 200 or concurrency < 1 or concurrency > 16:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="batch_size must be between 1 and 200 and concurrency between 1 and 16"
+        )
     
+    job = start_reanalysis(db)
+    background_tasks.add_task(run_reanalysis, job.job_id, batch_size, concurrency)
+    return job_progress(job)
+
+#This gets the progress of a bulk re-analysis
+@router.get("/reanalysis/{job_id}")
+def get_bulk_reanalysis(job_id: UUID, db: Session = Depends(get_db)):
+    job = db.get(ReanalysisJob, job_id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Re-analysis job not found"
+        )
+    return job_progress(job)
+
+#This returns how the style of a book changes through it, averaged down to at most points values per metric
+@router.get("/timeline/{book_id}")
+def get_stylometric_timeline(book_id: UUID, points: int = 100, db: Session = Depends(get_db)):
+    if points < 1 or points > 1000:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="points must be between 1 and 1000"
+        )
+    
+    stored = db.query(StylometricTimeline).filter(StylometricTimeline.book_id == book_id).first()
+    if not stored:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Timeline not found. Book may not be analysed yet or only has a preview."
+        )
+    
+    timeline = downsample_timeline(unpack_timeline(stored.metrics), points)
+    return {
+        "book_id": str(book_id),
+        "window_words": stored.window_words,
+        "windows": stored.windows,
+        "points": len(timeline),
+        #Where each point starts, as a fraction of the way through the book
+        "positions": [round(i / len(timeline), 4) for i in range(len(timeline))],
+        "metrics": {
+            name: [round(float(value), 4) for value in timeline[:, column]]
+            for column, name in enumerate(TIMELINE_METRICS)
+        }
+    }
+
+#Fields that /profile/{book_id} can return
+PROFILE_FIELDS = (
+    "book_id", "pacing_score", "tone_score", "vocabulary_richness", "avg_sentence_length",
+    "avg_word_length", "lexical_diversity", "total_words", "total_sentences", "unique_words", "analysis_version", "sampled", "analysed_at"
+)
+
+@router.get("/profile/{book_id}")
+def get_stylometric_profile(book_id: UUID, fields: Optional[str] = None, db: Session = Depends(get_db)):
+    #fields=pacing_score,tone_score only returns those metrics
+    wanted = parse_fields(fields, PROFILE_FIELDS)
+
     profile = db.query(StylometricProfile).filter(
         StylometricProfile.book_id == book_id
     ).first()
@@ -199,7 +432,7 @@ def get_stylometric_profile(book_id: UUID, db: Session = Depends(get_db)):
             detail="Stylometric profile not found. Book may not be analysed yet."
         )
     
-    return {
+    return project_fields({
         "book_id": str(profile.book_id),
         "pacing_score": float(profile.pacing_score) if profile.pacing_score else None,
         "tone_score": float(profile.tone_score) if profile.tone_score else None,
@@ -210,5 +443,85 @@ def get_stylometric_profile(book_id: UUID, db: Session = Depends(get_db)):
         "total_words": profile.total_words,
         "total_sentences": profile.total_sentences,
         "unique_words": profile.unique_words,
+        "analysis_version": profile.analysis_version,
+        "sampled": is_sampled_version(profile.analysis_version),
         "analysed_at": profile.analysed_at
-    }
\ No newline at end of file
+    }, wanted)
+
+#This returns the books closest in style to a book by Burrows' Delta over function word frequencies
+@router.get("/delta/{book_id}")
+def get_nearest_by_delta(book_id: UUID, limit: int = 10, db: Session = Depends(get_db)):
+    if limit < 1 or limit > 100:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="limit must be between 1 and 100"
+        )
+    
+    #Picks up books analysed by other workers since the last call
+    delta_index.sync(db)
+    
+    nearest = delta_index.nearest(book_id, limit)
+    if nearest is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No function word profile for this book. It may need to be analysed or re-analysed."
+        )
+    
+    books = {
+        book.book_id: book
+        for book in db.query(Book).filter(Book.book_id.in_([neighbour_id for neighbour_id, _ in nearest])).all()
+    }
+    
+    return {
+        "book_id": str(book_id),
+        "corpus_size": len(delta_index),
+        "nearest": [
+            {
+                "book_id": str(neighbour_id),
+                "title": books[neighbour_id].title,
+                "author": books[neighbour_id].author,
+                "delta": round(delta, 4)
+            }
+            for neighbour_id, delta in nearest
+            if neighbour_id in books
+        ]
+    }
+
+#This returns the books with the most similar style profile, with the similarity on each dimension
+@router.get("/similar/{book_id}")
+def get_similar_books(book_id: UUID, limit: int = 10, db: Session = Depends(get_db)):
+    if limit < 1 or limit > 100:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="limit must be between 1 and 100"
+        )
+    
+    #Picks up books analysed by other workers since the last call
+    style_index.sync(db)
+    
+    similar = style_index.similar(book_id, limit)
+    if similar is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Stylometric profile not found. Book may not be analysed yet."
+        )
+    
+    books = {
+        book.book_id: book
+        for book in db.query(Book).filter(Book.book_id.in_([similar_id for similar_id, _, _ in similar])).all()
+    }
+    
+    return {
+        "book_id": str(book_id),
+        "similar": [
+            {
+                "book_id": str(similar_id),
+                "title": books[similar_id].title,
+                "author": books[similar_id].author,
+                "similarity_score": round(score, 4),
+                **{name: round(value, 4) for name, value in dimensions.items()}
+            }
+            for similar_id, score, dimensions in similar
+            if similar_id in books
+        ]
+    }
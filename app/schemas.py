@@ -1,9 +1,10 @@
 '''
     This file defines what the data should look like when it comes in and goes out of the API which validates data automatically
 '''
+from fastapi import HTTPException, status
 from pydantic import BaseModel, EmailStr, Field, ConfigDict
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Iterable, Optional, Set
 from uuid import UUID
 
 #Login request
@@ -83,3 +84,24 @@ class RatingResponse(BaseModel):
 #Error response
 class ErrorResponse(BaseModel):
     detail: str
+
+#Turns a comma separated fields= query parameter into the set of requested fields (None means every field)
+def parse_fields(fields: Optional[str], allowed: Iterable[str]) -> Optional[Set[str]]:
+    if not fields:
+        return None
+
+    allowed = set(allowed)
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = requested - allowed
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}. Valid fields: {', '.join(sorted(allowed))}"
+        )
+    return requested
+
+#Keeps only the requested fields of a response dictionary
+def project_fields(data: Dict, fields: Optional[Set[str]]) -> Dict:
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
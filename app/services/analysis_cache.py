@@ -0,0 +1,151 @@
+'''
+    This file caches analysis results by a hash of the text so re-imported books and identical editions skip tokenising
+'''
+
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import bindparam, delete, func, select, tuple_
+from sqlalchemy.orm import Session
+
+from app.models import AnalysisCacheEntry
+from app.services.corpus_store import text_hash
+from app.services.delta_service import pack_frequencies, unpack_frequencies
+from app.services.stylometry_service import ANALYSIS_VERSION, FUNCTION_WORDS_VERSION
+from app.services.timeline_service import pack_timeline, unpack_timeline
+
+#Entries kept before the least recently used ones are evicted, each is roughly a kilobyte
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 50000))
+
+#Eviction needs a sort over the table, so it only runs after this many new entries
+EVICT_EVERY = 100
+
+#Hits are counted in memory and written together once this many entries were hit or this many seconds passed,
+#instead of a commit per hit. Hits not written when the process stops only make eviction slightly less exact
+TOUCH_FLUSH_SIZE = 100
+TOUCH_FLUSH_SECONDS = 60.0
+
+class AnalysisCache:
+
+    def __init__(self, max_entries: int = ANALYSIS_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._touches: Dict[Tuple[str, str], int] = {}
+        self._touch_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    #Returns the stored metrics, function word frequencies and timeline for a text, or None on a miss.
+    #Entries written before timelines were cached count as misses so they get rewritten with one
+    def get(self, db: Session, key: str, analysis_version: str = ANALYSIS_VERSION) -> Optional[Tuple[Dict, np.ndarray, np.ndarray]]:
+        entry = db.get(AnalysisCacheEntry, (key, analysis_version))
+        if entry is None or entry.vocabulary_version != FUNCTION_WORDS_VERSION or entry.timeline is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touch(db, key, analysis_version)
+        return dict(entry.metrics), unpack_frequencies(entry.frequencies), unpack_timeline(entry.timeline)
+
+    def _touch(self, db: Session, key: str, analysis_version: str):
+        with self._touch_lock:
+            self._touches[(key, analysis_version)] = self._touches.get((key, analysis_version), 0) + 1
+            due = len(self._touches) >= TOUCH_FLUSH_SIZE or time.monotonic() - self._flushed_at >= TOUCH_FLUSH_SECONDS
+        if due:
+            self.flush_touches(db)
+
+    #Writes the hits counted since the last flush in a transaction of its own, so the caller's is left alone
+    def flush_touches(self, db: Session):
+        with self._touch_lock:
+            touches, self._touches = self._touches, {}
+            self._flushed_at = time.monotonic()
+        if not touches:
+            return
+
+        table = AnalysisCacheEntry.__table__
+        statement = table.update().where(
+            table.c.text_hash == bindparam("key"),
+            table.c.analysis_version == bindparam("version")
+        ).values(hit_count=func.coalesce(table.c.hit_count, 0) + bindparam("hits"), last_used_at=func.now())
+        try:
+            with db.get_bind().engine.begin() as connection:
+                connection.execute(statement, [
+                    {"key": key, "version": version, "hits": hits} for (key, version), hits in touches.items()
+                ])
+        except Exception as e:
+            print(f"Could not record analysis cache hits: {e}")
+
+    def put(
+        self,
+        db: Session,
+        key: str,
+        metrics: Dict,
+        frequencies: np.ndarray,
+        timeline: np.ndarray,
+        analysis_version: str = ANALYSIS_VERSION
+    ):
+        self.add(db, key, metrics, frequencies, timeline, analysis_version)
+        db.commit()
+        self.evict_if_due(db)
+
+    #Adds an entry to the session without committing, so a batch of results is written in one transaction.
+    #The caller commits and then calls evict_if_due
+    def add(
+        self,
+        db: Session,
+        key: str,
+        metrics: Dict,
+        frequencies: np.ndarray,
+        timeline: np.ndarray,
+        analysis_version: str = ANALYSIS_VERSION
+    ):
+        db.merge(AnalysisCacheEntry(
+            text_hash=key,
+            analysis_version=analysis_version,
+            metrics=metrics,
+            frequencies=pack_frequencies(frequencies),
+            timeline=pack_timeline(timeline),
+            vocabulary_version=FUNCTION_WORDS_VERSION,
+            hit_count=0,
+            last_used_at=func.now()
+        ))
+        self._puts += 1
+
+    def evict_if_due(self, db: Session):
+        if self._puts >= EVICT_EVERY:
+            self._puts = 0
+            self.evict(db)
+
+    #Deletes the least recently used entries beyond max_entries
+    def evict(self, db: Session) -> int:
+        self.flush_touches(db)
+        oldest = select(AnalysisCacheEntry.text_hash, AnalysisCacheEntry.analysis_version).order_by(
+            AnalysisCacheEntry.last_used_at.desc()
+        ).offset(self.max_entries)
+
+        result = db.execute(delete(AnalysisCacheEntry).where(
+            tuple_(AnalysisCacheEntry.text_hash, AnalysisCacheEntry.analysis_version).in_(oldest)
+        ))
+        db.commit()
+
+        self.evictions += result.rowcount
+        return result.rowcount
+
+    def stats(self, db: Session) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "entries": db.query(func.count()).select_from(AnalysisCacheEntry).scalar(),
+            "max_entries": self.max_entries
+        }
+
+#Create singleton instance
+analysis_cache = AnalysisCache()
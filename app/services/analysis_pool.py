@@ -0,0 +1,72 @@
+'''
+    This file runs the CPU heavy stylometry analysis in a pool of worker processes so the event loop keeps serving requests
+'''
+
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from app.services.stylometry_service import stylometry_analyzer
+
+#Jobs have to be module level functions so they can be sent to the worker processes
+def analyze_text_job(text: str) -> Dict:
+    return stylometry_analyzer.analyze_text(text)
+
+#Metrics, the function word frequencies used for Burrows' Delta and the timeline, so the text is only sent to a worker once
+def analyze_book_job(text: str) -> Tuple[Dict, np.ndarray, np.ndarray]:
+    metrics, timeline = stylometry_analyzer.analyze_with_timeline(text)
+    return metrics, stylometry_analyzer.function_word_frequencies(text), timeline
+
+#Estimates from a sample of the text with their confidence intervals, for previews
+def analyze_sample_job(text: str, sample_rate: float) -> Tuple[Dict, Dict]:
+    return stylometry_analyzer.analyze_sample(text, sample_rate=sample_rate)
+
+class AnalysisPool:
+
+    def __init__(self, max_workers: Optional[int] = None):
+        #Size comes from ANALYSIS_POOL_SIZE and defaults to one worker per core
+        self.max_workers = max_workers or int(os.getenv("ANALYSIS_POOL_SIZE", os.cpu_count() or 1))
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    def start(self):
+        if self._executor is None:
+            #Spawn rather than fork so workers never inherit the server's threads or open database connections
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            print(f"Analysis pool started with {self.max_workers} workers")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            print("Analysis pool stopped")
+
+    #Runs a job in a worker process and waits for it without blocking the event loop
+    async def run(self, job: Callable, *args):
+        #Scripts and tests that skip the app lifespan get a pool on first use
+        if self._executor is None:
+            self.start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, job, *args)
+
+    async def analyze_text(self, text: str) -> Dict:
+        return await self.run(analyze_text_job, text)
+
+    async def analyze_book(self, text: str) -> Tuple[Dict, np.ndarray, np.ndarray]:
+        return await self.run(analyze_book_job, text)
+
+    async def analyze_sample(self, text: str, sample_rate: float) -> Tuple[Dict, Dict]:
+        return await self.run(analyze_sample_job, text, sample_rate)
+
+#Create singleton instance
+analysis_pool = AnalysisPool()
@@ -0,0 +1,85 @@
+'''
+    This file finds the text of a book, reading it from the corpus store or downloading it from Gutenberg the first time
+'''
+
+import asyncio
+from typing import Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.models import Book
+from app.services.corpus_store import corpus_store, is_blob_path
+from app.services.gutendex_service import gutendex_service
+from app.services.single_flight import SingleFlight
+
+#Concurrent requests for a book that is not stored yet share one download
+download_flights = SingleFlight()
+
+#Gutenberg ID of a book from its column or from the older gutenberg_<id> text_file_path
+def gutenberg_id_of(book: Book) -> Optional[int]:
+    if book.gutenberg_id:
+        return book.gutenberg_id
+    if book.text_file_path and book.text_file_path.startswith("gutenberg_"):
+        try:
+            return int(book.text_file_path.replace("gutenberg_", ""))
+        except ValueError:
+            return None
+    return None
+
+#Points a book's text_file_path at its stored blob. The caller commits
+def _point_at_blob(db: Session, book: Book, path: str):
+    #Books that only had the Gutenberg ID in text_file_path keep it in the gutenberg_id column
+    gutenberg_id = gutenberg_id_of(book)
+    if gutenberg_id and not book.gutenberg_id:
+        if not db.query(Book).filter(Book.gutenberg_id == gutenberg_id).first():
+            book.gutenberg_id = gutenberg_id
+
+    book.text_file_path = path
+
+#Stores the text a book was analysed from and points its text_file_path at the blob. The caller commits
+async def store_book_text(db: Session, book: Book, text: str) -> str:
+    #Compressing a long book takes tens of milliseconds, so it runs off the event loop
+    path = await asyncio.to_thread(corpus_store.put, text)
+    await asyncio.to_thread(_point_at_blob, db, book, path)
+    return path
+
+#Downloads a book from Gutenberg, compressing each cleaned chunk into the corpus store as it arrives.
+#Only the cleaned text is kept in memory, as one copy for the analyzer. Returns the text and its blob path
+async def _download_book_text(gutenberg_id: int) -> Optional[Tuple[str, str]]:
+    writer = await asyncio.to_thread(corpus_store.writer)
+    chunks = []
+    try:
+        async for chunk in gutendex_service.stream_book_text(gutenberg_id):
+            await asyncio.to_thread(writer.write, chunk)
+            chunks.append(chunk)
+    except Exception as e:
+        print(f"Download of Gutenberg ID {gutenberg_id} failed part way: {e}")
+        await asyncio.to_thread(writer.abort)
+        return None
+
+    if not chunks:
+        await asyncio.to_thread(writer.abort)
+        return None
+
+    path = await asyncio.to_thread(writer.commit)
+    return "".join(chunks), path
+
+#The cleaned text of a book from the corpus store, downloading and storing it from Gutenberg the first time.
+#Returns None when the book has no stored text and no Gutenberg ID, or the download fails
+async def load_book_text(db: Session, book: Book) -> Optional[str]:
+    if is_blob_path(book.text_file_path):
+        text = await asyncio.to_thread(corpus_store.get, book.text_file_path)
+        if text is not None:
+            return text
+
+    gutenberg_id = gutenberg_id_of(book)
+    if gutenberg_id is None:
+        return None
+
+    downloaded = await download_flights.run(gutenberg_id, lambda: _download_book_text(gutenberg_id))
+    if downloaded is None:
+        return None
+
+    text, path = downloaded
+    await asyncio.to_thread(_point_at_blob, db, book, path)
+    return text
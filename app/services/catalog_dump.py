@@ -0,0 +1,159 @@
+'''
+    This file reads a local copy of Project Gutenberg's catalog dump, the pg_catalog.csv file or the RDF tarball,
+    and turns every book into the same dictionary gutendex.com returns, so the import maps both the same way
+'''
+
+import csv
+import gzip
+import re
+import tarfile
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List, Optional
+
+GUTENBERG_URL = "https://www.gutenberg.org"
+
+#Only text books are imported, the dump also lists audio books, images and data sets
+MEDIA_TYPE = "Text"
+
+RDF = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+DCTERMS = "{http://purl.org/dc/terms/}"
+DCAM = "{http://purl.org/dc/dcam/}"
+PGTERMS = "{http://www.gutenberg.org/2009/pgterms/}"
+
+#The years after an author's name in the CSV, "Melville, Herman, 1819-1891" or "Homer, 751? BCE-651? BCE"
+AUTHOR_YEARS = re.compile(r"^(?P<birth>\d+)?\??(?P<birth_bce> BCE)?-(?P<death>\d+)?\??(?P<death_bce> BCE)?$")
+
+#The role after a contributor in the CSV, "Smith, John [Translator]"
+AUTHOR_ROLE = re.compile(r"\s*\[[^\]]*\]$")
+
+def read_catalog_dump(path: str) -> Iterator[Dict]:
+    """
+    Yields the text books of a catalog dump one at a time, so the whole catalog is never in memory.
+    The format is picked from the file name: pg_catalog.csv, optionally gzipped, or rdf-files.tar with
+    any compression tarfile reads.
+    """
+    if path.endswith((".csv", ".csv.gz")):
+        return read_csv_catalog(path)
+    if ".tar" in path:
+        return read_rdf_catalog(path)
+    raise ValueError(f"Unknown catalog dump format: {path}")
+
+def _year(value: Optional[str], bce: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    return -int(value) if bce else int(value)
+
+def _split(value: str) -> List[str]:
+    return [part.strip() for part in value.split(";") if part.strip()]
+
+#Splits "Melville, Herman, 1819-1891" into its name and years, names without years are kept whole
+def parse_csv_author(value: str) -> Dict:
+    name = AUTHOR_ROLE.sub("", value.strip())
+    author = {"name": name, "birth_year": None, "death_year": None}
+    if ", " in name:
+        rest, years = name.rsplit(", ", 1)
+        match = AUTHOR_YEARS.match(years)
+        if match:
+            author["name"] = rest
+            author["birth_year"] = _year(match["birth"], match["birth_bce"])
+            author["death_year"] = _year(match["death"], match["death_bce"])
+    return author
+
+#The CSV has no file list, so the book points at the URLs gutenberg.org serves every book from
+def _standard_formats(gutenberg_id: int) -> Dict[str, str]:
+    return {
+        "text/plain; charset=utf-8": f"{GUTENBERG_URL}/ebooks/{gutenberg_id}.txt.utf-8",
+        "text/html": f"{GUTENBERG_URL}/ebooks/{gutenberg_id}.html.images",
+        "image/jpeg": f"{GUTENBERG_URL}/cache/epub/{gutenberg_id}/pg{gutenberg_id}.cover.medium.jpg"
+    }
+
+def read_csv_catalog(path: str) -> Iterator[Dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file):
+            if row.get("Type") != MEDIA_TYPE or not row.get("Text#", "").isdigit():
+                continue
+            gutenberg_id = int(row["Text#"])
+            yield {
+                "id": gutenberg_id,
+                "title": " ".join(row.get("Title", "").split()) or "Unknown Title",
+                "authors": [parse_csv_author(author) for author in _split(row.get("Authors", ""))],
+                "subjects": _split(row.get("Subjects", "")),
+                "bookshelves": _split(row.get("Bookshelves", "")),
+                "languages": _split(row.get("Language", "")),
+                "media_type": MEDIA_TYPE,
+                "formats": _standard_formats(gutenberg_id),
+                "summaries": []
+            }
+
+def _values(element: ET.Element, path: str) -> List[str]:
+    return [value.text.strip() for value in element.findall(f"{path}/{RDF}Description/{RDF}value") if value.text]
+
+def _text(element: Optional[ET.Element]) -> Optional[str]:
+    return " ".join(element.text.split()) if element is not None and element.text else None
+
+def _int(element: Optional[ET.Element]) -> Optional[int]:
+    try:
+        return int(element.text) if element is not None and element.text else None
+    except ValueError:
+        return None
+
+#Subjects in the RDF come from two vocabularies, gutendex.com only lists the subject headings
+def _subjects(ebook: ET.Element) -> List[str]:
+    subjects = []
+    for description in ebook.findall(f"{DCTERMS}subject/{RDF}Description"):
+        scheme = description.find(f"{DCAM}memberOf")
+        value = description.find(f"{RDF}value")
+        if value is not None and value.text and scheme is not None and scheme.get(f"{RDF}resource", "").endswith("LCSH"):
+            subjects.append(value.text.strip())
+    return subjects
+
+def parse_rdf_ebook(data: bytes) -> Optional[Dict]:
+    ebook = ET.fromstring(data).find(f"{PGTERMS}ebook")
+    if ebook is None:
+        return None
+    about = ebook.get(f"{RDF}about", "")
+    if not about.rsplit("/", 1)[-1].isdigit():
+        return None
+    media_types = _values(ebook, f"{DCTERMS}type")
+    if media_types and media_types[0] != MEDIA_TYPE:
+        return None
+
+    authors = []
+    for agent in ebook.findall(f"{DCTERMS}creator/{PGTERMS}agent"):
+        authors.append({
+            "name": _text(agent.find(f"{PGTERMS}name")),
+            "birth_year": _int(agent.find(f"{PGTERMS}birthdate")),
+            "death_year": _int(agent.find(f"{PGTERMS}deathdate"))
+        })
+
+    #Files are keyed by media type like gutendex.com, the first file of each type wins
+    formats = {}
+    for file in ebook.findall(f"{DCTERMS}hasFormat/{PGTERMS}file"):
+        media = _values(file, f"{DCTERMS}format")
+        if media and media[0] not in formats:
+            formats[media[0]] = file.get(f"{RDF}about")
+
+    summary = _text(ebook.find(f"{PGTERMS}marc520"))
+    return {
+        "id": int(about.rsplit("/", 1)[-1]),
+        "title": _text(ebook.find(f"{DCTERMS}title")) or "Unknown Title",
+        "authors": authors,
+        "subjects": _subjects(ebook),
+        "bookshelves": _values(ebook, f"{PGTERMS}bookshelf"),
+        "languages": _values(ebook, f"{DCTERMS}language"),
+        "media_type": MEDIA_TYPE,
+        "formats": formats,
+        "summaries": [summary] if summary else [],
+        "download_count": _int(ebook.find(f"{PGTERMS}downloads"))
+    }
+
+def read_rdf_catalog(path: str) -> Iterator[Dict]:
+    #Stream mode reads the members in order without seeking, so a compressed tarball is never unpacked to disk
+    with tarfile.open(path, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(".rdf"):
+                continue
+            book = parse_rdf_ebook(tar.extractfile(member).read())
+            if book is not None:
+                yield book
@@ -0,0 +1,166 @@
+'''
+    This file stores the subjects and languages of the catalog in normalized tables and keeps how many books
+    each one has, so books can be browsed and filtered by them without asking gutendex.com
+'''
+
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Query, Session
+
+from app.models import Book, BookLanguage, BookSubject, FacetCount, Subject
+
+SUBJECT_FACET = "subject"
+LANGUAGE_FACET = "language"
+
+#Most values returned per facet
+MAX_FACET_VALUES = 200
+
+#Adds the download count and the facet tables to a database created before they were in the model.
+#The import script runs these too, it does not create the models' tables
+FACET_SCHEMA_STATEMENTS = (
+    "ALTER TABLE books ADD COLUMN IF NOT EXISTS download_count INTEGER",
+    """
+    CREATE TABLE IF NOT EXISTS subjects (
+        subject_id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS book_subjects (
+        book_id UUID NOT NULL REFERENCES books (book_id) ON DELETE CASCADE,
+        subject_id INTEGER NOT NULL REFERENCES subjects (subject_id) ON DELETE CASCADE,
+        PRIMARY KEY (book_id, subject_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_book_subjects_subject ON book_subjects (subject_id, book_id)",
+    """
+    CREATE TABLE IF NOT EXISTS book_languages (
+        book_id UUID NOT NULL REFERENCES books (book_id) ON DELETE CASCADE,
+        language VARCHAR(10) NOT NULL,
+        PRIMARY KEY (book_id, language)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_book_languages_language ON book_languages (language, book_id)",
+    """
+    CREATE TABLE IF NOT EXISTS facet_counts (
+        facet VARCHAR(20) NOT NULL,
+        value TEXT NOT NULL,
+        book_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (facet, value)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_facet_counts_facet_count ON facet_counts (facet, book_count)",
+)
+
+#Recounts every facet in one transaction. The bulk import runs it once at the end, single books adjust the counts
+#as they change
+REFRESH_FACET_COUNTS_STATEMENTS = (
+    "DELETE FROM facet_counts",
+    f"""
+    INSERT INTO facet_counts (facet, value, book_count)
+    SELECT '{SUBJECT_FACET}', subjects.name, COUNT(*)
+    FROM book_subjects JOIN subjects ON subjects.subject_id = book_subjects.subject_id
+    GROUP BY subjects.name
+    """,
+    f"""
+    INSERT INTO facet_counts (facet, value, book_count)
+    SELECT '{LANGUAGE_FACET}', language, COUNT(*)
+    FROM book_languages
+    GROUP BY language
+    """,
+)
+
+def ensure_facet_schema(db: Session):
+    for statement in FACET_SCHEMA_STATEMENTS:
+        db.execute(text(statement))
+    db.commit()
+
+#Subjects and languages without blanks or repeats, in their original order
+def clean_facet_values(values: Optional[Iterable[str]]) -> List[str]:
+    return list(dict.fromkeys(value.strip() for value in values or [] if value and value.strip()))
+
+#Values a book gains and values it loses going from current to wanted, both in their original order
+def facet_changes(current: Iterable[str], wanted: List[str]) -> Tuple[List[str], List[str]]:
+    current = list(current)
+    return [value for value in wanted if value not in current], [value for value in current if value not in wanted]
+
+#Moves the counts of the values a book gained up and of the ones it lost down
+def _adjust_counts(db: Session, facet: str, added: Iterable[str], removed: Iterable[str]):
+    for value in added:
+        db.execute(insert(FacetCount).values(facet=facet, value=value, book_count=1).on_conflict_do_update(
+            index_elements=[FacetCount.facet, FacetCount.value],
+            set_={"book_count": FacetCount.book_count + 1}
+        ))
+    removed = list(removed)
+    if removed:
+        db.query(FacetCount).filter(FacetCount.facet == facet, FacetCount.value.in_(removed)).update(
+            {FacetCount.book_count: FacetCount.book_count - 1}, synchronize_session=False
+        )
+        db.query(FacetCount).filter(
+            FacetCount.facet == facet, FacetCount.value.in_(removed), FacetCount.book_count <= 0
+        ).delete(synchronize_session=False)
+
+#Replaces a book's subjects and languages and adjusts the facet counts by the difference. The caller commits
+def set_book_facets(db: Session, book_id: UUID, subjects: Optional[Iterable[str]], languages: Optional[Iterable[str]]):
+    subjects = clean_facet_values(subjects)
+    languages = clean_facet_values(languages)
+
+    current_subjects = dict(db.query(Subject.name, Subject.subject_id).join(
+        BookSubject, BookSubject.subject_id == Subject.subject_id
+    ).filter(BookSubject.book_id == book_id).all())
+    added_subjects, removed_subjects = facet_changes(current_subjects, subjects)
+
+    if added_subjects:
+        db.execute(insert(Subject).values([{"name": name} for name in added_subjects]).on_conflict_do_nothing())
+        subject_ids = db.query(Subject.subject_id).filter(Subject.name.in_(added_subjects)).all()
+        db.execute(insert(BookSubject).values([
+            {"book_id": book_id, "subject_id": subject_id} for (subject_id,) in subject_ids
+        ]).on_conflict_do_nothing())
+    if removed_subjects:
+        db.query(BookSubject).filter(
+            BookSubject.book_id == book_id,
+            BookSubject.subject_id.in_([current_subjects[name] for name in removed_subjects])
+        ).delete(synchronize_session=False)
+
+    current_languages = {language for (language,) in db.query(BookLanguage.language).filter(BookLanguage.book_id == book_id).all()}
+    added_languages, removed_languages = facet_changes(current_languages, languages)
+
+    if added_languages:
+        db.execute(insert(BookLanguage).values([
+            {"book_id": book_id, "language": language} for language in added_languages
+        ]).on_conflict_do_nothing())
+    if removed_languages:
+        db.query(BookLanguage).filter(
+            BookLanguage.book_id == book_id, BookLanguage.language.in_(removed_languages)
+        ).delete(synchronize_session=False)
+
+    _adjust_counts(db, SUBJECT_FACET, added_subjects, removed_subjects)
+    _adjust_counts(db, LANGUAGE_FACET, added_languages, removed_languages)
+
+#Keeps the books that have the subject and the language. Both are exact values, as listed by facet_values
+def filter_by_facets(query: Query, subject: Optional[str] = None, language: Optional[str] = None) -> Query:
+    if subject:
+        query = query.filter(Book.book_id.in_(
+            select(BookSubject.book_id).join(Subject, Subject.subject_id == BookSubject.subject_id).where(Subject.name == subject)
+        ))
+    if language:
+        query = query.filter(Book.book_id.in_(
+            select(BookLanguage.book_id).where(BookLanguage.language == language)
+        ))
+    return query
+
+#The subjects and languages with the most books and how many each has, read from the stored counts
+def facet_values(db: Session, limit: int = 50) -> Dict[str, List[Dict]]:
+    limit = max(1, min(limit, MAX_FACET_VALUES))
+    return {
+        facet: [
+            {"value": value, "count": count}
+            for value, count in db.query(FacetCount.value, FacetCount.book_count).filter(
+                FacetCount.facet == facet
+            ).order_by(FacetCount.book_count.desc(), FacetCount.value).limit(limit).all()
+        ]
+        for facet in (SUBJECT_FACET, LANGUAGE_FACET)
+    }
@@ -0,0 +1,68 @@
+'''
+    This file searches the imported Gutenberg catalog in PostgreSQL, so most searches never reach gutendex.com
+'''
+
+import re
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+from app.models import SEARCH_VECTOR_SQL, Book
+
+#Words of a search that are matched, longer searches are cut here
+MAX_SEARCH_TERMS = 8
+
+#Adds the generated search column and its GIN index to a books table created before they were in the model
+SEARCH_SCHEMA_STATEMENTS = (
+    f"ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR_SQL}) STORED",
+    "CREATE INDEX IF NOT EXISTS idx_books_search_vector ON books USING GIN (search_vector)",
+)
+
+def ensure_search_schema(db: Session):
+    for statement in SEARCH_SCHEMA_STATEMENTS:
+        db.execute(text(statement))
+    db.commit()
+
+#Turns a search into a tsquery where every word must match as a prefix, "pride prej" becomes "pride:* & prej:*".
+#Returns None when the search has no words
+def prefix_query(search: str) -> Optional[str]:
+    words = re.findall(r"\w+", search.lower())[:MAX_SEARCH_TERMS]
+    if not words:
+        return None
+    return " & ".join(f"{word}:*" for word in words)
+
+#The same fields as a Gutendex search result, plus the book_id of the local row
+def _catalog_row(book: Book) -> Dict:
+    return {
+        "book_id": book.book_id,
+        "gutenberg_id": book.gutenberg_id,
+        "title": book.title,
+        "authors": [book.author],
+        "author": book.author,
+        "cover_url": book.cover_url,
+        "summary": book.summary,
+        "subjects": [],
+        "languages": [],
+        "download_count": None,
+        "formats": {}
+    }
+
+def search_catalog(db: Session, search: str, limit: int = 10) -> List[Dict]:
+    """
+    Ranks the imported Gutenberg books against the search through the GIN index on books.search_vector.
+    The query is built with both the english and simple configurations, so stemmed title words and
+    unstemmed author names both match.
+    """
+    terms = prefix_query(search)
+    if terms is None:
+        return []
+
+    query = func.to_tsquery("english", terms).op("||")(func.to_tsquery("simple", terms))
+    rank = func.ts_rank_cd(Book.search_vector, query)
+    books = db.query(Book).filter(
+        Book.gutenberg_id != None,
+        Book.search_vector.op("@@")(query)
+    ).order_by(rank.desc(), Book.title).limit(limit).all()
+
+    return [_catalog_row(book) for book in books]
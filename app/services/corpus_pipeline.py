@@ -0,0 +1,332 @@
+'''
+    This file analyses every book that has not been analysed yet in one pipeline of download, analysis and write
+    stages, joined by bounded queues so a slow stage holds the others back instead of filling memory
+'''
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.models import Book, FunctionWordProfile, StylometricProfile, StylometricTimeline
+from app.services.analysis_cache import analysis_cache
+from app.services.analysis_pool import analysis_pool
+from app.services.book_text_service import load_book_text
+from app.services.corpus_store import text_hash
+from app.services.delta_service import pack_frequencies
+from app.services.stylometry_service import ANALYSIS_VERSION, FUNCTION_WORDS_VERSION, PROFILE_DTYPE, TIMELINE_WINDOW_WORDS
+from app.services.timeline_service import pack_timeline
+
+#Gutenberg downloads running at once, books read per query, and results written per transaction
+DOWNLOAD_CONCURRENCY = int(os.getenv("PIPELINE_DOWNLOAD_CONCURRENCY", 8))
+SELECT_BATCH_SIZE = 200
+WRITE_BATCH_SIZE = int(os.getenv("PIPELINE_WRITE_BATCH_SIZE", 50))
+
+#Longest a result waits for its batch to fill before it is written anyway
+WRITE_INTERVAL_SECONDS = 10.0
+
+#Throughput of every stage is printed this often
+REPORT_SECONDS = 15.0
+
+#One book going through the stages. text_file_path and gutenberg_id are written back with the result, because
+#the download stage points the book at its stored text
+@dataclass
+class PipelineItem:
+    book_id: UUID
+    text_file_path: Optional[str]
+    gutenberg_id: Optional[int]
+    text: Optional[str] = None
+    result: Optional[Tuple[Dict, np.ndarray, np.ndarray]] = None
+    cache_key: Optional[str] = None
+    cached: bool = False
+
+class StageStats:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.busy_seconds = 0.0
+        self._started = time.monotonic()
+
+    def stats(self) -> Dict:
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        return {
+            "done": self.done,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "per_second": round(self.done / elapsed, 2),
+            "busy_seconds": round(self.busy_seconds, 1)
+        }
+
+#Books the pipeline picks up. Sampled previews are already marked analysed and are left to the exact analysis
+#the preview scheduled
+def unanalysed_filter():
+    return or_(Book.analysed == False, Book.analysed == None)
+
+class CorpusPipeline:
+    '''
+        Selects the books that are not analysed in book_id order and passes them through three stages:
+        downloads on the event loop with bounded concurrency, analysis in the process pool with one book per
+        worker, and writes in batches from a thread. Each batch stores the profiles and marks the books analysed
+        in one transaction, so the analysed flag is the checkpoint and a run that stops is carried on by running
+        it again. Books that fail are left unanalysed for the next run.
+    '''
+
+    def __init__(
+        self,
+        download_concurrency: int = DOWNLOAD_CONCURRENCY,
+        analysis_concurrency: Optional[int] = None,
+        write_batch_size: int = WRITE_BATCH_SIZE,
+        select_batch_size: int = SELECT_BATCH_SIZE,
+        limit: Optional[int] = None
+    ):
+        self.download_concurrency = download_concurrency
+        self.analysis_concurrency = analysis_concurrency or analysis_pool.max_workers
+        self.write_batch_size = write_batch_size
+        self.select_batch_size = select_batch_size
+        self.limit = limit
+
+        #Books are small, so a few pages wait for the downloaders. Texts are large, so only one per analysis
+        #worker waits, and results wait for at most two batches
+        self.books: asyncio.Queue = asyncio.Queue(maxsize=download_concurrency * 2)
+        self.texts: asyncio.Queue = asyncio.Queue(maxsize=self.analysis_concurrency)
+        self.results: asyncio.Queue = asyncio.Queue(maxsize=write_batch_size * 2)
+
+        self.select_stage = StageStats("select")
+        self.download_stage = StageStats("download")
+        self.analysis_stage = StageStats("analyse")
+        self.write_stage = StageStats("write")
+
+    async def run(self) -> Dict:
+        stages = [
+            asyncio.create_task(self._select()),
+            asyncio.create_task(self._stage(
+                self.download_concurrency, self._download_worker, self.books, self.texts, self.analysis_concurrency
+            )),
+            asyncio.create_task(self._stage(self.analysis_concurrency, self._analysis_worker, self.texts, self.results, 1)),
+            asyncio.create_task(self._write())
+        ]
+        reporter = asyncio.create_task(self._report_every(REPORT_SECONDS))
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            #A stage that fails stops the others, which would otherwise wait on its queue forever
+            for task in stages + [reporter]:
+                task.cancel()
+            await asyncio.gather(*stages, reporter, return_exceptions=True)
+        self._report()
+        return self.stats()
+
+    #Reads pages of unanalysed books with a keyset on book_id, so books that fail are not picked up again
+    #in the same run. Each page is read in a thread with its own session and the books are detached, so no
+    #connection or transaction stays open while they go through the stages
+    async def _select(self):
+        last_book_id = None
+        selected = 0
+        while self.limit is None or selected < self.limit:
+            size = self.select_batch_size if self.limit is None else min(self.select_batch_size, self.limit - selected)
+            books = await asyncio.to_thread(self._select_page, last_book_id, size)
+            if not books:
+                break
+
+            last_book_id = books[-1].book_id
+            selected += len(books)
+            for book in books:
+                await self.books.put(book)
+                self.select_stage.done += 1
+
+        for _ in range(self.download_concurrency):
+            await self.books.put(None)
+
+    def _select_page(self, last_book_id: Optional[UUID], size: int) -> List[Book]:
+        db = SessionLocal()
+        try:
+            query = db.query(Book).filter(unanalysed_filter())
+            if last_book_id is not None:
+                query = query.filter(Book.book_id > last_book_id)
+            books = query.order_by(Book.book_id).limit(size).all()
+            db.expunge_all()
+            return books
+        finally:
+            db.close()
+
+    #Runs the workers of a stage and tells every worker of the next stage to stop once they have all finished.
+    #A stage that fails sends no stop, run cancels every stage instead
+    async def _stage(self, workers: int, worker, inbox: asyncio.Queue, outbox: asyncio.Queue, next_workers: int):
+        await asyncio.gather(*[worker(inbox, outbox) for _ in range(workers)])
+        for _ in range(next_workers):
+            await outbox.put(None)
+
+    #Reads the text from the corpus store or downloads it. Books without a text are skipped, and a failed
+    #download still sends the book on so the stored text it might have is written back. Each download has its
+    #own session, which only connects for books that still keep their Gutenberg ID in text_file_path
+    async def _download_worker(self, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        while (book := await inbox.get()) is not None:
+            started = time.monotonic()
+            db = SessionLocal()
+            try:
+                text = await load_book_text(db, book)
+            except Exception as e:
+                print(f"Download of {book.book_id} failed: {e}")
+                text = None
+                self.download_stage.failed += 1
+            else:
+                if text:
+                    self.download_stage.done += 1
+                else:
+                    self.download_stage.skipped += 1
+            finally:
+                await asyncio.to_thread(db.close)
+            self.download_stage.busy_seconds += time.monotonic() - started
+            await outbox.put(PipelineItem(book.book_id, book.text_file_path, book.gutenberg_id, text=text))
+
+    #Texts analysed before are read from the analysis cache, the others take one worker of the process pool
+    async def _analysis_worker(self, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        while (item := await inbox.get()) is not None:
+            if item.text:
+                started = time.monotonic()
+                item.cache_key = text_hash(item.text)
+                try:
+                    item.result = await asyncio.to_thread(self._cached_analysis, item.cache_key)
+                    item.cached = item.result is not None
+                    if item.result is None:
+                        item.result = await analysis_pool.analyze_book(item.text)
+                    self.analysis_stage.done += 1
+                except Exception as e:
+                    print(f"Analysis of {item.book_id} failed: {e}")
+                    self.analysis_stage.failed += 1
+                self.analysis_stage.busy_seconds += time.monotonic() - started
+                #The text is not needed past this stage
+                item.text = None
+            await outbox.put(item)
+
+    #Looks a text up in the analysis cache with a session of its own, the analysis workers run at once
+    def _cached_analysis(self, key: str) -> Optional[Tuple[Dict, np.ndarray, np.ndarray]]:
+        db = SessionLocal()
+        try:
+            cached = analysis_cache.get(db, key)
+            db.commit()
+            return cached
+        finally:
+            db.close()
+
+    #Collects results into batches and writes each one from a thread so the event loop keeps downloading.
+    #A batch is written when it is full, when results stop arriving for a while, or at the end
+    async def _write(self):
+        db = SessionLocal()
+        batch: List[PipelineItem] = []
+        finished = False
+        try:
+            while not finished:
+                try:
+                    item = await asyncio.wait_for(self.results.get(), timeout=WRITE_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    flush = True
+                else:
+                    finished = item is None
+                    if item is not None:
+                        batch.append(item)
+                    flush = finished or len(batch) >= self.write_batch_size
+                if batch and flush:
+                    started = time.monotonic()
+                    written = await asyncio.to_thread(self._write_batch, db, batch)
+                    self.write_stage.busy_seconds += time.monotonic() - started
+                    self.write_stage.done += written
+                    self.write_stage.skipped += len(batch) - written
+                    batch = []
+        finally:
+            db.close()
+
+    #Writes the profiles, function word frequencies, timelines and cache entries of a batch, and marks its books
+    #analysed in one transaction. Books without a result only get their text_file_path. Returns how many
+    #books were marked analysed
+    def _write_batch(self, db: Session, batch: List[PipelineItem]) -> int:
+        analysed = [item for item in batch if item.result is not None]
+        #Identical texts in one batch share a cache entry, which is added once
+        cache_keys = set()
+        try:
+            profiles = {
+                profile.book_id: profile
+                for profile in db.query(StylometricProfile).filter(
+                    StylometricProfile.book_id.in_([item.book_id for item in analysed])
+                ).all()
+            } if analysed else {}
+
+            for item in analysed:
+                analysis_results, frequencies, timeline = item.result
+                profile = profiles.get(item.book_id)
+                if profile is None:
+                    profile = StylometricProfile(book_id=item.book_id)
+                    db.add(profile)
+                else:
+                    profile.analysed_at = func.now()
+                for name in PROFILE_DTYPE.names:
+                    setattr(profile, name, analysis_results[name])
+                profile.analysis_version = ANALYSIS_VERSION
+
+                db.merge(FunctionWordProfile(
+                    book_id=item.book_id,
+                    frequencies=pack_frequencies(frequencies),
+                    vocabulary_version=FUNCTION_WORDS_VERSION
+                ))
+                db.merge(StylometricTimeline(
+                    book_id=item.book_id,
+                    window_words=TIMELINE_WINDOW_WORDS,
+                    windows=len(timeline),
+                    metrics=pack_timeline(timeline),
+                    analysis_version=ANALYSIS_VERSION
+                ))
+                if not item.cached and item.cache_key not in cache_keys:
+                    cache_keys.add(item.cache_key)
+                    analysis_cache.add(db, item.cache_key, analysis_results, frequencies, timeline)
+
+            #One executemany for the whole batch instead of loading every book
+            db.bulk_update_mappings(Book, [
+                {
+                    "book_id": item.book_id,
+                    "text_file_path": item.text_file_path,
+                    "gutenberg_id": item.gutenberg_id,
+                    "analysed": item.result is not None
+                }
+                for item in batch
+            ])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            #Nothing written is read back, so the session does not need to keep it
+            db.expunge_all()
+
+        analysis_cache.evict_if_due(db)
+        return len(analysed)
+
+    async def _report_every(self, seconds: float):
+        while True:
+            await asyncio.sleep(seconds)
+            self._report()
+
+    def _report(self):
+        stages = [self.select_stage, self.download_stage, self.analysis_stage, self.write_stage]
+        line = " | ".join(
+            f"{stage.name} {stage.done} ({stage.stats()['per_second']}/s"
+            + (f", {stage.failed} failed" if stage.failed else "")
+            + ")"
+            for stage in stages
+        )
+        print(f"{line} | queued {self.books.qsize()}/{self.texts.qsize()}/{self.results.qsize()}")
+
+    def stats(self) -> Dict:
+        return {
+            stage.name: stage.stats()
+            for stage in [self.select_stage, self.download_stage, self.analysis_stage, self.write_stage]
+        }
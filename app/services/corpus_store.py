@@ -0,0 +1,202 @@
+'''
+    This file keeps cleaned book texts on local disk, gzip compressed and named by the hash of their content,
+    so a book is only downloaded from Gutenberg once
+'''
+
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+
+#Where the blobs and their index live, and how much compressed text is kept before the least recently read is evicted
+CORPUS_DIR = os.getenv("CORPUS_DIR", "corpus")
+CORPUS_MAX_BYTES = int(os.getenv("CORPUS_MAX_BYTES", 2 * 1024 ** 3))
+
+#The key of a cleaned text, shared by the corpus store and the analysis cache
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+#Stored texts are <first two hash characters>/<hash>.txt.gz under CORPUS_DIR
+BLOB_SUFFIX = ".txt.gz"
+
+def is_blob_path(path: Optional[str]) -> bool:
+    return bool(path) and path.endswith(BLOB_SUFFIX)
+
+class CorpusStore:
+    '''
+        Content-addressed store of gzip compressed texts. A small SQLite index next to the blobs records their
+        sizes and when each was last read, which drives the LRU eviction and is shared by every worker on the machine.
+    '''
+
+    def __init__(self, root: str = CORPUS_DIR, max_bytes: int = CORPUS_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _index(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._connection = sqlite3.connect(os.path.join(self.root, "index.sqlite3"), timeout=30, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "path TEXT PRIMARY KEY, raw_bytes INTEGER NOT NULL, stored_bytes INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_read_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS blobs_last_read_at ON blobs (last_read_at)")
+            self._connection.commit()
+        return self._connection
+
+    def blob_path(self, text: str) -> str:
+        key = text_hash(text)
+        return f"{key[:2]}/{key}{BLOB_SUFFIX}"
+
+    #Writes a text once and returns its path relative to the store, identical texts share one blob
+    def put(self, text: str) -> str:
+        path = self.blob_path(text)
+        with self._lock:
+            if self._touch(self._index(), path):
+                return path
+
+        raw = text.encode("utf-8")
+        temporary_path = self._temporary_path()
+        with open(temporary_path, "wb") as file:
+            file.write(gzip.compress(raw, compresslevel=6))
+        return self._add(path, temporary_path, len(raw))
+
+    #A writer that compresses a text into the store chunk by chunk, for texts that arrive as a stream
+    def writer(self) -> "BlobWriter":
+        return BlobWriter(self)
+
+    def _temporary_path(self) -> str:
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, f".{uuid.uuid4().hex}.tmp")
+
+    #Marks a blob as just read if it is indexed and still on disk
+    def _touch(self, index: sqlite3.Connection, path: str) -> bool:
+        if not index.execute("SELECT 1 FROM blobs WHERE path = ?", (path,)).fetchone():
+            return False
+        if not os.path.exists(os.path.join(self.root, path)):
+            return False
+        index.execute("UPDATE blobs SET last_read_at = ? WHERE path = ?", (time.time(), path))
+        index.commit()
+        return True
+
+    #Moves a finished temporary file into place under its hash, so a reader never sees half a file
+    def _add(self, path: str, temporary_path: str, raw_bytes: int) -> str:
+        full_path = os.path.join(self.root, path)
+        with self._lock:
+            index = self._index()
+            if self._touch(index, path):
+                os.remove(temporary_path)
+                return path
+
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(temporary_path, full_path)
+            now = time.time()
+            index.execute(
+                "INSERT OR REPLACE INTO blobs (path, raw_bytes, stored_bytes, created_at, last_read_at) VALUES (?, ?, ?, ?, ?)",
+                (path, raw_bytes, os.path.getsize(full_path), now, now)
+            )
+            index.commit()
+            self._evict(index, keep=path)
+        return path
+
+    #Reads a stored text, or None if it is not stored. A truncated or corrupt blob is dropped from the index
+    #like a missing one, so the book is downloaded again
+    def get(self, path: str) -> Optional[str]:
+        full_path = os.path.join(self.root, path)
+        try:
+            with gzip.open(full_path, "rb") as file:
+                text = file.read().decode("utf-8")
+        except (OSError, EOFError, ValueError):
+            self.misses += 1
+            with self._lock:
+                index = self._index()
+                index.execute("DELETE FROM blobs WHERE path = ?", (path,))
+                index.commit()
+            return None
+
+        with self._lock:
+            index = self._index()
+            index.execute("UPDATE blobs SET last_read_at = ? WHERE path = ?", (time.time(), path))
+            index.commit()
+        self.hits += 1
+        return text
+
+    #Deletes the least recently read blobs until the store is back under max_bytes
+    def _evict(self, index: sqlite3.Connection, keep: Optional[str] = None):
+        total = index.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for path, stored_bytes in index.execute("SELECT path, stored_bytes FROM blobs ORDER BY last_read_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.root, path))
+            except FileNotFoundError:
+                pass
+            index.execute("DELETE FROM blobs WHERE path = ?", (path,))
+            total -= stored_bytes
+            self.evictions += 1
+        index.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            blobs, raw_bytes, stored_bytes = self._index().execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(stored_bytes), 0) FROM blobs"
+            ).fetchone()
+        return {
+            "blobs": blobs,
+            "raw_bytes": raw_bytes,
+            "stored_bytes": stored_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+class BlobWriter:
+    '''
+        Compresses a text into a temporary file as its chunks are written. The blob path comes from the hash of
+        the whole text, so the file only moves into place on commit.
+    '''
+
+    def __init__(self, store: CorpusStore):
+        self._store = store
+        self._temporary_path = store._temporary_path()
+        self._file = gzip.open(self._temporary_path, "wb", compresslevel=6)
+        self._hash = hashlib.sha256()
+        self.raw_bytes = 0
+
+    def write(self, chunk: str):
+        data = chunk.encode("utf-8")
+        self._hash.update(data)
+        self._file.write(data)
+        self.raw_bytes += len(data)
+
+    #Stores the text and returns its blob path, the same path put() gives for the joined text
+    def commit(self) -> str:
+        self._file.close()
+        key = self._hash.hexdigest()
+        return self._store._add(f"{key[:2]}/{key}{BLOB_SUFFIX}", self._temporary_path, self.raw_bytes)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._temporary_path)
+        except FileNotFoundError:
+            pass
+
+#Create singleton instance
+corpus_store = CorpusStore()
@@ -0,0 +1,205 @@
+'''
+    This file finds the books closest in style to a given book using Burrows' Delta over function word frequencies
+'''
+
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models import FunctionWordProfile
+from app.services.stylometry_service import FUNCTION_WORDS, FUNCTION_WORDS_VERSION
+
+#Rows committed by other workers can carry a slightly older timestamp than our last sync, so look back a bit
+SYNC_OVERLAP = timedelta(seconds=60)
+
+#Seconds between the counts that find profiles deleted by other workers, this worker's own deletions are
+#removed at once
+RECOUNT_INTERVAL = 60.0
+
+#Converts a frequency vector to the bytes stored in function_word_profiles and back
+def pack_frequencies(frequencies: np.ndarray) -> bytes:
+    return np.asarray(frequencies, dtype="<f4").tobytes()
+
+def unpack_frequencies(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype="<f4")
+
+class DeltaIndex:
+    '''
+        Keeps every book's function word frequencies in one float32 matrix together with running sums,
+        so the corpus mean and standard deviation are updated as books are added instead of recomputed.
+        Delta between a book and every other book is then one vectorized operation over the z-score matrix.
+    '''
+
+    def __init__(self, n_features: int = len(FUNCTION_WORDS)):
+        self.n_features = n_features
+        self._lock = threading.Lock()
+        self._frequencies = np.zeros((1024, n_features), dtype=np.float32)
+        self._size = 0
+        self._book_ids: List[UUID] = []
+        self._rows = {}
+        self._sum = np.zeros(n_features, dtype=np.float64)
+        self._sum_sq = np.zeros(n_features, dtype=np.float64)
+        self._z_scores: Optional[np.ndarray] = None
+        self._last_sync: Optional[datetime] = None
+        self._recounted_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, book_id: UUID, frequencies: np.ndarray):
+        with self._lock:
+            self._add_rows([book_id], np.asarray(frequencies, dtype=np.float32).reshape(1, -1))
+
+    def add_many(self, book_ids: List[UUID], frequencies: np.ndarray):
+        with self._lock:
+            self._add_rows(book_ids, np.asarray(frequencies, dtype=np.float32).reshape(len(book_ids), -1))
+
+    def _add_rows(self, book_ids: List[UUID], frequencies: np.ndarray):
+        changed = False
+        for book_id, vector in zip(book_ids, frequencies):
+            row = self._rows.get(book_id)
+            if row is None:
+                #Grow the matrix by doubling so adding books stays cheap
+                if self._size == len(self._frequencies):
+                    grown = np.zeros((len(self._frequencies) * 2, self.n_features), dtype=np.float32)
+                    grown[:self._size] = self._frequencies[:self._size]
+                    self._frequencies = grown
+                row = self._size
+                self._size += 1
+                self._book_ids.append(book_id)
+                self._rows[book_id] = row
+            elif np.array_equal(self._frequencies[row], vector):
+                #Sync reads the last rows again, which mostly have not changed
+                continue
+            else:
+                #Re-analysed book - take its old vector out of the running sums first
+                old = self._frequencies[row].astype(np.float64)
+                self._sum -= old
+                self._sum_sq -= old * old
+
+            self._frequencies[row] = vector
+            self._sum += vector
+            self._sum_sq += vector.astype(np.float64) ** 2
+            changed = True
+
+        #The z-scores depend on the corpus mean and std, so rebuild them on the next query
+        if changed:
+            self._z_scores = None
+
+    #Takes a deleted book out of the index and the running sums, moving the last row into its place
+    def remove(self, book_id: UUID):
+        with self._lock:
+            row = self._rows.pop(book_id, None)
+            if row is None:
+                return
+            old = self._frequencies[row].astype(np.float64)
+            self._sum -= old
+            self._sum_sq -= old * old
+            last = self._size - 1
+            if row != last:
+                moved = self._book_ids[last]
+                self._frequencies[row] = self._frequencies[last]
+                self._book_ids[row] = moved
+                self._rows[moved] = row
+            self._book_ids.pop()
+            self._size = last
+            self._z_scores = None
+
+    #Replaces every row, which drops the books whose profile is gone
+    def _replace(self, book_ids: List[UUID], frequencies: np.ndarray):
+        with self._lock:
+            self._frequencies = np.zeros((max(1024, len(book_ids)), self.n_features), dtype=np.float32)
+            self._size = 0
+            self._book_ids = []
+            self._rows = {}
+            self._sum = np.zeros(self.n_features, dtype=np.float64)
+            self._sum_sq = np.zeros(self.n_features, dtype=np.float64)
+            self._z_scores = None
+            if book_ids:
+                self._add_rows(book_ids, np.asarray(frequencies, dtype=np.float32).reshape(len(book_ids), -1))
+
+    def _corpus_stats(self) -> Tuple[np.ndarray, np.ndarray]:
+        n = self._size
+        mean = self._sum / n
+        #Sample standard deviation, the same as faststylometry uses
+        variance = np.maximum(self._sum_sq - n * mean * mean, 0) / max(n - 1, 1)
+        std = np.sqrt(variance)
+        return mean, std
+
+    def _z_matrix(self) -> np.ndarray:
+        if self._z_scores is None:
+            mean, std = self._corpus_stats()
+            #Words that never vary across the corpus cannot tell books apart, so they get zero weight
+            inv_std = np.divide(1.0, std, out=np.zeros_like(std), where=std > 0)
+            self._z_scores = ((self._frequencies[:self._size] - mean) * inv_std).astype(np.float32)
+        return self._z_scores
+
+    def nearest(self, book_id: UUID, limit: int = 10) -> Optional[List[Tuple[UUID, float]]]:
+        """Books with the smallest Delta to book_id, or None if the book is not in the index"""
+        with self._lock:
+            row = self._rows.get(book_id)
+            if row is None:
+                return None
+            if self._size < 2 or limit < 1:
+                return []
+
+            z_scores = self._z_matrix()
+            #Burrows' Delta is the mean absolute difference of z-scores
+            deltas = np.abs(z_scores - z_scores[row]).mean(axis=1)
+            deltas[row] = np.inf
+
+            k = min(limit, self._size - 1)
+            closest = np.argpartition(deltas, k - 1)[:k]
+            closest = closest[np.argsort(deltas[closest])]
+            return [(self._book_ids[i], float(deltas[i])) for i in closest]
+
+    def _track_sync(self, rows):
+        latest = max((row.updated_at for row in rows if row.updated_at is not None), default=None)
+        if latest is not None and (self._last_sync is None or latest > self._last_sync):
+            self._last_sync = latest
+
+    #Loads vectors written since the last sync, including ones committed by other workers. Deleted profiles
+    #never turn up in a sync, so every RECOUNT_INTERVAL seconds the profiles are counted, and when the table
+    #holds a different number than the index, the index is loaded again whole
+    def sync(self, db: Session):
+        query = db.query(
+            FunctionWordProfile.book_id,
+            FunctionWordProfile.frequencies,
+            FunctionWordProfile.updated_at
+        ).filter(FunctionWordProfile.vocabulary_version == FUNCTION_WORDS_VERSION)
+
+        now = time.monotonic()
+        full = query
+        if self._last_sync is not None:
+            query = query.filter(FunctionWordProfile.updated_at >= self._last_sync - SYNC_OVERLAP)
+        else:
+            #Every profile is read, so there is nothing to count
+            self._recounted_at = now
+
+        rows = query.all()
+        if rows:
+            self.add_many([row.book_id for row in rows], np.stack([unpack_frequencies(row.frequencies) for row in rows]))
+            self._track_sync(rows)
+
+        if self._recounted_at is not None and now - self._recounted_at < RECOUNT_INTERVAL:
+            return
+        self._recounted_at = now
+        count = db.query(func.count(FunctionWordProfile.book_id)).filter(
+            FunctionWordProfile.vocabulary_version == FUNCTION_WORDS_VERSION
+        ).scalar()
+        if count != self._size:
+            rows = full.all()
+            self._replace(
+                [row.book_id for row in rows],
+                np.stack([unpack_frequencies(row.frequencies) for row in rows]) if rows else np.zeros((0, self.n_features))
+            )
+            self._track_sync(rows)
+
+#Create singleton instance
+delta_index = DeltaIndex()
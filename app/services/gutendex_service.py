@@ -2,14 +2,464 @@
     This file interacts with the Gutendex API to search and download books from Gutenberg
 '''
 
+import asyncio
 import httpx 
-from typing import Optional, Dict, List
+import os
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional, Dict, List, Tuple
+from urllib.parse import urlsplit
 import re
+import time
+
+from app.services.single_flight import SingleFlight
+from app.services.upstream_guard import UpstreamGuard
+
+#HTTP/2 needs the optional h2 package, without it the client stays on HTTP/1.1
+try:
+    import h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+#Connection pool settings for the shared client
+MAX_CONNECTIONS = int(os.getenv("GUTENDEX_MAX_CONNECTIONS", 20))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("GUTENDEX_MAX_KEEPALIVE", 10))
+KEEPALIVE_EXPIRY = float(os.getenv("GUTENDEX_KEEPALIVE_EXPIRY", 30))
+USE_HTTP2 = os.getenv("GUTENDEX_HTTP2", "false").lower() == "true"
+
+#Requests in flight to one host at a time, so bulk jobs stay polite to gutendex.com and gutenberg.org
+PER_HOST_LIMIT = int(os.getenv("GUTENDEX_PER_HOST_LIMIT", 4))
+
+#Where Gutenberg keeps plain text books, in the order they are tried for a book with no known pattern
+TEXT_URL_PATTERNS = (
+    "https://www.gutenberg.org/files/{id}/{id}-0.txt",
+    "https://www.gutenberg.org/cache/epub/{id}/pg{id}.txt",
+)
+
+#Seconds the preferred text URL has to respond before the other patterns are raced against it
+HEDGE_DELAY = float(os.getenv("GUTENDEX_HEDGE_DELAY", 1.5))
+
+#The pattern that worked is remembered for this many books, and for each block of IDS_PER_RANGE IDs
+#as neighbouring books were usually uploaded the same way
+PATTERN_MEMORY_SIZE = 10000
+IDS_PER_RANGE = 1000
+
+#Gutendex responses are served from memory for CACHE_TTL seconds, then for CACHE_STALE_TTL more seconds while
+#a background request refreshes them. Searches with no results and unknown IDs are kept for CACHE_NEGATIVE_TTL
+CACHE_MAX_ENTRIES = int(os.getenv("GUTENDEX_CACHE_MAX_ENTRIES", 2000))
+CACHE_TTL = float(os.getenv("GUTENDEX_CACHE_TTL", 3600))
+CACHE_STALE_TTL = float(os.getenv("GUTENDEX_CACHE_STALE_TTL", 86400))
+CACHE_NEGATIVE_TTL = float(os.getenv("GUTENDEX_CACHE_NEGATIVE_TTL", 300))
+
+#A cleaned text this short is an error page or a stub rather than a book
+MIN_TEXT_CHARS = 1000
+
+#Removes a "Produced by" credit from where it starts to the end of its line
+PRODUCED_BY = re.compile(r'Produced by', flags=re.IGNORECASE)
+
+class GutenbergTextCleaner:
+    '''
+        Strips the Project Gutenberg header and footer from a text as it arrives, holding only the current line,
+        the blank lines after it and the header until its START marker. feed() and finish() return the cleaned
+        text that is ready, which is the same however the download was split into chunks.
+    '''
+
+    #The header is searched this far for a START marker, after that the text is taken to have none
+    START_SEARCH_CHARS = 100_000
+
+    def __init__(self):
+        self.started = False
+        self.ended = False
+        self.characters = 0
+        self._partial = ""
+        self._header: List[str] = []
+        self._header_chars = 0
+        self._credit: Optional[str] = None
+        self._blank_lines: List[str] = []
+        self._trailing = ""
+        self._emitted = False
+
+    def feed(self, chunk: str) -> str:
+        if self.ended:
+            return ""
+        lines = (self._partial + chunk).split("\n")
+        self._partial = lines.pop()
+        return "".join(self._line(line) for line in lines)
+
+    #Cleans the last line, which has no newline after it, and drops trailing blank lines
+    def finish(self) -> str:
+        out = ""
+        if not self.ended:
+            out += self._line(self._partial)
+        self._partial = ""
+        if not self.started:
+            out += self._replay_header()
+        return out + self._flush_credit()
+
+    def _line(self, line: str) -> str:
+        if self.ended:
+            return ""
+        if self.started:
+            return self._content(line)
+
+        upper = line.upper()
+        if 'START OF' in upper and 'PROJECT GUTENBERG' in upper:
+            print(f"Found START marker: {line[:60]}...")
+            self.started = True
+            self._header = []
+            return ""
+
+        self._header.append(line)
+        self._header_chars += len(line) + 1
+        if self._header_chars > self.START_SEARCH_CHARS:
+            return self._replay_header()
+        return ""
+
+    #Without a START marker the book starts at the first line
+    def _replay_header(self) -> str:
+        self.started = True
+        header, self._header = self._header, []
+        return "".join(self._content(line) for line in header)
+
+    def _content(self, line: str) -> str:
+        if self.ended:
+            return ""
+        upper = line.upper()
+        if 'END OF' in upper and 'PROJECT GUTENBERG' in upper:
+            print(f"Found END marker: {line[:60]}...")
+            self.ended = True
+            return self._flush_credit()
+
+        #A credit is removed with its newline, so what came before it joins the next line
+        if self._credit is not None:
+            line = self._credit[:PRODUCED_BY.search(self._credit).start()] + line
+            self._credit = None
+        if PRODUCED_BY.search(line):
+            self._credit = line
+            return ""
+        return self._text_line(line)
+
+    #A credit on the last line has no newline after it, so it stays
+    def _flush_credit(self) -> str:
+        credit, self._credit = self._credit, None
+        return self._text_line(credit) if credit is not None else ""
+
+    def _text_line(self, line: str) -> str:
+        if not line.strip():
+            self._blank_lines.append(line)
+            return ""
+        return self._emit(line)
+
+    #Writes a line after the blank lines before it, three or more newlines in a row become one empty line
+    def _emit(self, line: str) -> str:
+        if not self._emitted:
+            separator = ""
+            line = line.lstrip()
+        elif len(self._blank_lines) >= 2:
+            separator = self._trailing + "\n\n"
+        elif self._blank_lines:
+            separator = self._trailing + "\n" + self._blank_lines[0] + "\n"
+        else:
+            separator = self._trailing + "\n"
+
+        #Trailing whitespace is held back in case this is the last line
+        content = line.rstrip()
+        self._trailing = line[len(content):]
+        self._blank_lines = []
+        self._emitted = True
+        self.characters += len(separator) + len(content)
+        return separator + content
+
+class MetadataCache:
+    '''
+        Size-bounded LRU cache of Gutendex responses with a time to live. An empty result is a negative entry,
+        it is kept for a shorter time and never served stale. Errors are not cached, and when a request for an
+        expired entry fails the expired value is returned instead.
+    '''
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        ttl: float = CACHE_TTL,
+        stale_ttl: float = CACHE_STALE_TTL,
+        negative_ttl: float = CACHE_NEGATIVE_TTL,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[object, float]]" = OrderedDict()
+        self._refreshing: Dict[Hashable, asyncio.Task] = {}
+        self._flights = SingleFlight()
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.fallback_hits = 0
+        self.refresh_failures = 0
+
+    #Returns the cached value for key, calling fetch when it is missing or expired
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable]):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = self._clock() - fetched_at
+            if not value:
+                if age < self.negative_ttl:
+                    self.negative_hits += 1
+                    self._entries.move_to_end(key)
+                    return value
+            elif age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            elif age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._refresh(key, fetch)
+                return value
+
+        #Concurrent misses for the same key share one request
+        self.misses += 1
+        try:
+            value = await self._flights.run(key, fetch)
+        except Exception:
+            #While Gutendex is failing an expired entry is better than an error
+            if entry is not None:
+                self.fallback_hits += 1
+                return entry[0]
+            raise
+        self._store(key, value)
+        return value
+
+    def _store(self, key: Hashable, value):
+        self._entries[key] = (value, self._clock())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    #Starts one background refresh per key, the stale value stays if it fails
+    def _refresh(self, key: Hashable, fetch: Callable[[], Awaitable]):
+        if key in self._refreshing:
+            return
+        self._refreshing[key] = asyncio.create_task(self._run_refresh(key, fetch))
+
+    async def _run_refresh(self, key: Hashable, fetch: Callable[[], Awaitable]):
+        try:
+            self._store(key, await fetch())
+        except Exception as e:
+            self.refresh_failures += 1
+            print(f"Could not refresh Gutendex cache entry {key}: {e}")
+        finally:
+            self._refreshing.pop(key, None)
+
+    def stats(self) -> Dict:
+        served = self.hits + self.stale_hits + self.negative_hits
+        lookups = served + self.misses
+        negative_entries = sum(1 for value, _ in self._entries.values() if not value)
+        return {
+            "entries": len(self._entries),
+            "negative_entries": negative_entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self._flights.joined,
+            "fallback_hits": self.fallback_hits,
+            "hit_ratio": round(served / lookups, 4) if lookups else 0.0,
+            "refreshing": len(self._refreshing),
+            "refresh_failures": self.refresh_failures
+        }
+
+#The fields of a Gutendex book that the API returns
+def format_book(book: Dict) -> Dict:
+    authors_list = book.get("authors", [])
+    author_names = [author.get("name", "Unknown") for author in authors_list]
+    
+    # Get cover URL from formats
+    formats = book.get("formats", {})
+    cover_url = formats.get("image/jpeg") or formats.get("image/png")
+    
+    return {
+        "gutenberg_id": book.get("id"),
+        "title": book.get("title", "Unknown Title"),
+        "authors": author_names,
+        "author": author_names[0] if author_names else "Unknown",
+        "cover_url": cover_url,
+        "subjects": book.get("subjects", []),
+        "languages": book.get("languages", []),
+        "download_count": book.get("download_count", 0),
+        "formats": book.get("formats", {})
+    }
 
 class GutendexService:
     
     BASE_URL = "https://gutendex.com/books/"  
     
+    def __init__(self, transport: Optional[httpx.AsyncBaseTransport] = None):
+        #Tests pass an httpx.MockTransport here or through use_transport to answer requests locally
+        self._transport = transport
+        self._clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._host_limits: Dict[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]] = {}
+        self._book_patterns: "OrderedDict[int, int]" = OrderedDict()
+        self._range_patterns: Dict[int, int] = {}
+        self.metadata_cache = MetadataCache()
+        self.upstream = UpstreamGuard()
+    
+    #Creates the shared client of the running loop, called from the app lifespan
+    def start(self):
+        try:
+            self._get_client()
+        except RuntimeError:
+            pass
+    
+    #Closes every client. Connections belong to the loop that opened them, so each client is closed in its own
+    #loop. A client whose loop has already closed cannot be closed any more and is dropped
+    async def close(self):
+        current = asyncio.get_running_loop()
+        clients, self._clients = self._clients, {}
+        self._host_limits = {}
+        for loop, client in clients.items():
+            if loop is current:
+                await client.aclose()
+            elif loop.is_running() and not loop.is_closed():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(client.aclose(), loop))
+    
+    #Swaps the transport of the shared client, the next request uses a client built on it
+    async def use_transport(self, transport: Optional[httpx.AsyncBaseTransport]):
+        await self.close()
+        self._transport = transport
+    
+    #The client of the running loop, started on first use for scripts that skip the app lifespan.
+    #Connections belong to an event loop, so each loop gets its own client and those of closed loops are dropped
+    def _get_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            for closed in [other for other in self._clients if other.is_closed()]:
+                del self._clients[closed]
+                self._host_limits.pop(closed, None)
+            client = self._clients[loop] = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=30.0,
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY
+                ),
+                http2=USE_HTTP2 and HTTP2_AVAILABLE,
+                transport=self._transport
+            )
+        return client
+    
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        limits = self._host_limits.setdefault(asyncio.get_running_loop(), {})
+        if host not in limits:
+            limits[host] = asyncio.Semaphore(PER_HOST_LIMIT)
+        return limits[host]
+    
+    #Sends a GET through the shared client and the upstream guard, which rate limits, retries and fails fast
+    #while the host is down. Each attempt waits for a free slot on the host
+    async def _get(self, url: str, **kwargs) -> httpx.Response:
+        client = self._get_client()
+        
+        async def send() -> httpx.Response:
+            async with self._host_limit(url):
+                return await client.get(url, **kwargs)
+        
+        return await self.upstream.send(url, send)
+    
+    #Sends a GET and returns once the headers are in, leaving the body to be read in chunks.
+    #The host slot is held until _close_stream, and a response that is not a success is closed and raised
+    async def _open_stream(self, url: str, **kwargs) -> httpx.Response:
+        client = self._get_client()
+        
+        async def send() -> httpx.Response:
+            limit = self._host_limit(url)
+            await limit.acquire()
+            try:
+                return await client.send(client.build_request("GET", url, **kwargs), stream=True)
+            except BaseException:
+                limit.release()
+                raise
+        
+        response = await self.upstream.send(url, send, discard=lambda retried: self._close_stream(url, retried))
+        try:
+            response.raise_for_status()
+        except BaseException:
+            await self._close_stream(url, response)
+            raise
+        return response
+    
+    async def _close_stream(self, url: str, response: httpx.Response):
+        try:
+            await response.aclose()
+        finally:
+            self._host_limit(url).release()
+    
+    #Opens the first text URL that answers. The first URL has HEDGE_DELAY seconds, or until it fails, before the
+    #others are raced against it, and the requests still in flight are cancelled once one succeeds
+    async def _open_first(self, urls: List[str]) -> Optional[Tuple[str, httpx.Response]]:
+        tasks = {}
+        waiting = list(urls)
+        
+        def start(count: int):
+            for url in waiting[:count]:
+                print(f"Trying to fetch text from: {url}")
+                tasks[asyncio.create_task(self._open_stream(url, timeout=60.0))] = url
+            del waiting[:count]
+        
+        start(1)
+        winner = None
+        try:
+            while tasks and winner is None:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=HEDGE_DELAY if waiting else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    url = tasks.pop(task)
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        print(f"Failed to fetch from {url}: {e}")
+                        continue
+                    if winner is None:
+                        winner = (url, response)
+                    else:
+                        await self._close_stream(url, response)
+                
+                #Either the delay passed or a URL failed, so the rest start together
+                if winner is None:
+                    start(len(waiting))
+        finally:
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for url, result in zip(tasks.values(), results):
+                if isinstance(result, httpx.Response):
+                    await self._close_stream(url, result)
+        return winner
+    
+    #Text URLs of a book, the pattern that last worked for it or its ID range first
+    def _text_urls(self, gutenberg_id: int) -> List[str]:
+        preferred = self._book_patterns.get(gutenberg_id, self._range_patterns.get(gutenberg_id // IDS_PER_RANGE, 0))
+        order = [preferred] + [index for index in range(len(TEXT_URL_PATTERNS)) if index != preferred]
+        return [TEXT_URL_PATTERNS[index].format(id=gutenberg_id) for index in order]
+    
+    def _remember_pattern(self, gutenberg_id: int, url: str):
+        for index, pattern in enumerate(TEXT_URL_PATTERNS):
+            if pattern.format(id=gutenberg_id) == url:
+                self._book_patterns[gutenberg_id] = index
+                self._book_patterns.move_to_end(gutenberg_id)
+                if len(self._book_patterns) > PATTERN_MEMORY_SIZE:
+                    self._book_patterns.popitem(last=False)
+                self._range_patterns[gutenberg_id // IDS_PER_RANGE] = index
+                return
+    
     # This returns list of book with its metadata
     async def search_books(
         self, 
@@ -29,141 +479,117 @@ class GutendexService:
         elif title:
             params["search"] = title
             
-        #This makes a HTTP GET request to the Gutendex API
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            try:
-                response = await client.get(
-                    self.BASE_URL, 
-                    params=params, 
-                    timeout=30.0
-                )
-                response.raise_for_status()
-                data = response.json()
-                
-                #This extract the book data and formats it
-                books = []
-                for book in data.get("results", [])[:limit]:
-                    authors_list = book.get("authors", [])
-                    author_names = [author.get("name", "Unknown") for author in authors_list]
-                    
-                    # Get cover URL from formats
-                    formats = book.get("formats", {})
-                    cover_url = formats.get("image/jpeg") or formats.get("image/png")
-                    
-                    books.append({
-                        "gutenberg_id": book.get("id"),
-                        "title": book.get("title", "Unknown Title"),
-                        "authors": author_names,
-                        "author": author_names[0] if author_names else "Unknown",
-                        "cover_url": cover_url,
-                        "subjects": book.get("subjects", []),
-                        "languages": book.get("languages", []),
-                        "download_count": book.get("download_count", 0),
-                        "formats": book.get("formats", {})
-                    })
-                
-                return books
-            except httpx.HTTPStatusError as e:
-                print(f"HTTP error occurred: {e}")
-                raise
-            except Exception as e:
-                print(f"Error searching Gutendex: {e}")
-                raise
+        #The whole first page is cached, so searches that only differ in limit or case share an entry
+        try:
+            key = ("search", params.get("search", "").strip().lower())
+            books = await self.metadata_cache.get(key, lambda: self._fetch_search(params))
+            return books[:limit]
+        except httpx.HTTPStatusError as e:
+            print(f"HTTP error occurred: {e}")
+            raise
+        except Exception as e:
+            print(f"Error searching Gutendex: {e}")
+            raise
+    
+    #This makes a HTTP GET request to the Gutendex API
+    async def _fetch_search(self, params: Dict) -> List[Dict]:
+        response = await self._get(
+            self.BASE_URL, 
+            params=params, 
+            timeout=30.0
+        )
+        response.raise_for_status()
+        data = response.json()
+        
+        #This extract the book data and formats it
+        return [format_book(book) for book in data.get("results", [])]
     
     #This gets the book metadata by its Gutenberg ID which returns the book directory or None
     async def get_book_by_id(self, gutenberg_id: int) -> Optional[Dict]:
-        url = f"{self.BASE_URL}{gutenberg_id}/"
-        
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            try:
-                response = await client.get(url, timeout=30.0)
-                response.raise_for_status()
-                book = response.json()
-                
-                authors_list = book.get("authors", [])
-                author_names = [author.get("name", "Unknown") for author in authors_list]
-
-                #Get cover URL and formats
-                formats = book.get("formats", {})
-                cover_url = formats.get("image/jpeg") or formats.get("image/png")
-                
-                return {
-                    "gutenberg_id": book.get("id"),
-                    "title": book.get("title", "Unknown Title"),
-                    "authors": author_names,
-                    "author": author_names[0] if author_names else "Unknown",
-                    "cover_url": cover_url,
-                    "subjects": book.get("subjects", []),
-                    "languages": book.get("languages", []),
-                    "download_count": book.get("download_count", 0),
-                    "formats": book.get("formats", {})
-                }
-            except Exception as e:
-                print(f"Error fetching book {gutenberg_id}: {e}")
-                return None
+        try:
+            return await self.metadata_cache.get(("book", gutenberg_id), lambda: self._fetch_book(gutenberg_id))
+        except Exception as e:
+            print(f"Error fetching book {gutenberg_id}: {e}")
+            return None
+    
+    #Only a 404 comes back as None to be cached, other failures raise so they are retried on the next call
+    async def _fetch_book(self, gutenberg_id: int) -> Optional[Dict]:
+        response = await self._get(f"{self.BASE_URL}{gutenberg_id}/", timeout=30.0)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return format_book(response.json())
     
     #This downloads the whole book script if its available
     async def get_book_text(self, gutenberg_id: int) -> Optional[str]:
-        # Try multiple URL formats for text files
-        urls_to_try = [
-            f"https://www.gutenberg.org/files/{gutenberg_id}/{gutenberg_id}-0.txt",
-            f"https://www.gutenberg.org/cache/epub/{gutenberg_id}/pg{gutenberg_id}.txt",
-        ]
+        chunks = []
+        try:
+            async for chunk in self.stream_book_text(gutenberg_id):
+                chunks.append(chunk)
+        except Exception as e:
+            print(f"Download of Gutenberg ID {gutenberg_id} failed part way: {e}")
+            return None
         
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            for url in urls_to_try:
-                try:
-                    print(f"Trying to fetch text from: {url}")
-                    response = await client.get(url, timeout=60.0)
-                    response.raise_for_status()
-                    
-                    # Clean the text (remove Project Gutenberg header/footer)
-                    text = response.text
-                    print(f"Raw text length: {len(text)}")
-                    text = self._clean_gutenberg_text(text)
-                    print(f"Cleaned text length: {len(text)}")
+        return "".join(chunks) if chunks else None
+    
+    #Downloads a book and yields its cleaned text in chunks as they arrive, so the raw text is never held in full.
+    #Nothing is yielded until MIN_TEXT_CHARS are in, so a URL with an empty or stub body falls back to the next one.
+    #A download that breaks after text was yielded raises, as the caller already has part of the book
+    async def stream_book_text(self, gutenberg_id: int) -> AsyncIterator[str]:
+        urls = self._text_urls(gutenberg_id)
+        
+        while urls:
+            opened = await self._open_first(urls)
+            if opened is None:
+                break
+            url, response = opened
+            urls.remove(url)
+            
+            cleaner = GutenbergTextCleaner()
+            head = ""
+            streaming = False
+            try:
+                async for chunk in response.aiter_text():
+                    text = cleaner.feed(chunk)
+                    if streaming:
+                        if text:
+                            yield text
+                    else:
+                        head += text
+                        if len(head) > MIN_TEXT_CHARS:
+                            streaming = True
+                            yield head
                     
-                    if len(text) > 1000:  # Make sure we got actual content
-                        print(f"Successfully fetched {len(text)} characters")
-                        return text
-                except Exception as e:
-                    print(f"Failed to fetch from {url}: {e}")
+                    #The licence after the END marker is not needed, so the rest of the body is skipped
+                    if cleaner.ended:
+                        break
+                tail = cleaner.finish()
+            except Exception as e:
+                if streaming:
+                    raise
+                print(f"Failed to fetch from {url}: {e}")
+                continue
+            finally:
+                await self._close_stream(url, response)
+            
+            if not streaming:
+                head += tail
+                if len(head) <= MIN_TEXT_CHARS:
+                    print(f"Text from {url} is too short after cleaning")
                     continue
+                yield head
+            elif tail:
+                yield tail
             
-            print(f"Could not fetch text for Gutenberg ID {gutenberg_id}")
-            return None
+            self._remember_pattern(gutenberg_id, url)
+            print(f"Successfully fetched {cleaner.characters} characters")
+            return
+        
+        print(f"Could not fetch text for Gutenberg ID {gutenberg_id}")
     
     def _clean_gutenberg_text(self, text: str) -> str:
-        #Split text into lines for easier processing
-        lines = text.split('\n')
-        
-        #Find the start marker
-        start_idx = 0
-        for i, line in enumerate(lines):
-            if 'START OF' in line.upper() and 'PROJECT GUTENBERG' in line.upper():
-                start_idx = i + 1  # Start from the line after the marker
-                print(f"Found START marker at line {i}: {line[:60]}...")
-                break
-        
-        #Find the end marker
-        end_idx = len(lines)
-        for i in range(len(lines) - 1, -1, -1):
-            if 'END OF' in lines[i].upper() and 'PROJECT GUTENBERG' in lines[i].upper():
-                end_idx = i  # End at the line before the marker
-                print(f"Found END marker at line {i}: {lines[i][:60]}...")
-                break
-        
-        #Extract the content between markers
-        content_lines = lines[start_idx:end_idx]
-        text = '\n'.join(content_lines)
-        
-        #Additional cleaning - remove common prefatory material
-        #Remove "Produced by..." lines
-        text = re.sub(r'Produced by[^\n]*\n', '', text, flags=re.IGNORECASE)
-        
-        #Remove excessive whitespace
-        text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)
-        text = text.strip()
+        cleaner = GutenbergTextCleaner()
+        text = cleaner.feed(text) + cleaner.finish()
         
         print(f"Final text length: {len(text)} characters, {len(text.split())} words")
         
@@ -0,0 +1,267 @@
+'''
+    This file re-analyses every profile written by an older analysis version in resumable batches
+'''
+
+import asyncio
+from contextlib import AsyncExitStack
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal, engine
+from app.models import Book, FunctionWordProfile, ReanalysisJob, StylometricProfile, StylometricTimeline
+from app.services.analysis_cache import analysis_cache
+from app.services.analysis_pool import analysis_pool
+from app.services.book_text_service import load_book_text
+from app.services.corpus_store import text_hash
+from app.services.delta_service import delta_index, pack_frequencies
+from app.services.single_flight import advisory_key, advisory_lock
+from app.services.style_index import style_index
+from app.services.stylometry_service import ANALYSIS_VERSION, FUNCTION_WORDS_VERSION, PROFILE_DTYPE, TIMELINE_WINDOW_WORDS
+from app.services.timeline_service import pack_timeline
+
+#Books re-analysed per transaction and Gutenberg downloads running at once
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_CONCURRENCY = 4
+
+#Jobs running in this process, so a second start request does not run the same job twice
+_active_jobs: Set[UUID] = set()
+
+#Profiles written by any other analysis version, including sampled previews
+def stale_profiles_filter(target_version: str):
+    return or_(StylometricProfile.analysis_version == None, StylometricProfile.analysis_version != target_version)
+
+#Returns the unfinished job for the version so it carries on where it stopped, or starts a new one
+def start_reanalysis(db: Session, target_version: str = ANALYSIS_VERSION) -> ReanalysisJob:
+    job = db.query(ReanalysisJob).filter(
+        ReanalysisJob.target_version == target_version,
+        ReanalysisJob.status == "running"
+    ).order_by(ReanalysisJob.started_at.desc()).first()
+
+    if job is None:
+        job = ReanalysisJob(
+            target_version=target_version,
+            status="running",
+            total=db.query(func.count(StylometricProfile.book_id)).filter(stale_profiles_filter(target_version)).scalar(),
+            processed=0,
+            updated=0,
+            skipped=0,
+            failed=0
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+    return job
+
+def job_progress(job: ReanalysisJob) -> Dict:
+    return {
+        "job_id": str(job.job_id),
+        "target_version": job.target_version,
+        "status": job.status,
+        "total": job.total,
+        "processed": job.processed,
+        "updated": job.updated,
+        "skipped": job.skipped,
+        "failed": job.failed,
+        "error": job.error,
+        "started_at": job.started_at,
+        "updated_at": job.updated_at,
+        "finished_at": job.finished_at
+    }
+
+#Stored texts are read from the corpus store, only books without one are downloaded. Each download has its own
+#session, which only connects for books that still keep their Gutenberg ID in text_file_path
+async def _fetch_text(book: Book, semaphore: asyncio.Semaphore) -> Optional[str]:
+    async with semaphore:
+        db = SessionLocal()
+        try:
+            return await load_book_text(db, book)
+        finally:
+            await asyncio.to_thread(db.close)
+
+#The job's target version, or None when there is no such job
+def _target_version(db: Session, job_id: UUID) -> Optional[str]:
+    job = db.get(ReanalysisJob, job_id)
+    target_version = job.target_version if job is not None else None
+    db.commit()
+    return target_version
+
+#The next books of a running job after its checkpoint, detached so no transaction stays open while their texts
+#are fetched
+def _next_books(db: Session, job_id: UUID, batch_size: int) -> List[Book]:
+    job = db.get(ReanalysisJob, job_id)
+    books = []
+    if job is not None and job.status == "running":
+        query = db.query(Book).join(StylometricProfile, StylometricProfile.book_id == Book.book_id).filter(
+            stale_profiles_filter(job.target_version)
+        )
+        if job.last_book_id is not None:
+            query = query.filter(Book.book_id > job.last_book_id)
+        books = query.order_by(Book.book_id).limit(batch_size).all()
+        for book in books:
+            db.expunge(book)
+    db.commit()
+    return books
+
+def _cached_results(db: Session, keys: Dict[UUID, str], target_version: str) -> Dict[UUID, Tuple]:
+    results = {}
+    for book_id, key in keys.items():
+        cached = analysis_cache.get(db, key, target_version)
+        if cached is not None:
+            results[book_id] = cached
+    db.commit()
+    return results
+
+#Writes every result of a batch, the texts the books were pointed at and the job checkpoint in one transaction.
+#fresh holds the cache keys of the results that were just analysed. Returns the job's progress
+def _write_batch(
+    db: Session,
+    job_id: UUID,
+    books: List[Book],
+    texts: List[Optional[str]],
+    results: Dict[UUID, Tuple],
+    fresh: Dict[UUID, str]
+) -> Dict:
+    job = db.get(ReanalysisJob, job_id)
+    profiles = {
+        profile.book_id: profile
+        for profile in db.query(StylometricProfile).filter(StylometricProfile.book_id.in_([book.book_id for book in books])).all()
+    }
+    cached_keys = set()
+    for book, text in zip(books, texts):
+        #The book or its profile was deleted since the batch was selected, and merging it would add the book again
+        profile = profiles.get(book.book_id)
+        if text is None or profile is None:
+            job.skipped += 1
+            continue
+        #Carries over the text path the download pointed the book at
+        db.merge(book)
+        if book.book_id not in results:
+            job.failed += 1
+            continue
+
+        analysis_results, frequencies, timeline = results[book.book_id]
+        for name in PROFILE_DTYPE.names:
+            setattr(profile, name, analysis_results[name])
+        profile.analysis_version = job.target_version
+        profile.analysed_at = func.now()
+        db.merge(FunctionWordProfile(
+            book_id=book.book_id,
+            frequencies=pack_frequencies(frequencies),
+            vocabulary_version=FUNCTION_WORDS_VERSION
+        ))
+        db.merge(StylometricTimeline(
+            book_id=book.book_id,
+            window_words=TIMELINE_WINDOW_WORDS,
+            windows=len(timeline),
+            metrics=pack_timeline(timeline),
+            analysis_version=job.target_version
+        ))
+        key = fresh.get(book.book_id)
+        if key is not None and key not in cached_keys:
+            cached_keys.add(key)
+            analysis_cache.add(db, key, analysis_results, frequencies, timeline)
+        job.updated += 1
+
+    job.processed += len(books)
+    job.last_book_id = books[-1].book_id
+    db.commit()
+    analysis_cache.evict_if_due(db)
+    return job_progress(job)
+
+#Fetches and analyses one batch, then writes it. The session's work runs in threads so downloads and other
+#requests carry on
+async def _reanalyse_batch(db: Session, job_id: UUID, target_version: str, books: List[Book], semaphore: asyncio.Semaphore) -> Dict:
+    texts = await asyncio.gather(*[_fetch_text(book, semaphore) for book in books])
+    keys = {book.book_id: text_hash(text) for book, text in zip(books, texts) if text is not None}
+
+    #Only the current analysis version is cached
+    results = await asyncio.to_thread(_cached_results, db, keys, target_version) if target_version == ANALYSIS_VERSION else {}
+    pending = [(book.book_id, text) for book, text in zip(books, texts) if text is not None and book.book_id not in results]
+
+    #Every worker of the analysis pool takes one book
+    analysed = await asyncio.gather(
+        *[analysis_pool.analyze_book(text) for _, text in pending],
+        return_exceptions=True
+    )
+    fresh = {}
+    for (book_id, _), result in zip(pending, analysed):
+        if isinstance(result, Exception):
+            print(f"Re-analysis of {book_id} failed: {result}")
+            continue
+        results[book_id] = result
+        if target_version == ANALYSIS_VERSION:
+            fresh[book_id] = keys[book_id]
+
+    progress = await asyncio.to_thread(_write_batch, db, job_id, books, texts, results, fresh)
+
+    #Keeps the in-memory indexes current for this worker, others pick the rows up on their next sync
+    for book_id, (analysis_results, frequencies, _) in results.items():
+        delta_index.add(book_id, frequencies)
+        style_index.add(book_id, analysis_results)
+    return progress
+
+#Marks a running job completed once no books are left, and returns its progress
+def _finish(db: Session, job_id: UUID) -> Dict:
+    job = db.get(ReanalysisJob, job_id)
+    if job.status == "running":
+        job.status = "completed"
+        job.finished_at = func.now()
+        db.commit()
+        db.refresh(job)
+    return job_progress(job)
+
+def _mark_failed(db: Session, job_id: UUID, error: Exception):
+    db.rollback()
+    job = db.get(ReanalysisJob, job_id)
+    if job is not None:
+        job.status = "failed"
+        job.error = str(error)
+        db.commit()
+
+async def run_reanalysis(
+    job_id: UUID,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    concurrency: int = DEFAULT_CONCURRENCY
+) -> Optional[Dict]:
+    """
+    Re-analyses the books whose profile has an older analysis version, in book_id order from the job's
+    last checkpoint. Books with neither a stored text nor a Gutenberg ID are skipped and a new job retries
+    earlier failures. The job's advisory lock is held while it runs, so a worker asked to run a job another
+    worker is running returns None, and the job's queries all use the lock's connection.
+    """
+    if job_id in _active_jobs:
+        print(f"Re-analysis job {job_id} is already running")
+        return None
+    _active_jobs.add(job_id)
+
+    try:
+        async with AsyncExitStack() as stack:
+            try:
+                connection = await stack.enter_async_context(
+                    advisory_lock(engine, advisory_key("reanalysis", str(job_id)), timeout=0)
+                )
+            except TimeoutError:
+                print(f"Re-analysis job {job_id} is already running in another worker")
+                return None
+            db = SessionLocal(bind=connection)
+            stack.callback(db.close)
+
+            try:
+                target_version = await asyncio.to_thread(_target_version, db, job_id)
+                if target_version is None:
+                    return None
+
+                semaphore = asyncio.Semaphore(concurrency)
+                while books := await asyncio.to_thread(_next_books, db, job_id, batch_size):
+                    progress = await _reanalyse_batch(db, job_id, target_version, books, semaphore)
+                    print(f"Re-analysis: {progress['processed']}/{progress['total']} books done, {progress['updated']} updated")
+                return await asyncio.to_thread(_finish, db, job_id)
+            except Exception as e:
+                await asyncio.to_thread(_mark_failed, db, job_id, e)
+                print(f"Re-analysis job {job_id} failed: {e}")
+                raise
+    finally:
+        _active_jobs.discard(job_id)
@@ -0,0 +1,135 @@
+'''
+    This file builds each user's recommendations from the style of the books they rated and stores them in the recommendations table
+'''
+
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import delete, func, insert, or_
+from sqlalchemy.dialects.postgresql import insert as upsert
+from sqlalchemy.orm import Session
+
+from app.models import Rating, Recommendation, RecommendationRun
+from app.services.style_index import SIMILARITY_NAMES, style_index
+
+#Users scored together - each chunk needs users x books x dimensions floats in memory
+DEFAULT_CHUNK_SIZE = 32
+
+#Users whose ratings changed after their recommendations were last generated, or who were never generated
+def stale_user_ids(db: Session) -> List[UUID]:
+    last_rated = db.query(
+        Rating.user_id,
+        func.max(func.coalesce(Rating.updated_at, Rating.rated_at)).label("last_rated")
+    ).group_by(Rating.user_id).subquery()
+
+    rows = db.query(last_rated.c.user_id).outerjoin(
+        RecommendationRun, RecommendationRun.user_id == last_rated.c.user_id
+    ).filter(or_(
+        RecommendationRun.generated_at == None,
+        last_rated.c.last_rated > RecommendationRun.generated_at
+    )).all()
+    return [row.user_id for row in rows]
+
+def all_rating_user_ids(db: Session) -> List[UUID]:
+    return [row.user_id for row in db.query(Rating.user_id).distinct().all()]
+
+def generate_recommendations(
+    db: Session,
+    user_ids: Optional[List[UUID]] = None,
+    top_n: int = 20,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    only_stale: bool = True
+) -> Dict:
+    """
+    Scores every analysed book for each user against a rating-weighted style profile and replaces
+    their top_n recommendations. By default only users whose ratings changed since the last run are done.
+    """
+    started = time.perf_counter()
+
+    style_index.sync(db)
+    book_ids, styles = style_index.matrix()
+    row_of_book = {book_id: row for row, book_id in enumerate(book_ids)}
+
+    if user_ids is None:
+        user_ids = stale_user_ids(db) if only_stale else all_rating_user_ids(db)
+
+    stats = {"users_considered": len(user_ids), "users_updated": 0, "recommendations_written": 0, "books_scored": len(book_ids)}
+    if not user_ids or not book_ids:
+        stats["seconds"] = round(time.perf_counter() - started, 2)
+        return stats
+
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+
+        #Ratings of this chunk of users, keeping only books that have a style profile
+        rated = defaultdict(list)
+        for rating in db.query(Rating.user_id, Rating.book_id, Rating.rating).filter(Rating.user_id.in_(chunk)).all():
+            row = row_of_book.get(rating.book_id)
+            if row is not None:
+                rated[rating.user_id].append((row, float(rating.rating)))
+
+        users = [user_id for user_id in chunk if rated[user_id]]
+        rows = []
+        if users:
+            #Each user's profile is the rating-weighted mean of the style vectors of the books they rated
+            profiles = np.zeros((len(users), styles.shape[1]), dtype=np.float32)
+            for i, user_id in enumerate(users):
+                book_rows = np.array([row for row, _ in rated[user_id]])
+                weights = np.array([rating for _, rating in rated[user_id]], dtype=np.float32)
+                if weights.sum() <= 0:
+                    weights = np.ones_like(weights)
+                profiles[i] = np.average(styles[book_rows], axis=0, weights=weights)
+
+            #users x books x dimensions similarities, then the mean over dimensions as the overall score
+            similarities = 1.0 - np.abs(styles[None, :, :] - profiles[:, None, :])
+            scores = similarities.mean(axis=2)
+
+            #Books the user already rated are never recommended back to them
+            for i, user_id in enumerate(users):
+                scores[i, [row for row, _ in rated[user_id]]] = -np.inf
+
+            k = min(top_n, len(book_ids))
+            best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for i, user_id in enumerate(users):
+                ranked = best[i][np.argsort(-scores[i, best[i]])]
+                for rank, book_row in enumerate(ranked, start=1):
+                    if not np.isfinite(scores[i, book_row]):
+                        break
+                    rows.append({
+                        "user_id": user_id,
+                        "book_id": book_ids[book_row],
+                        "similarity_score": round(float(scores[i, book_row]), 4),
+                        **{name: round(float(value), 4) for name, value in zip(SIMILARITY_NAMES, similarities[i, book_row])},
+                        "rank": rank
+                    })
+
+        #Replaces the chunk's recommendations in one transaction, including users whose rated books have no profile,
+        #and records the run for every user so the ones left without recommendations are not stale
+        written = defaultdict(int)
+        for row in rows:
+            written[row["user_id"]] += 1
+        try:
+            db.execute(delete(Recommendation).where(Recommendation.user_id.in_(chunk)))
+            if rows:
+                db.execute(insert(Recommendation), rows)
+            run = upsert(RecommendationRun).values([
+                {"user_id": user_id, "generated_at": func.now(), "recommendations": written[user_id]} for user_id in chunk
+            ])
+            db.execute(run.on_conflict_do_update(
+                index_elements=[RecommendationRun.user_id],
+                set_={"generated_at": run.excluded.generated_at, "recommendations": run.excluded.recommendations}
+            ))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        stats["users_updated"] += len(users)
+        stats["recommendations_written"] += len(rows)
+        print(f"Recommendations: {min(start + chunk_size, len(user_ids))}/{len(user_ids)} users done")
+
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    return stats
@@ -0,0 +1,105 @@
+'''
+    This file makes concurrent requests for the same book share one download or analysis instead of each doing it
+'''
+
+import asyncio
+import hashlib
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+#How often a worker waiting for another worker's lock checks again, and how long it waits before giving up
+ADVISORY_LOCK_POLL_SECONDS = 0.25
+ADVISORY_LOCK_TIMEOUT = float(os.getenv("ADVISORY_LOCK_TIMEOUT", 600))
+
+class SingleFlight:
+    '''
+        Runs one call per key at a time in this process. Callers that arrive while it is running await the
+        same task and get its result or its exception. The task is shielded, so it still finishes for the
+        others if the caller that started it is cancelled.
+    '''
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.joined = 0
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable]):
+        task = self._calls.get(key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self.joined += 1
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda finished: self._forget(key, finished))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> Dict:
+        return {"in_flight": len(self._calls), "started": self.started, "joined": self.joined}
+
+#Advisory lock keys are 64-bit integers, so the parts are hashed the same way in every worker
+def advisory_key(*parts) -> int:
+    digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+def _try_lock(connection: Connection, key: int) -> bool:
+    locked = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": key}).scalar()
+    #Session locks outlive the transaction, which is ended so a Session bound to the connection starts its own
+    connection.commit()
+    return locked
+
+def _unlock(connection: Connection, key: int):
+    connection.rollback()
+    connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+    connection.commit()
+
+@asynccontextmanager
+async def advisory_lock(engine: Engine, key: int, timeout: float = ADVISORY_LOCK_TIMEOUT) -> AsyncIterator[Connection]:
+    """
+    Holds a PostgreSQL session advisory lock so only one worker runs the block for the key at a time, and
+    yields the connection holding it. A Session bound to that connection keeps it across commits, so the
+    block needs no other connection. Anything the block leaves uncommitted is rolled back.
+    Connecting, polling pg_try_advisory_lock and unlocking run in threads so the event loop is not blocked.
+    Raises TimeoutError when the lock is not free within timeout seconds, a timeout of 0 tries once.
+    Other databases have no advisory locks and only get the in-process SingleFlight.
+    """
+    connection = await asyncio.to_thread(engine.connect)
+    if engine.dialect.name != "postgresql":
+        try:
+            yield connection
+        finally:
+            await asyncio.to_thread(connection.close)
+        return
+
+    unlocked = False
+    try:
+        deadline = time.monotonic() + timeout
+        while not await asyncio.to_thread(_try_lock, connection, key):
+            if time.monotonic() >= deadline:
+                unlocked = True
+                raise TimeoutError(f"Timed out waiting for advisory lock {key}")
+            await asyncio.sleep(ADVISORY_LOCK_POLL_SECONDS)
+
+        try:
+            yield connection
+        finally:
+            await asyncio.to_thread(_unlock, connection, key)
+            unlocked = True
+    finally:
+        #Cancelled while locking or unlocking, so the lock may still be held. Closing the connection for good
+        #releases it instead of handing it back to the pool with the lock
+        if not unlocked:
+            connection.invalidate()
+        await asyncio.to_thread(connection.close)
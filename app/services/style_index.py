@@ -0,0 +1,213 @@
+'''
+    This file keeps every stylometric profile in memory so the most similar books can be found in a few milliseconds
+'''
+
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models import StylometricProfile
+
+#Profile columns used for similarity, in the order they are stored in the matrix
+STYLE_DIMENSIONS = ("pacing_score", "tone_score", "vocabulary_richness", "avg_sentence_length")
+
+#Names of the per-dimension similarities, matching the columns of the recommendations table
+SIMILARITY_NAMES = ("pacing_similarity", "tone_similarity", "vocabulary_similarity", "sentence_length_similarity")
+
+#Rows committed by other workers can carry a slightly older timestamp than our last sync, so look back a bit
+SYNC_OVERLAP = timedelta(seconds=60)
+
+#Seconds between the counts that find profiles deleted by other workers. Counting the table on every sync
+#would slow every lookup, and this worker's own deletions are removed at once
+RECOUNT_INTERVAL = 60.0
+
+#Reads the style dimensions of a profile or an analysis result dict into a vector
+def style_vector(values) -> np.ndarray:
+    get = values.get if isinstance(values, dict) else lambda name: getattr(values, name)
+    return np.array([float(get(name) or 0) for name in STYLE_DIMENSIONS], dtype=np.float32)
+
+class StyleIndex:
+    '''
+        Holds the style dimensions of every analysed book in a float32 matrix scaled to 0-1 per dimension,
+        so the similarity on a dimension is one minus the absolute difference and the overall score is their mean.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._raw = np.zeros((1024, len(STYLE_DIMENSIONS)), dtype=np.float32)
+        self._size = 0
+        self._book_ids: List[UUID] = []
+        self._rows: Dict[UUID, int] = {}
+        self._normalized: Optional[np.ndarray] = None
+        self._low = np.zeros(len(STYLE_DIMENSIONS), dtype=np.float32)
+        self._high = np.zeros(len(STYLE_DIMENSIONS), dtype=np.float32)
+        self._scale = np.zeros(len(STYLE_DIMENSIONS), dtype=np.float32)
+        self._last_sync: Optional[datetime] = None
+        self._recounted_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, book_id: UUID, values):
+        with self._lock:
+            self._add_rows([book_id], style_vector(values).reshape(1, -1))
+
+    def add_many(self, book_ids: List[UUID], vectors: np.ndarray):
+        with self._lock:
+            self._add_rows(book_ids, np.asarray(vectors, dtype=np.float32).reshape(len(book_ids), -1))
+
+    def _add_rows(self, book_ids: List[UUID], vectors: np.ndarray):
+        rescale = False
+        for book_id, vector in zip(book_ids, vectors):
+            row = self._rows.get(book_id)
+            if row is not None and self._normalized is not None:
+                #A re-analysed book that set the lowest or highest value may leave the range narrower
+                old = self._raw[row]
+                rescale = rescale or bool(np.any((old == self._low) | (old == self._high)) and np.any(old != vector))
+            if row is None:
+                #Grow the matrix by doubling so adding books stays cheap
+                if self._size == len(self._raw):
+                    grown = np.zeros((len(self._raw) * 2, len(STYLE_DIMENSIONS)), dtype=np.float32)
+                    grown[:self._size] = self._raw[:self._size]
+                    self._raw = grown
+                row = self._size
+                self._size += 1
+                self._book_ids.append(book_id)
+                self._rows[book_id] = row
+            self._raw[row] = vector
+
+        if self._normalized is None:
+            return
+
+        #New books inside the current range are scaled in place, anything outside it forces a rescale
+        if not rescale and np.all(vectors >= self._low) and np.all(vectors <= self._high):
+            if len(self._normalized) < len(self._raw):
+                grown = np.zeros_like(self._raw)
+                grown[:len(self._normalized)] = self._normalized
+                self._normalized = grown
+            for book_id in book_ids:
+                row = self._rows[book_id]
+                self._normalized[row] = (self._raw[row] - self._low) * self._scale
+        else:
+            self._normalized = None
+
+    #Takes a deleted book out of the index, moving the last row into its place
+    def remove(self, book_id: UUID):
+        with self._lock:
+            row = self._rows.pop(book_id, None)
+            if row is None:
+                return
+            old = self._raw[row].copy()
+            last = self._size - 1
+            if row != last:
+                moved = self._book_ids[last]
+                self._raw[row] = self._raw[last]
+                self._book_ids[row] = moved
+                self._rows[moved] = row
+                if self._normalized is not None:
+                    self._normalized[row] = self._normalized[last]
+            self._book_ids.pop()
+            self._size = last
+
+            #A book that set the lowest or highest value may leave the range narrower
+            if self._normalized is not None and np.any((old == self._low) | (old == self._high)):
+                self._normalized = None
+
+    def _normalized_matrix(self) -> np.ndarray:
+        if self._size == 0:
+            return self._raw[:0]
+        if self._normalized is None:
+            raw = self._raw[:self._size]
+            self._low = raw.min(axis=0)
+            self._high = raw.max(axis=0)
+            spread = self._high - self._low
+            #Dimensions where every book is the same contribute full similarity
+            self._scale = np.divide(1.0, spread, out=np.zeros_like(spread), where=spread > 0)
+            self._normalized = np.zeros_like(self._raw)
+            self._normalized[:self._size] = (raw - self._low) * self._scale
+        return self._normalized[:self._size]
+
+    def similar(self, book_id: UUID, limit: int = 10) -> Optional[List[Tuple[UUID, float, Dict[str, float]]]]:
+        """Most similar books as (book_id, overall score, per-dimension similarities), or None if the book is unknown"""
+        with self._lock:
+            row = self._rows.get(book_id)
+            if row is None:
+                return None
+            if self._size < 2 or limit < 1:
+                return []
+
+            normalized = self._normalized_matrix()
+            similarities = 1.0 - np.abs(normalized - normalized[row])
+            scores = similarities.mean(axis=1)
+            scores[row] = -np.inf
+
+            k = min(limit, self._size - 1)
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [
+                (self._book_ids[i], float(scores[i]), dict(zip(SIMILARITY_NAMES, similarities[i].tolist())))
+                for i in best
+            ]
+
+    def matrix(self) -> Tuple[List[UUID], np.ndarray]:
+        """Book ids with their 0-1 scaled style vectors, for scoring many books at once"""
+        with self._lock:
+            return list(self._book_ids), self._normalized_matrix().copy()
+
+    #Replaces every row, which drops the books whose profile is gone
+    def _replace(self, book_ids: List[UUID], vectors: np.ndarray):
+        with self._lock:
+            self._raw = np.zeros((max(1024, len(book_ids)), len(STYLE_DIMENSIONS)), dtype=np.float32)
+            self._size = 0
+            self._book_ids = []
+            self._rows = {}
+            self._normalized = None
+            if book_ids:
+                self._add_rows(book_ids, np.asarray(vectors, dtype=np.float32).reshape(len(book_ids), -1))
+
+    def _track_sync(self, rows):
+        latest = max((row.analysed_at for row in rows if row.analysed_at is not None), default=None)
+        if latest is not None and (self._last_sync is None or latest > self._last_sync):
+            self._last_sync = latest
+
+    #Loads profiles written since the last sync, including ones committed by other workers. Deleted profiles
+    #never turn up in a sync, so every RECOUNT_INTERVAL seconds the profiles are counted, and when the table
+    #holds a different number than the index, the index is loaded again whole
+    def sync(self, db: Session):
+        columns = [
+            StylometricProfile.book_id,
+            StylometricProfile.analysed_at,
+            *[getattr(StylometricProfile, name) for name in STYLE_DIMENSIONS]
+        ]
+        query = db.query(*columns)
+        now = time.monotonic()
+        if self._last_sync is not None:
+            query = query.filter(StylometricProfile.analysed_at >= self._last_sync - SYNC_OVERLAP)
+        else:
+            #Every profile is read, so there is nothing to count
+            self._recounted_at = now
+
+        rows = query.all()
+        if rows:
+            self.add_many([row.book_id for row in rows], np.stack([style_vector(row) for row in rows]))
+            self._track_sync(rows)
+
+        if self._recounted_at is not None and now - self._recounted_at < RECOUNT_INTERVAL:
+            return
+        self._recounted_at = now
+        if db.query(func.count(StylometricProfile.book_id)).scalar() != self._size:
+            rows = db.query(*columns).all()
+            self._replace(
+                [row.book_id for row in rows],
+                np.stack([style_vector(row) for row in rows]) if rows else np.zeros((0, len(STYLE_DIMENSIONS)))
+            )
+            self._track_sync(rows)
+
+#Create singleton instance
+style_index = StyleIndex()
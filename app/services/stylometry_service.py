@@ -2,54 +2,149 @@
     This file uses stylometry to analyse the writing style of book texts
 '''
 
-from faststylometry import load_corpus_from_folder, calculate_burrows_delta
+from faststylometry import tokenise_remove_pronouns_en
+from collections import Counter
+import math
+import numpy as np
 import os
-from typing import Dict, Optional
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 import re
 
+#Bump this whenever the metric formulas change so older profiles can be found and re-analysed
+ANALYSIS_VERSION = "1.0"
+
+#Profiles estimated from a sample of the text have this added to their analysis_version
+SAMPLED_VERSION_SUFFIX = "-sampled"
+
+def is_sampled_version(version: Optional[str]) -> bool:
+    return bool(version) and version.endswith(SAMPLED_VERSION_SUFFIX)
+
+#A sentence end followed by whitespace, so sampled windows never cut a word like "e.g." in half
+_TERMINATOR_RE = re.compile(r'[.!?]+\s')
+_WHITESPACE_RE = re.compile(r'\s')
+
+#Function words used for Burrows' Delta - pronouns are left out because faststylometry's tokeniser removes them
+FUNCTION_WORDS = (
+    "the", "of", "and", "to", "a", "in", "that", "was", "it", "is", "for", "as", "with", "be", "at",
+    "not", "on", "by", "had", "this", "but", "all", "from", "have", "so", "were", "which", "or", "no",
+    "one", "an", "there", "been", "would", "if", "are", "when", "what", "said", "who", "will", "could",
+    "into", "more", "then", "out", "up", "do", "very", "now", "some", "than", "upon", "only", "any",
+    "can", "did", "like", "such", "before", "should", "little", "about", "must", "made", "well",
+    "over", "after", "much", "never", "how", "may", "where", "own", "again", "yet", "just", "though",
+    "might", "too", "down", "here", "those", "through", "every", "even", "these", "being", "most",
+    "without", "other", "shall", "has", "am", "while", "because", "against", "until", "both", "why",
+)
+
+#Bump this whenever FUNCTION_WORDS changes so stored vectors from the old list are not mixed in
+FUNCTION_WORDS_VERSION = "1"
+
+#Metrics of each window in a book's timeline, in the order of the columns of the packed array
+TIMELINE_METRICS = ("pacing_score", "avg_sentence_length", "dialogue_percentage", "punctuation_density")
+
+#Words per timeline window, about four pages of a novel
+TIMELINE_WINDOW_WORDS = 1000
+
+#One record per book from analyze_many - the float fields are rounded the same way as analyze_text
+PROFILE_DTYPE = np.dtype([
+    ("pacing_score", np.float64),
+    ("tone_score", np.float64),
+    ("vocabulary_richness", np.float64),
+    ("avg_sentence_length", np.float64),
+    ("avg_word_length", np.float64),
+    ("lexical_diversity", np.float64),
+    ("punctuation_density", np.float64),
+    ("dialogue_percentage", np.float64),
+    ("total_words", np.int64),
+    ("total_sentences", np.int64),
+    ("unique_words", np.int64),
+])
+
 class StylometryAnalyzer:
-    
+
     def analyze_text(self, text: str) -> Dict[str, float]:
         if not text or len(text.strip()) == 0:
             raise ValueError("Text cannot be empty")
-        
-        #Splits text into words and sentences
+
+        return self._analyze_words(text, text.split())
+
+    def analyze_with_timeline(self, text: str, window_words: int = TIMELINE_WINDOW_WORDS) -> Tuple[Dict[str, float], np.ndarray]:
+        """The analyze_text metrics together with the timeline, splitting the text into words once for both"""
+        if not text or len(text.strip()) == 0:
+            raise ValueError("Text cannot be empty")
+
         words = text.split()
-        sentences = self._split_sentences(text)
-        
+        return self._analyze_words(text, words), self._timeline(words, window_words)
+
+    def timeline(self, text: str, window_words: int = TIMELINE_WINDOW_WORDS) -> np.ndarray:
+        """TIMELINE_METRICS for every window of window_words words, as a float32 array with one row per window"""
+        return self._timeline(text.split(), window_words)
+
+    def _timeline(self, words: List[str], window_words: int) -> np.ndarray:
+        #A short last window is only kept when it has at least half a window of words
+        n_windows = max(1, len(words) // window_words + (len(words) % window_words >= window_words // 2))
+        timeline = np.zeros((n_windows, len(TIMELINE_METRICS)), dtype=np.float32)
+        for i in range(n_windows):
+            window = words[i * window_words:(i + 1) * window_words if i < n_windows - 1 else len(words)]
+            if not window:
+                continue
+            joined = ' '.join(window)
+            lengths = self._sentence_lengths(window)
+
+            #Same formulas as analyze_text, with sentences cut at the window edges
+            mean_length = len(window) / len(lengths) if lengths else 0
+            if len(lengths) > 1:
+                avg_len = sum(lengths) / len(lengths)
+                pacing = min(100, sum((x - avg_len) ** 2 for x in lengths) / len(lengths))
+            else:
+                pacing = 50.0
+            punctuation = sum(joined.count(mark) for mark in '.!?,;:')
+            dialogue = min(100, (joined.count('"') + joined.count("'")) / len(joined) * 200)
+            timeline[i] = (pacing, mean_length, dialogue, punctuation / len(window))
+        return timeline
+
+    #The analyze_text metrics from the text and its words
+    def _analyze_words(self, text: str, words: List[str]) -> Dict[str, float]:
+        #Gets the word count of every sentence
+        sentence_lengths = self._sentence_lengths(words)
+
         #Calculates the basic statistics
         total_words = len(words)
-        total_sentences = len(sentences)
-        unique_words = len(set(word.lower() for word in words))
-        
+        total_sentences = len(sentence_lengths)
+        unique_words = len(set(map(str.lower, words)))
+
         #Calculate the metrics
         avg_sentence_length = total_words / total_sentences if total_sentences > 0 else 0
-        avg_word_length = sum(len(word) for word in words) / total_words if total_words > 0 else 0
+        avg_word_length = sum(map(len, words)) / total_words if total_words > 0 else 0
         lexical_diversity = unique_words / total_words if total_words > 0 else 0
-        
+
         #Calculate the pacing score (based on sentence length variation)
         if total_sentences > 1:
-            sentence_lengths = [len(s.split()) for s in sentences]
-            avg_len = sum(sentence_lengths) / len(sentence_lengths)
-            variance = sum((x - avg_len) ** 2 for x in sentence_lengths) / len(sentence_lengths)
+            avg_len = sum(sentence_lengths) / total_sentences
+            variance = sum((x - avg_len) ** 2 for x in sentence_lengths) / total_sentences
             pacing_score = min(100, variance)  #This is normalised from 0-100
         else:
             pacing_score = 50.0
-        
+
+        #Counts each punctuation character once - str.count runs in C so this avoids looping per character
+        full_stops = text.count('.')
+        exclamations = text.count('!')
+        questions = text.count('?')
+        clause_marks = text.count(',') + text.count(';') + text.count(':')
+
         #Calculate the tone score (placeholder - can be enhanced with sentiment analysis)
-        punctuation_count = sum(1 for char in text if char in '!?.')
+        punctuation_count = full_stops + exclamations + questions
         tone_score = min(100, (punctuation_count / total_sentences) * 10) if total_sentences > 0 else 50.0
-        
+
         #Calculates the vocabulary richness (lexical diversity scaled to 0-100)
         vocabulary_richness = lexical_diversity * 100
-        
+
         #Calculates the dialogue percentage (this is a rough estimate)
         dialogue_chars = text.count('"') + text.count("'")
         dialogue_percentage = min(100, (dialogue_chars / len(text)) * 200) if len(text) > 0 else 0
-        
+
         #Calculates the punctuation density
-        punctuation_density = sum(1 for char in text if char in ',.!?;:') / total_words if total_words > 0 else 0
-        
+        punctuation_density = (punctuation_count + clause_marks) / total_words if total_words > 0 else 0
+
         return {
             "pacing_score": round(pacing_score, 2),
             "tone_score": round(tone_score, 2),
@@ -61,16 +156,212 @@ class StylometryAnalyzer:
             "dialogue_percentage": round(dialogue_percentage, 2),
             "total_words": total_words,
             "total_sentences": total_sentences,
-            "unique_words": unique_words,
-            "start": words
+            "unique_words": unique_words
+        }
+
+    def analyze_many(self, texts: Iterable[str]) -> np.ndarray:
+        """Analyse many texts at once and return a PROFILE_DTYPE structured array with one record per text"""
+        texts = list(texts)
+        n = len(texts)
 
+        #Raw counts per text: words, sentences, unique words, letters, terminators, clause marks, quotes, characters
+        counts = np.zeros((n, 8), dtype=np.int64)
+        sentence_lengths = []
+        for i, text in enumerate(texts):
+            if not text or len(text.strip()) == 0:
+                raise ValueError(f"Text {i} cannot be empty")
+
+            words = text.split()
+            lengths = self._sentence_lengths(words)
+            sentence_lengths.append(lengths)
+            counts[i] = (
+                len(words),
+                len(lengths),
+                len(set(map(str.lower, words))),
+                sum(map(len, words)),
+                text.count('.') + text.count('!') + text.count('?'),
+                text.count(',') + text.count(';') + text.count(':'),
+                text.count('"') + text.count("'"),
+                len(text),
+            )
+
+        total_words, total_sentences, unique_words, letters, terminators, clause_marks, quotes, chars = counts.T.astype(np.float64)
+
+        #Every sentence length of every book in one flat array, tagged with the index of its book
+        flat_lengths = np.fromiter((x for lengths in sentence_lengths for x in lengths), dtype=np.float64, count=int(total_sentences.sum()))
+        book_index = np.repeat(np.arange(n), counts[:, 1])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            #Per-book variance of sentence lengths - bincount sums in order so this matches analyze_text exactly
+            mean_lengths = np.bincount(book_index, weights=flat_lengths, minlength=n) / total_sentences
+            deviations = flat_lengths - mean_lengths[book_index]
+            variance = np.bincount(book_index, weights=deviations ** 2, minlength=n) / total_sentences
+
+            lexical_diversity = np.where(total_words > 0, unique_words / total_words, 0.0)
+
+            results = np.zeros(n, dtype=PROFILE_DTYPE)
+            results["pacing_score"] = np.round(np.where(total_sentences > 1, np.minimum(100, variance), 50.0), 2)
+            results["tone_score"] = np.round(np.where(total_sentences > 0, np.minimum(100, (terminators / total_sentences) * 10), 50.0), 2)
+            results["vocabulary_richness"] = np.round(lexical_diversity * 100, 2)
+            results["avg_sentence_length"] = np.round(np.where(total_sentences > 0, total_words / total_sentences, 0.0), 2)
+            results["avg_word_length"] = np.round(np.where(total_words > 0, letters / total_words, 0.0), 2)
+            results["lexical_diversity"] = np.round(lexical_diversity, 4)
+            results["punctuation_density"] = np.round(np.where(total_words > 0, (terminators + clause_marks) / total_words, 0.0), 4)
+            results["dialogue_percentage"] = np.round(np.where(chars > 0, np.minimum(100, (quotes / chars) * 200), 0.0), 2)
+
+        results["total_words"] = counts[:, 0]
+        results["total_sentences"] = counts[:, 1]
+        results["unique_words"] = counts[:, 2]
+        return results
+
+    def analyze_sample(
+        self,
+        text: str,
+        sample_rate: float = 0.05,
+        window_chars: int = 2000,
+        min_windows: int = 20,
+        bootstrap_rounds: int = 200,
+        seed: Optional[int] = None
+    ) -> Tuple[Dict[str, float], Dict[str, List[float]]]:
+        """
+        Estimates the analyze_text metrics from sentence-aligned windows spread evenly through the text and
+        covering about sample_rate of it. Returns the estimates and their 95% bootstrap confidence intervals
+        (bounds for the vocabulary metrics). Texts too short to be worth sampling are analysed exactly.
+        """
+        if not text or len(text.strip()) == 0:
+            raise ValueError("Text cannot be empty")
+
+        n_windows = max(min_windows, math.ceil(len(text) * sample_rate / window_chars))
+        stratum = len(text) // n_windows
+        if stratum < window_chars * 2:
+            exact = self.analyze_text(text)
+            return exact, {name: [exact[name], exact[name]] for name in PROFILE_DTYPE.names}
+
+        #One window at a random offset inside each equal slice of the book, so every part of it is represented
+        rng = np.random.default_rng(seed)
+        counts = []
+        word_sets = []
+        for i in range(n_windows):
+            start = i * stratum + int(rng.integers(0, stratum - window_chars))
+            window = self._sentence_window(text, start, window_chars)
+            words = window.split()
+            if not words:
+                continue
+            lengths = self._sentence_lengths(words)
+            counts.append((
+                len(words),
+                len(lengths),
+                sum(length * length for length in lengths),
+                sum(map(len, words)),
+                window.count('.') + window.count('!') + window.count('?'),
+                window.count(',') + window.count(';') + window.count(':'),
+                window.count('"') + window.count("'"),
+                len(window),
+            ))
+            word_sets.append(set(map(str.lower, words)))
+
+        counts = np.array(counts, dtype=np.float64)
+        point = self._sample_estimates(counts.sum(axis=0, keepdims=True), len(text))
+
+        #Bootstrap over windows - every round is a resample of the windows with replacement
+        resamples = rng.integers(0, len(counts), size=(bootstrap_rounds, len(counts)))
+        rounds = self._sample_estimates(counts[resamples].sum(axis=1), len(text))
+
+        estimates = {}
+        intervals = {}
+        for name, values in point.items():
+            low, high = np.percentile(rounds[name], [2.5, 97.5])
+            estimates[name] = self._round_metric(name, values[0])
+            intervals[name] = [self._round_metric(name, low), self._round_metric(name, high)]
+
+        #Unique words do not add up across windows, so the whole-book vocabulary is extrapolated with Heaps' law.
+        #Vocabulary grows more slowly as a book goes on, so it lies between what the sample saw and that scaled
+        #up linearly - that range is returned instead of a bootstrap interval
+        total_words = point["total_words"][0]
+        seen = len(set().union(*word_sets))
+        ceiling = min(total_words, seen * total_words / counts[:, 0].sum())
+        unique_words = min(ceiling, max(seen, self._heaps_unique_words(word_sets, counts[:, 0], rng.permutation(len(word_sets)), total_words)))
+        for name, scale in (("unique_words", 1), ("lexical_diversity", 1 / total_words), ("vocabulary_richness", 100 / total_words)):
+            estimates[name] = self._round_metric(name, unique_words * scale)
+            intervals[name] = [self._round_metric(name, seen * scale), self._round_metric(name, ceiling * scale)]
+
+        return {name: estimates[name] for name in PROFILE_DTYPE.names}, {name: intervals[name] for name in PROFILE_DTYPE.names}
+
+    def _sentence_window(self, text: str, start: int, size: int) -> str:
+        """About size characters from start, moved to begin after a sentence end and stop at one, or at least at word breaks"""
+        first_end = _TERMINATOR_RE.search(text, start, start + size) or _WHITESPACE_RE.search(text, start, start + size)
+        if first_end:
+            start = first_end.end()
+        last_end = _TERMINATOR_RE.search(text, start + size, start + 2 * size) or _WHITESPACE_RE.search(text, start + size)
+        end = last_end.end() if last_end else len(text)
+        return text[start:end]
+
+    def _sample_estimates(self, sums: np.ndarray, text_chars: int) -> Dict[str, np.ndarray]:
+        """Whole-book metrics from summed window counts, one row per sample"""
+        words, sentences, squares, letters, terminators, clause_marks, quotes, chars = sums.T
+        sentences = np.maximum(sentences, 1)
+        mean_length = words / sentences
+
+        total_words = words / chars * text_chars
+        return {
+            "total_words": total_words,
+            "total_sentences": total_words / mean_length,
+            "avg_sentence_length": mean_length,
+            "avg_word_length": letters / words,
+            "pacing_score": np.minimum(100, squares / sentences - mean_length ** 2),
+            "tone_score": np.minimum(100, (terminators / sentences) * 10),
+            "punctuation_density": (terminators + clause_marks) / words,
+            "dialogue_percentage": np.minimum(100, (quotes / chars) * 200),
         }
-    
-    def _split_sentences(self, text: str) -> list:
-        """Split text into sentences"""
-        #Simple sentence splitting
-        sentences = re.split(r'[.!?]+', text)
-        return [s.strip() for s in sentences if s.strip()]
+
+    def _heaps_unique_words(self, word_sets: List[set], word_counts: np.ndarray, order: np.ndarray, total_words: float) -> float:
+        """Extrapolates the vocabulary of the whole book from how fast it grows as more windows are added"""
+        #Vocabulary size after each quarter of the windows, then a log-log fit of Heaps' law V = K * n^beta
+        seen = set()
+        points = []
+        checkpoints = {max(1, round(len(order) * fraction)) for fraction in (0.25, 0.5, 0.75, 1.0)}
+        words = 0.0
+        for position, i in enumerate(order, start=1):
+            seen |= word_sets[i]
+            words += word_counts[i]
+            if position in checkpoints:
+                points.append((math.log(words), math.log(len(seen))))
+
+        if len(points) > 1:
+            beta = float(np.polyfit([x for x, _ in points], [y for _, y in points], 1)[0])
+        else:
+            beta = 1.0
+        beta = min(1.0, max(0.0, beta))
+        return min(total_words, len(seen) * (total_words / words) ** beta)
+
+    def _round_metric(self, name: str, value: float):
+        if PROFILE_DTYPE[name].kind == 'i':
+            return int(round(value))
+        return round(float(value), 4 if name in ("lexical_diversity", "punctuation_density") else 2)
+
+    def function_word_frequencies(self, text: str) -> np.ndarray:
+        """Relative frequency of every FUNCTION_WORDS entry in the text, as float32 for Burrows' Delta"""
+        tokens = tokenise_remove_pronouns_en(text)
+        counts = Counter(tokens)
+        total = len(tokens) or 1
+        return np.array([counts[word] for word in FUNCTION_WORDS], dtype=np.float32) / np.float32(total)
+
+    def _sentence_lengths(self, words: List[str]) -> List[int]:
+        """Word count of every non-empty sentence, reusing the word split instead of splitting each sentence again"""
+        #Rejoining the words leaves exactly one space between them, so once the text is cut at
+        #every terminator the number of words in a piece is its number of spaces plus one
+        joined = ' '.join(words).replace('!', '.').replace('?', '.')
+        return [sentence.count(' ') + 1 for sentence in map(str.strip, joined.split('.')) if sentence]
+
+#Turns analyze_many results into rows that can be bulk inserted into stylometric_profiles
+def to_profile_rows(book_ids: Sequence, results: np.ndarray, analysis_version: str = ANALYSIS_VERSION) -> List[Dict]:
+    rows = []
+    for book_id, record in zip(book_ids, results.tolist()):
+        row = dict(zip(PROFILE_DTYPE.names, record))
+        row["book_id"] = book_id
+        row["analysis_version"] = analysis_version
+        rows.append(row)
+    return rows
 
 #Creates singleton instance
-stylometry_analyzer = StylometryAnalyzer()
\ No newline at end of file
+stylometry_analyzer = StylometryAnalyzer()
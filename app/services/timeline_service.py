@@ -0,0 +1,22 @@
+'''
+    This file packs the per-window timeline of a book for storage and downsamples it for the timeline endpoint
+'''
+
+import numpy as np
+
+from app.services.stylometry_service import TIMELINE_METRICS
+
+#Converts a windows x metrics timeline to the bytes stored in stylometric_timelines and back
+def pack_timeline(timeline: np.ndarray) -> bytes:
+    return np.asarray(timeline, dtype="<f4").tobytes()
+
+def unpack_timeline(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype="<f4").reshape(-1, len(TIMELINE_METRICS))
+
+#Averages runs of neighbouring windows so the timeline has at most points rows, each run differs by at most one window
+def downsample_timeline(timeline: np.ndarray, points: int) -> np.ndarray:
+    if len(timeline) <= points:
+        return timeline
+    starts = np.linspace(0, len(timeline), points, endpoint=False).astype(np.int64)
+    sizes = np.diff(np.append(starts, len(timeline)))
+    return np.add.reduceat(timeline.astype(np.float64), starts, axis=0) / sizes[:, None]
@@ -0,0 +1,255 @@
+'''
+    This file controls the requests sent to gutendex.com and gutenberg.org, with a rate limit per host, backoff when
+    they throttle us and a circuit breaker that fails fast while a host is down
+'''
+
+import asyncio
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+#Requests per second to one host, and how many can go at once after a quiet spell
+RATE_PER_SECOND = float(os.getenv("UPSTREAM_RATE_PER_SECOND", 5))
+BURST = int(os.getenv("UPSTREAM_BURST", 10))
+
+#Retries of a throttled or failed request, waiting a random time up to BACKOFF_BASE * 2^attempt seconds
+MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 3))
+BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", 0.5))
+BACKOFF_MAX = 30.0
+
+#Longest Retry-After that is obeyed, a longer one is cut to this
+MAX_RETRY_AFTER = 120.0
+
+#Failures in a row that open the breaker, and how long it stays open before one trial request is let through
+BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", 30))
+
+#Responses that mean the host is throttling us, and the ones worth retrying
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    pass
+
+#Full jitter, so clients that failed together do not retry together
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+#Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date
+def retry_after_seconds(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - (now if now is not None else time.time())
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+class TokenBucket:
+
+    def __init__(self, rate: float = RATE_PER_SECOND, burst: int = BURST, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self.throttled = 0
+
+    #Takes a token and returns how long to wait for it. Tokens can go negative, which queues callers in order
+    def reserve(self) -> float:
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            self.throttled += 1
+            await asyncio.sleep(wait)
+
+class CircuitBreaker:
+    '''
+        Closed lets every request through. After failure_threshold failures in a row it opens and rejects them,
+        then after reset_timeout seconds it is half open and lets one trial through, which closes or reopens it.
+    '''
+
+    def __init__(
+        self,
+        failure_threshold: int = BREAKER_FAILURES,
+        reset_timeout: float = BREAKER_RESET_SECONDS,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if self._clock() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._trial_running = False
+        if self.state == "half_open":
+            if self._trial_running:
+                return False
+            self._trial_running = True
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self._opened_at = self._clock()
+            self._trial_running = False
+
+    #Lets another trial through when one ends without an outcome, like a cancelled request
+    def release_trial(self):
+        self._trial_running = False
+
+class HostGuard:
+
+    def __init__(self, host: str, bucket: TokenBucket, breaker: CircuitBreaker):
+        self.host = host
+        self.bucket = bucket
+        self.breaker = breaker
+        self._paused_until = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.throttled_responses = 0
+        self.rejected = 0
+
+    #Fails fast while the breaker is open, otherwise waits out a Retry-After pause and the rate limit
+    async def before_request(self):
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise CircuitOpenError(f"{self.host} is failing, requests are paused")
+        try:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.bucket.acquire()
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+        self.requests += 1
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict:
+        return {
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "times_opened": self.breaker.opened,
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled_responses": self.throttled_responses,
+            "rate_limited": self.bucket.throttled,
+            "rejected": self.rejected
+        }
+
+class UpstreamGuard:
+    '''
+        Sends requests through a HostGuard per host. Network errors and 429 or 5xx responses count as failures
+        and are retried with backoff, any other response counts as a success.
+    '''
+
+    def __init__(
+        self,
+        rate: float = RATE_PER_SECOND,
+        burst: int = BURST,
+        max_retries: int = MAX_RETRIES,
+        backoff_base: float = BACKOFF_BASE,
+        failure_threshold: int = BREAKER_FAILURES,
+        reset_timeout: float = BREAKER_RESET_SECONDS
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._hosts: Dict[str, HostGuard] = {}
+
+    def host(self, url: str) -> HostGuard:
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = HostGuard(
+                host,
+                TokenBucket(self.rate, self.burst),
+                CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            )
+        return self._hosts[host]
+
+    async def send(
+        self,
+        url: str,
+        send: Callable[[], Awaitable[httpx.Response]],
+        discard: Optional[Callable[[httpx.Response], Awaitable]] = None
+    ) -> httpx.Response:
+        """
+        Calls send until it gives a response that is not retried or the retries run out, and returns the last
+        response. A response that is retried is passed to discard, which closes it by default.
+        Raises CircuitOpenError while the host's breaker is open. A request cancelled while it is the half open
+        breaker's trial gives the trial back, so the next request tries instead.
+        """
+        guard = self.host(url)
+        for attempt in range(self.max_retries + 1):
+            await guard.before_request()
+            try:
+                response = await send()
+            except httpx.TransportError:
+                guard.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise
+                guard.retries += 1
+                await asyncio.sleep(backoff_delay(attempt, self.backoff_base))
+                continue
+            except BaseException:
+                #Cancelled or failed some other way, which says nothing about the host
+                guard.breaker.release_trial()
+                raise
+
+            if response.status_code not in RETRY_STATUSES:
+                guard.breaker.record_success()
+                return response
+
+            guard.breaker.record_failure()
+            delay = backoff_delay(attempt, self.backoff_base)
+            if response.status_code in THROTTLE_STATUSES:
+                guard.throttled_responses += 1
+                retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    delay = retry_after
+                    guard.pause(retry_after)
+            if attempt == self.max_retries:
+                return response
+
+            guard.retries += 1
+            await (discard(response) if discard else response.aclose())
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict:
+        return {host: guard.stats() for host, guard in self._hosts.items()}
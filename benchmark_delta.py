@@ -0,0 +1,66 @@
+"""
+Benchmark the Burrows' Delta index for corpora of 1k to 50k books.
+
+Usage: python benchmark_delta.py [corpus sizes ...]
+Vectors are synthetic (Dirichlet-distributed word frequencies), so no database or downloads are needed.
+"""
+
+import sys
+import time
+import uuid
+
+import numpy as np
+
+from app.services.delta_service import DeltaIndex
+from app.services.stylometry_service import FUNCTION_WORDS
+
+
+def synthetic_frequencies(n_books, seed=0):
+    rng = np.random.default_rng(seed)
+    #Roughly Zipfian base profile with per-book noise, scaled so each row looks like relative frequencies
+    base = 1.0 / np.arange(1, len(FUNCTION_WORDS) + 1)
+    return (rng.dirichlet(base * 50, size=n_books) * 0.5).astype(np.float32)
+
+
+def benchmark(n_books, queries=200):
+    book_ids = [uuid.uuid4() for _ in range(n_books)]
+    frequencies = synthetic_frequencies(n_books)
+
+    index = DeltaIndex()
+    start = time.perf_counter()
+    index.add_many(book_ids, frequencies)
+    load_time = time.perf_counter() - start
+
+    #The first query builds the z-score matrix
+    start = time.perf_counter()
+    index.nearest(book_ids[0], 10)
+    first_query = time.perf_counter() - start
+
+    rng = np.random.default_rng(1)
+    timings = []
+    for i in rng.integers(0, n_books, size=queries):
+        start = time.perf_counter()
+        index.nearest(book_ids[i], 10)
+        timings.append(time.perf_counter() - start)
+
+    #Adding a newly analysed book only updates the running sums, the z-scores are rebuilt on the next query
+    start = time.perf_counter()
+    index.add(uuid.uuid4(), frequencies[0])
+    index.nearest(book_ids[0], 10)
+    add_and_query = time.perf_counter() - start
+
+    timings = np.array(timings) * 1000
+    print(f"{n_books:>7} books   load {load_time * 1000:>8.1f} ms   "
+          f"first query {first_query * 1000:>7.2f} ms   "
+          f"query p50 {np.percentile(timings, 50):>6.2f} ms   p99 {np.percentile(timings, 99):>6.2f} ms   "
+          f"add+query {add_and_query * 1000:>7.2f} ms")
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Scriptum - Burrows' Delta Index Benchmark")
+    print("=" * 60)
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1_000, 5_000, 10_000, 50_000]
+    for size in sizes:
+        benchmark(size)
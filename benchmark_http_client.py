@@ -0,0 +1,95 @@
+"""
+Benchmark a new httpx.AsyncClient per call against GutendexService's shared pooled client.
+
+Usage: python benchmark_http_client.py [requests] [url]
+Without a url a local keep-alive HTTP server is started, which only shows the TCP connect cost.
+Pass a real https url (e.g. https://gutendex.com/books/1342/) to include DNS and TLS handshakes.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+from app.services.gutendex_service import GutendexService
+
+BODY = b'{"id": 1342, "title": "Pride and Prejudice"}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    #HTTP/1.1 so the server keeps connections open between requests
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/books/1342/"
+
+
+async def per_call_clients(url, n, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch():
+        async with semaphore:
+            async with httpx.AsyncClient(follow_redirects=True) as client:
+                (await client.get(url)).raise_for_status()
+
+    await asyncio.gather(*[fetch() for _ in range(n)])
+
+
+async def pooled_client(url, n, concurrency):
+    service = GutendexService()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch():
+        async with semaphore:
+            (await service._get(url)).raise_for_status()
+
+    try:
+        await asyncio.gather(*[fetch() for _ in range(n)])
+    finally:
+        await service.close()
+
+
+def benchmark(name, runner, url, n, concurrency):
+    start = time.perf_counter()
+    asyncio.run(runner(url, n, concurrency))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<18} concurrency {concurrency:>2}   {n} requests in {elapsed * 1000:>8.1f} ms   "
+          f"{elapsed / n * 1000:>6.2f} ms per request")
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Scriptum - Gutendex HTTP Client Benchmark")
+    print("=" * 60)
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server = None
+    if len(sys.argv) > 2:
+        url = sys.argv[2]
+    else:
+        server, url = start_local_server()
+    print(f"Target: {url}")
+
+    for concurrency in (1, 4):
+        benchmark("per-call clients", per_call_clients, url, n, concurrency)
+        benchmark("pooled client", pooled_client, url, n, concurrency)
+
+    if server is not None:
+        server.shutdown()
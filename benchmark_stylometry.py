@@ -0,0 +1,67 @@
+"""
+Benchmark the fused StylometryAnalyzer against the original multi-pass implementation on large texts.
+
+Usage: python benchmark_stylometry.py [path/to/book.txt ...]
+Without arguments it times synthetic novels of 1, 2 and 4 MB.
+"""
+
+import random
+import sys
+import time
+
+from app.services.stylometry_service import StylometryAnalyzer
+from test_stylometry import reference_analyze_text
+
+VOCAB = ("the of and a to in he was that it his with had as for she at by on not be but from "
+         "whale captain ship sea morning harbour letter silence window garden carriage dinner "
+         "walked answered looked remembered wondered thought never always perhaps quite").split()
+
+
+def synthetic_novel(n_chars, seed=0):
+    """Builds a novel-like text with 5-30 word sentences, paragraphs and some quoted dialogue"""
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < n_chars:
+        sentence = " ".join(rng.choice(VOCAB) for _ in range(rng.randint(5, 30)))
+        sentence = sentence.capitalize() + rng.choice([".", ".", ".", ",", ";", "!", "?"])
+        if rng.random() < 0.2:
+            sentence = f'"{sentence}" she said.'
+        sentence += "\n\n" if rng.random() < 0.1 else " "
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)
+
+
+def best_of(func, text, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(label, text):
+    analyzer = StylometryAnalyzer()
+    reference_time = best_of(reference_analyze_text, text)
+    fused_time = best_of(analyzer.analyze_text, text)
+    print(f"{label:<30} {len(text) / 1e6:>6.2f} MB   "
+          f"reference {reference_time * 1000:>8.1f} ms   "
+          f"fused {fused_time * 1000:>8.1f} ms   "
+          f"speedup {reference_time / fused_time:>5.1f}x")
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Scriptum - Stylometry Analyzer Benchmark")
+    print("=" * 60)
+
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, encoding="utf-8") as f:
+                benchmark(path, f.read())
+    else:
+        for megabytes in (1, 2, 4):
+            text = synthetic_novel(megabytes * 1_000_000, seed=megabytes)
+            benchmark(f"synthetic {megabytes} MB", text)
@@ -0,0 +1,45 @@
+"""
+Shared test setup. Tests that need a database get a SQLite file instead of PostgreSQL, with the PostgreSQL
+column types and search functions the models use mapped onto SQLite
+"""
+import os
+import tempfile
+
+#app.database connects when it is imported, so this has to come first
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'scriptum_test.db')}"
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
+from sqlalchemy.ext.compiler import compiles
+
+from app.database import Base, SessionLocal, engine
+import app.models  # noqa: F401
+
+
+@compiles(TSVECTOR, "sqlite")
+def _tsvector(element, compiler, **kw):
+    return "TEXT"
+
+
+@compiles(UUID, "sqlite")
+def _uuid(element, compiler, **kw):
+    return "CHAR(32)"
+
+
+#The search vector is a generated column, which SQLite only accepts with deterministic functions
+@event.listens_for(engine, "connect")
+def _search_functions(connection, record):
+    connection.create_function("setweight", 2, lambda vector, weight: vector, deterministic=True)
+    connection.create_function("to_tsvector", 2, lambda config, value: value, deterministic=True)
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(engine)
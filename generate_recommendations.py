@@ -0,0 +1,43 @@
+"""
+Batch job that materialises the recommendations table from users' ratings and the books' style profiles.
+
+By default only users whose ratings changed since their recommendations were generated are recomputed,
+so it can run nightly. Use --all to rebuild every user.
+"""
+
+import argparse
+
+from app.database import SessionLocal
+from app.services.recommendation_service import DEFAULT_CHUNK_SIZE, generate_recommendations
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate style based recommendations for users")
+    parser.add_argument("--all", action="store_true", help="recompute every user, not only those with new ratings")
+    parser.add_argument("--top-n", type=int, default=20, help="recommendations stored per user")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="users scored together")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("Scriptum - Recommendation Generator")
+    print("="*60)
+
+    db = SessionLocal()
+    try:
+        stats = generate_recommendations(
+            db,
+            top_n=args.top_n,
+            chunk_size=args.chunk_size,
+            only_stale=not args.all
+        )
+    except KeyboardInterrupt:
+        print("\n\nGeneration cancelled by user")
+        raise SystemExit(1)
+    finally:
+        db.close()
+
+    print(f"\n{'='*60}")
+    print("Generation Complete")
+    print(f"{'='*60}")
+    for key, value in stats.items():
+        print(f"{key.replace('_', ' ').capitalize()}: {value}")
+    print(f"{'='*60}")
@@ -1,15 +1,36 @@
 """
 Bulk import script to populate the database with all books from Gutendex API.
+
+Progress is checkpointed after each batch, so running it again after it stops carries on
+from the last finished page. Books whose catalog entry has not changed are not written again.
+
+With --dump it reads a local copy of Project Gutenberg's catalog dump instead of paging gutendex.com,
+either pg_catalog.csv or the rdf-files tarball from https://www.gutenberg.org/ebooks/offline_catalogs.html
 """
 
-import requests
+import argparse
+import asyncio
+import hashlib
+import httpx
+import io
+import math
 import psycopg2
-from psycopg2.extras import execute_values
 import time
 import os
 import uuid
 from dotenv import load_dotenv
 
+from app.services.catalog_dump import read_catalog_dump
+from app.services.catalog_facets import (
+    FACET_SCHEMA_STATEMENTS,
+    LANGUAGE_FACET,
+    REFRESH_FACET_COUNTS_STATEMENTS,
+    SUBJECT_FACET,
+    clean_facet_values
+)
+from app.services.catalog_search import SEARCH_SCHEMA_STATEMENTS
+from app.services.upstream_guard import CircuitOpenError, UpstreamGuard, backoff_delay
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -17,35 +38,301 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable not set")
 
-def fetch_all_books(max_books=10000):
-    all_books = []
-    url = "https://gutendex.com/books/"
+GUTENDEX_URL = "https://gutendex.com/books/"
+
+#Pages fetched at the same time, and the requests per second sent to gutendex.com across all of them
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 8))
+IMPORT_RATE_PER_SECOND = float(os.getenv("IMPORT_RATE_PER_SECOND", 4))
+
+#A page that still fails after the guard's own retries goes to the back of the queue up to this many times
+PAGE_ATTEMPTS = 5
+
+#Throughput is printed after every this many pages
+REPORT_EVERY = 20
+
+#Gutendex always returns this many books a page
+PAGE_SIZE = 32
+
+#Rows buffered in memory before they are sent to the staging table with COPY, merged and checkpointed
+COPY_BATCH_ROWS = 5000
+
+#Unlogged, so loading it skips the write-ahead log. It only holds the batch being merged
+STAGING_TABLE_SQL = """
+    CREATE UNLOGGED TABLE books_staging (
+        page INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        content_hash CHAR(32) NOT NULL,
+        download_count INTEGER,
+        book_id UUID NOT NULL,
+        gutenberg_id INTEGER,
+        title VARCHAR(500),
+        author VARCHAR(255),
+        publication_year INTEGER,
+        isbn VARCHAR(13),
+        text_file_path TEXT,
+        cover_url VARCHAR(500),
+        text_source VARCHAR(100),
+        summary TEXT
+    )
+"""
+
+STAGING_COLUMNS = "page, position, content_hash, download_count, book_id, gutenberg_id, title, author, publication_year, isbn, text_file_path, cover_url, text_source, summary"
+
+#Subjects and languages of the staged books, one row per value
+FACETS_STAGING_TABLE_SQL = """
+    CREATE UNLOGGED TABLE book_facets_staging (
+        gutenberg_id INTEGER NOT NULL,
+        facet VARCHAR(20) NOT NULL,
+        value TEXT NOT NULL
+    )
+"""
+
+#Progress of each import mode, and a hash of every book's catalog entry as it was last written
+SYNC_STATE_SQL = (
+    """
+    CREATE TABLE IF NOT EXISTS catalog_sync_state (
+        mode VARCHAR(20) PRIMARY KEY,
+        status VARCHAR(20) NOT NULL,
+        last_page INTEGER NOT NULL DEFAULT 0,
+        total_pages INTEGER,
+        max_gutenberg_id INTEGER,
+        rows_seen INTEGER NOT NULL DEFAULT 0,
+        rows_written INTEGER NOT NULL DEFAULT 0,
+        started_at TIMESTAMP DEFAULT now(),
+        updated_at TIMESTAMP DEFAULT now(),
+        finished_at TIMESTAMP
+    )
+    """,
+    #Pages a run gave up on, the next run fetches them again instead of everything after the first one
+    "ALTER TABLE catalog_sync_state ADD COLUMN IF NOT EXISTS failed_pages INTEGER[] NOT NULL DEFAULT '{}'",
+    """
+    CREATE TABLE IF NOT EXISTS catalog_sync_hashes (
+        gutenberg_id INTEGER PRIMARY KEY,
+        content_hash CHAR(32) NOT NULL
+    )
+    """,
+)
+
+#Moves the staged batch into books in one statement, skipping books whose hash matches the last one written.
+#A book staged twice, because the catalog changed while it was fetched, keeps its first copy.
+#The CSV dump has no summaries, so an import from it keeps the summary a book already has.
+#Returns how many books were staged and how many were written
+MERGE_SQL = """
+    WITH staged AS (
+        SELECT DISTINCT ON (gutenberg_id) *
+        FROM books_staging
+        WHERE gutenberg_id IS NOT NULL
+        ORDER BY gutenberg_id, page, position
+    ), changed AS (
+        SELECT staged.*
+        FROM staged
+        LEFT JOIN catalog_sync_hashes hashes ON hashes.gutenberg_id = staged.gutenberg_id
+        LEFT JOIN books ON books.gutenberg_id = staged.gutenberg_id
+        WHERE books.book_id IS NULL OR hashes.content_hash IS DISTINCT FROM staged.content_hash
+    ), merged AS (
+        INSERT INTO books (book_id, gutenberg_id, title, author, 
+                         publication_year, isbn, text_file_path, 
+                         cover_url, text_source, summary)
+        SELECT book_id, gutenberg_id, title, author, publication_year, isbn, text_file_path, cover_url, text_source, summary
+        FROM changed
+        ON CONFLICT (gutenberg_id) DO UPDATE SET
+            title = EXCLUDED.title,
+            cover_url = COALESCE(EXCLUDED.cover_url, books.cover_url),
+            text_file_path = CASE WHEN books.text_file_path LIKE '%.txt.gz' THEN books.text_file_path
+                ELSE COALESCE(EXCLUDED.text_file_path, books.text_file_path) END,
+            summary = COALESCE(EXCLUDED.summary, books.summary)
+        RETURNING gutenberg_id
+    ), hashed AS (
+        INSERT INTO catalog_sync_hashes (gutenberg_id, content_hash)
+        SELECT gutenberg_id, content_hash FROM changed
+        ON CONFLICT (gutenberg_id) DO UPDATE SET content_hash = EXCLUDED.content_hash
+        RETURNING gutenberg_id
+    )
+    SELECT (SELECT COUNT(*) FROM staged), (SELECT COUNT(*) FROM merged)
+"""
+
+#Download counts change every day, so they are left out of the content hash and only rows where the count
+#moved are updated. The CSV dump has no counts, and those rows keep the stored ones
+DOWNLOAD_COUNT_SQL = """
+    UPDATE books SET download_count = staged.download_count
+    FROM (
+        SELECT DISTINCT ON (gutenberg_id) gutenberg_id, download_count
+        FROM books_staging
+        WHERE gutenberg_id IS NOT NULL
+        ORDER BY gutenberg_id, page, position
+    ) staged
+    WHERE books.gutenberg_id = staged.gutenberg_id
+        AND staged.download_count IS NOT NULL
+        AND books.download_count IS DISTINCT FROM staged.download_count
+"""
+
+#Brings the subject and language links of the staged books in line with the catalog. Only links that were
+#added or removed are written
+FACET_MERGE_STATEMENTS = (
+    f"""
+    INSERT INTO subjects (name)
+    SELECT DISTINCT value FROM book_facets_staging WHERE facet = '{SUBJECT_FACET}'
+    ON CONFLICT (name) DO NOTHING
+    """,
+    f"""
+    DELETE FROM book_subjects
+    USING books
+    WHERE book_subjects.book_id = books.book_id
+        AND books.gutenberg_id IN (SELECT gutenberg_id FROM books_staging)
+        AND NOT EXISTS (
+            SELECT 1 FROM book_facets_staging facets
+            JOIN subjects ON subjects.name = facets.value
+            WHERE facets.facet = '{SUBJECT_FACET}' AND facets.gutenberg_id = books.gutenberg_id
+                AND subjects.subject_id = book_subjects.subject_id
+        )
+    """,
+    f"""
+    INSERT INTO book_subjects (book_id, subject_id)
+    SELECT DISTINCT books.book_id, subjects.subject_id
+    FROM book_facets_staging facets
+    JOIN books ON books.gutenberg_id = facets.gutenberg_id
+    JOIN subjects ON subjects.name = facets.value
+    WHERE facets.facet = '{SUBJECT_FACET}'
+    ON CONFLICT DO NOTHING
+    """,
+    f"""
+    DELETE FROM book_languages
+    USING books
+    WHERE book_languages.book_id = books.book_id
+        AND books.gutenberg_id IN (SELECT gutenberg_id FROM books_staging)
+        AND NOT EXISTS (
+            SELECT 1 FROM book_facets_staging facets
+            WHERE facets.facet = '{LANGUAGE_FACET}' AND facets.gutenberg_id = books.gutenberg_id
+                AND facets.value = book_languages.language
+        )
+    """,
+    f"""
+    INSERT INTO book_languages (book_id, language)
+    SELECT DISTINCT books.book_id, facets.value
+    FROM book_facets_staging facets
+    JOIN books ON books.gutenberg_id = facets.gutenberg_id
+    WHERE facets.facet = '{LANGUAGE_FACET}'
+    ON CONFLICT DO NOTHING
+    """,
+)
+
+#popular imports the most downloaded books, the Gutendex default order. catalog walks every book in ID order,
+#so pages stay put between runs and new books are always on the last pages
+MODE_PARAMS = {
+    "popular": {},
+    "catalog": {"sort": "ascending"},
+}
+
+#Mode of an import from a local catalog dump, which is checkpointed like the others
+DUMP_MODE = "dump"
+
+#Fetches one catalog page. The guard rate limits it and retries throttling, server and network errors
+async def fetch_page(client, guard, page, params=None):
+    url = str(httpx.URL(GUTENDEX_URL, params={**(params or {}), "page": page}))
+    response = await guard.send(url, lambda: client.get(url, timeout=30.0))
+    response.raise_for_status()
+    return response.json()
+
+def report_progress(done, total, started):
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"Fetched {done}/{total} pages, {done / elapsed:.2f} pages/s")
+
+async def fetch_catalog_pages(
+    max_books=10000,
+    workers=IMPORT_WORKERS,
+    start_page=1,
+    params=None,
+    failed_pages=None,
+    retry_pages=()
+):
+    """
+    Fetches the catalog from start_page with page numbers spread over a pool of workers instead of following
+    the next links one by one, and yields each page number with its books as soon as it arrives. retry_pages,
+    the pages an earlier run gave up on, are fetched first. A failed page is put back at the end of the queue,
+    so it does not hold up the others, and pages that are given up on are added to failed_pages. At most two
+    pages per worker wait to be consumed, so memory does not grow with the catalog. max_books of None fetches
+    the whole catalog.
+    """
+    guard = UpstreamGuard(rate=IMPORT_RATE_PER_SECOND, burst=workers)
+    failed_pages = failed_pages if failed_pages is not None else []
+    retry_pages = sorted(set(retry_pages))
     
-    while url and len(all_books) < max_books:
-        print(f"Fetching: {url}")
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+        #The first page gives how many books there are
+        first_page = retry_pages[0] if retry_pages else start_page
+        print(f"Fetching page {first_page}")
+        first = await fetch_page(client, guard, first_page, params)
+        count = first["count"] if max_books is None else min(first["count"], max_books)
+        total_pages = max(math.ceil(count / PAGE_SIZE), first_page)
+        pages = [page for page in retry_pages[1:] if page <= total_pages]
+        pages += [page for page in range(start_page, total_pages + 1) if page != first_page and page not in retry_pages]
+        if retry_pages:
+            print(f"Fetching {len(retry_pages)} pages the last run gave up on again")
+        print(f"{first['count']} books in the catalog, fetching {len(pages) + 1} pages up to {total_pages} with {workers} workers")
+        yield first_page, first["results"], total_pages
+        
+        fetched = 1
+        queue = asyncio.Queue()
+        for page in pages:
+            queue.put_nowait((page, 1))
+        results = asyncio.Queue(maxsize=workers * 2)
+        started = time.monotonic()
+        
+        async def worker():
+            while not queue.empty():
+                page, attempt = queue.get_nowait()
+                try:
+                    books = (await fetch_page(client, guard, page, params))["results"]
+                except (httpx.HTTPError, CircuitOpenError, ValueError) as e:
+                    if attempt >= PAGE_ATTEMPTS:
+                        print(f"Giving up on page {page} after {attempt} attempts: {e}")
+                        failed_pages.append(page)
+                        continue
+                    print(f"Page {page} failed ({e}), it will be fetched again")
+                    await asyncio.sleep(backoff_delay(attempt, base=2.0))
+                    queue.put_nowait((page, attempt + 1))
+                    continue
+                await results.put((page, books, total_pages))
+        
+        async def run_workers():
+            try:
+                await asyncio.gather(*[worker() for _ in range(workers)])
+            finally:
+                await results.put(None)
+        
+        runner = asyncio.create_task(run_workers())
         try:
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
-            data = response.json()
-            
-            all_books.extend(data['results'])
-            url = data.get('next')
-
-            if len(all_books) >= max_books:
-                all_books = all_books[:max_books]
-                print(f"Reached limit of {max_books} books")
-                break
-            
-            print(f"Fetched {len(all_books)} books so far..")
-            time.sleep(1)
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            print("Waiting before fetching again")
-            time.sleep(5)
-            continue
+            while (item := await results.get()) is not None:
+                yield item
+                fetched += 1
+                if fetched % REPORT_EVERY == 0:
+                    report_progress(fetched, len(pages) + 1, started)
+            await runner
+        finally:
+            runner.cancel()
+        report_progress(fetched, len(pages) + 1, started)
     
-    return all_books
+    if failed_pages:
+        print(f"Missing pages: {sorted(failed_pages)}")
+
+async def read_dump_pages(path, start_page=1):
+    """
+    Yields a catalog dump in pages of PAGE_SIZE books, so it is loaded, merged and checkpointed the same way
+    as the pages of gutendex.com. Pages before start_page were merged by an earlier run and are skipped.
+    Parsing never waits on the network, so the pages are yielded straight from the file.
+    """
+    print(f"Reading catalog dump {path}")
+    page = []
+    number = 1
+    for book in read_catalog_dump(path):
+        page.append(book)
+        if len(page) == PAGE_SIZE:
+            if number >= start_page:
+                yield number, page, None
+            page = []
+            number += 1
+    if page and number >= start_page:
+        yield number, page, None
 
 def prepare_book_data(book):
     author = book.get('authors', [{}])[0].get('name', 'Unknown') if book.get('authors') else 'Unknown'
@@ -78,11 +365,25 @@ def prepare_book_data(book):
         summary  
     )
 
-def bulk_insert_books(books, batch_size=500):
-    print("\nConnecting to database")
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
+#A value in COPY text format, where NULL is \N and backslashes, tabs and line breaks are escaped
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+#Subject and language rows of a book for the facet staging table
+def prepare_book_facets(book):
+    rows = []
+    for facet, values in ((SUBJECT_FACET, book.get('subjects')), (LANGUAGE_FACET, book.get('languages'))):
+        for value in clean_facet_values(values):
+            rows.append((book.get('id'), facet, value))
+    return rows
 
+#Hash of a book's catalog entry, without the book_id that is new on every run
+def content_hash(row):
+    return hashlib.md5("\t".join(copy_value(value) for value in row[1:]).encode("utf-8")).hexdigest()
+
+def ensure_schema(conn, cur):
     print("Checking database schema")
     try:
         cur.execute("""
@@ -100,76 +401,266 @@ def bulk_insert_books(books, batch_size=500):
             ON books(gutenberg_id);
         """)
         
+        #Full-text search column and index that search-gutendex answers from
+        for statement in SEARCH_SCHEMA_STATEMENTS:
+            cur.execute(statement)
+        
+        #Subject and language tables that /books/ filters on
+        for statement in FACET_SCHEMA_STATEMENTS:
+            cur.execute(statement)
+        
         conn.commit()
         print("Schema updated successfully")
     except Exception as e:
         print(f"Schema update error (might already exist): {e}")
         conn.rollback()
+    
+    for statement in SYNC_STATE_SQL:
+        cur.execute(statement)
+    cur.execute("DROP TABLE IF EXISTS books_staging")
+    cur.execute(STAGING_TABLE_SQL)
+    cur.execute("DROP TABLE IF EXISTS book_facets_staging")
+    cur.execute(FACETS_STAGING_TABLE_SQL)
+    conn.commit()
 
-    print("\nPreparing book data")
-    book_data = [prepare_book_data(book) for book in books]
+#Picks the first page of this run and the pages to fetch again. An unfinished run carries on after its last
+#checkpoint with the pages it gave up on, a finished one starts a new pass from page 1, or from its last page
+#when only new books are wanted
+def start_sync(conn, cur, mode, restart=False, new_only=False):
+    cur.execute("SELECT status, last_page, total_pages, failed_pages FROM catalog_sync_state WHERE mode = %s", (mode,))
+    state = cur.fetchone()
+    retry_pages = []
+    
+    if state is not None and state[0] == "running" and not restart:
+        start_page = state[1] + 1
+        retry_pages = list(state[3] or [])
+        print(f"Carrying on the {mode} import from page {start_page}")
+    else:
+        start_page = max(state[2] or 1, 1) if state is not None and new_only else 1
+        cur.execute("""
+            INSERT INTO catalog_sync_state (mode, status, last_page, rows_seen, rows_written, failed_pages, started_at, updated_at, finished_at)
+            VALUES (%(mode)s, 'running', %(last_page)s, 0, 0, '{}', now(), now(), NULL)
+            ON CONFLICT (mode) DO UPDATE SET
+                status = 'running', last_page = %(last_page)s, rows_seen = 0, rows_written = 0, failed_pages = '{}',
+                started_at = now(), updated_at = now(), finished_at = NULL
+        """, {"mode": mode, "last_page": start_page - 1})
+        print(f"Starting a {mode} import from page {start_page}")
+    
+    conn.commit()
+    return start_page, retry_pages
+
+#Copies a batch into the staging tables, merges it into books and their subjects and languages and moves the
+#checkpoint with the pages still missing in one transaction, so a run that stops never leaves a batch half
+#written. Returns how many books were staged and written
+def load_batch(conn, cur, buffer, facets_buffer, mode, last_page, total_pages, max_gutenberg_id, failed_pages):
+    try:
+        buffer.seek(0)
+        cur.copy_expert(f"COPY books_staging ({STAGING_COLUMNS}) FROM STDIN", buffer)
+        facets_buffer.seek(0)
+        cur.copy_expert("COPY book_facets_staging (gutenberg_id, facet, value) FROM STDIN", facets_buffer)
+        cur.execute(MERGE_SQL)
+        seen, written = cur.fetchone()
+        cur.execute(DOWNLOAD_COUNT_SQL)
+        for statement in FACET_MERGE_STATEMENTS:
+            cur.execute(statement)
+        cur.execute("TRUNCATE books_staging, book_facets_staging")
+        cur.execute("""
+            UPDATE catalog_sync_state SET
+                last_page = %(last_page)s,
+                total_pages = %(total_pages)s,
+                max_gutenberg_id = GREATEST(max_gutenberg_id, %(max_gutenberg_id)s),
+                rows_seen = rows_seen + %(seen)s,
+                rows_written = rows_written + %(written)s,
+                failed_pages = %(failed_pages)s,
+                updated_at = now()
+            WHERE mode = %(mode)s
+        """, {
+            "mode": mode, "last_page": last_page, "total_pages": total_pages, "max_gutenberg_id": max_gutenberg_id,
+            "seen": seen, "written": written, "failed_pages": failed_pages
+        })
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return seen, written
+
+#Recounts every facet once per import rather than per batch, browsing reads these counts. A failure is only
+#reported, the next import recounts them
+def refresh_facet_counts(conn, cur):
+    print("Refreshing subject and language counts")
+    try:
+        for statement in REFRESH_FACET_COUNTS_STATEMENTS:
+            cur.execute(statement)
+        conn.commit()
+    except psycopg2.Error as e:
+        print(f"Could not refresh subject and language counts: {e}")
+        if not conn.closed:
+            conn.rollback()
 
-    print(f"\nInserting {len(book_data)} books in batches of {batch_size}")
-    inserted_count = 0
+async def import_catalog(
+    max_books=10000,
+    workers=IMPORT_WORKERS,
+    batch_rows=COPY_BATCH_ROWS,
+    mode="popular",
+    restart=False,
+    new_only=False,
+    dump=None
+):
+    """
+    Streams the catalog into books. Each page goes through prepare_book_data as it arrives and is buffered
+    as COPY text. Every batch_rows rows the batch is copied to the staging table and merged into books,
+    and the checkpoint moves to the last page before which every page has been merged. Only one batch is
+    held in memory whatever the size of the catalog. dump is the path of a catalog dump to read instead
+    of gutendex.com.
+    """
+    print("\nConnecting to database")
+    conn = psycopg2.connect(DATABASE_URL)
+    cur = conn.cursor()
+    ensure_schema(conn, cur)
+    mode = DUMP_MODE if dump else mode
+    start_page, retry_pages = start_sync(conn, cur, mode, restart, new_only)
+    
+    buffer = io.StringIO()
+    facets_buffer = io.StringIO()
+    buffered_pages = []
+    buffered = 0
+    max_gutenberg_id = None
+    merged_pages = set()
+    checkpoint = start_page - 1
+    total_pages = None
+    staged = 0
+    written = 0
+    failed_pages = []
+    started = time.monotonic()
+    
+    #Pages given up on this run, and those of the last run that have not been merged since and are still in
+    #the catalog
+    def missing_pages():
+        retried = {page for page in set(retry_pages) - merged_pages if total_pages is None or page <= total_pages}
+        return sorted(retried | set(failed_pages))
     
-    for i in range(0, len(book_data), batch_size):
-        batch = book_data[i:i + batch_size]
-        batch_num = i//batch_size + 1
-        total_batches = (len(book_data) + batch_size - 1) // batch_size
+    async def flush():
+        nonlocal buffer, facets_buffer, buffered, buffered_pages, max_gutenberg_id, checkpoint, staged, written
+        if buffered_pages:
+            #The checkpoint only passes pages that are merged or stored as missing, pages can arrive out of order
+            merged_pages.update(buffered_pages)
+            failed = set(failed_pages)
+            while checkpoint + 1 in merged_pages or checkpoint + 1 in failed:
+                checkpoint += 1
+            
+            #COPY and the merge block, so they run in a thread while the workers keep fetching
+            seen, changed = await asyncio.to_thread(
+                load_batch, conn, cur, buffer, facets_buffer, mode, checkpoint, total_pages, max_gutenberg_id,
+                missing_pages()
+            )
+            staged += seen
+            written += changed
+            elapsed = max(time.monotonic() - started, 1e-9)
+            print(f"Merged {staged} books, {written} new or changed, {staged / elapsed:.0f} rows/s, checkpoint at page {checkpoint}")
+        buffer = io.StringIO()
+        facets_buffer = io.StringIO()
+        buffered_pages = []
+        buffered = 0
+        max_gutenberg_id = None
+    
+    try:
+        if dump:
+            pages = read_dump_pages(dump, start_page)
+        else:
+            pages = fetch_catalog_pages(max_books, workers, start_page, MODE_PARAMS[mode], failed_pages, retry_pages)
+        async for page, books, total_pages in pages:
+            for position, book in enumerate(books):
+                #The last page can run past max_books
+                if max_books is not None and (page - 1) * PAGE_SIZE + position >= max_books:
+                    break
+                row = prepare_book_data(book)
+                download_count = book.get('download_count')
+                buffer.write("\t".join(copy_value(value) for value in (page, position, content_hash(row), download_count, *row)) + "\n")
+                for facet_row in prepare_book_facets(book):
+                    facets_buffer.write("\t".join(copy_value(value) for value in facet_row) + "\n")
+                buffered += 1
+                if row[1] is not None:
+                    max_gutenberg_id = max(max_gutenberg_id or 0, row[1])
+            buffered_pages.append(page)
+            if buffered >= batch_rows:
+                await flush()
+        await flush()
         
+        #Pages given up on after the last batch move the checkpoint past them too. A pass with missing pages
+        #stays running, so the next run fetches only those again
+        failed = set(failed_pages)
+        while checkpoint + 1 in failed:
+            checkpoint += 1
+        missing = missing_pages()
+        cur.execute("""
+            UPDATE catalog_sync_state SET
+                last_page = GREATEST(last_page, %(last_page)s),
+                failed_pages = %(failed_pages)s,
+                status = CASE WHEN %(done)s THEN 'done' ELSE status END,
+                finished_at = CASE WHEN %(done)s THEN now() ELSE finished_at END,
+                updated_at = now()
+            WHERE mode = %(mode)s
+        """, {"mode": mode, "last_page": checkpoint, "failed_pages": missing, "done": not missing})
+        conn.commit()
+    finally:
+        #Batches merged before a run stops changed the facets too, so they are recounted either way
+        refresh_facet_counts(conn, cur)
+        
+        #Counting is only for the summary, so a failure here must not hide the error that stopped the import
+        total_gutenberg_books = books_with_summary = None
         try:
-            execute_values(
-                cur,
-                """
-                INSERT INTO books (book_id, gutenberg_id, title, author, 
-                                 publication_year, isbn, text_file_path, 
-                                 cover_url, text_source, summary)
-                VALUES %s
-                ON CONFLICT (gutenberg_id) DO UPDATE SET
-                    title = EXCLUDED.title,
-                    cover_url = COALESCE(EXCLUDED.cover_url, books.cover_url),
-                    text_file_path = COALESCE(EXCLUDED.text_file_path, books.text_file_path),
-                    summary = EXCLUDED.summary
-                """,
-                batch
-            )
+            cur.execute("SELECT COUNT(*) FROM books WHERE gutenberg_id IS NOT NULL")
+            total_gutenberg_books = cur.fetchone()[0]
             
-            conn.commit()
-            inserted_count += len(batch)
-            print(f"Batch {batch_num}/{total_batches} complete ({inserted_count}/{len(book_data)} books)")
-            
-        except Exception as e:
-            print(f"Error inserting batch {batch_num}: {e}")
-            conn.rollback()
-    
-    cur.execute("SELECT COUNT(*) FROM books WHERE gutenberg_id IS NOT NULL")
-    total_gutenberg_books = cur.fetchone()[0]
-
-    cur.execute("SELECT COUNT(*) FROM books WHERE summary IS NOT NULL")
-    books_with_summary = cur.fetchone()[0]
-    
-    cur.close()
-    conn.close()
+            cur.execute("SELECT COUNT(*) FROM books WHERE summary IS NOT NULL")
+            books_with_summary = cur.fetchone()[0]
+        except psycopg2.Error as e:
+            print(f"Could not count the imported books: {e}")
+        finally:
+            cur.close()
+            conn.close()
     
+    elapsed = max(time.monotonic() - started, 1e-9)
     print(f"\n{'='*60}")
-    print(f"Import Complete")
+    print(f"Import Complete" if not missing else f"Import Stopped, run again to fetch the {len(missing)} missing pages")
     print(f"{'='*60}")
-    print(f"Total books processed: {len(book_data)}")
+    print(f"Total books processed: {staged} in {elapsed:.1f}s, {staged / elapsed:.0f} rows/s")
+    print(f"New or changed books written: {written}")
     print(f"Total Gutenberg books in database: {total_gutenberg_books}")
     print(f"Books with summaries: {books_with_summary}")
     print(f"{'='*60}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import the Gutendex catalog into the books table")
+    parser.add_argument("--sync", action="store_true", help="walk the whole catalog in ID order instead of the most popular books")
+    parser.add_argument("--max-books", type=int, default=10000, help="books imported without --sync")
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS, help="pages fetched at once")
+    parser.add_argument("--restart", action="store_true", help="start from page 1 even if the last run did not finish")
+    parser.add_argument("--new-only", action="store_true", help="with --sync, only fetch the pages after the last finished pass")
+    parser.add_argument("--dump", metavar="PATH", help="read pg_catalog.csv or the rdf-files tarball instead of gutendex.com")
+    args = parser.parse_args()
+    if args.new_only and not args.sync:
+        parser.error("--new-only needs --sync")
+    if args.dump and args.sync:
+        parser.error("--dump already reads the whole catalog, leave out --sync")
+    
     print("="*60)
     print("Scriptum - Gutendex Bulk Import")
     print("="*60)
     
     try:
-        books = fetch_all_books()
-        bulk_insert_books(books)
+        asyncio.run(import_catalog(
+            max_books=None if args.sync or args.dump else args.max_books,
+            workers=args.workers,
+            mode="catalog" if args.sync else "popular",
+            restart=args.restart,
+            new_only=args.new_only,
+            dump=args.dump
+        ))
         
     except KeyboardInterrupt:
-        print("\n\nImport cancelled by user")
+        print("\n\nImport stopped, run again to carry on")
+        raise SystemExit(1)
     except Exception as e:
         print(f"\nFatal error: {e}")
-        raise
\ No newline at end of file
+        raise
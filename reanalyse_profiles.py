@@ -0,0 +1,53 @@
+"""
+Re-analyses every stylometric profile written by an older analysis version.
+
+Progress is checkpointed after each batch, so running it again after it stops carries on
+from the last finished batch instead of starting over.
+"""
+
+import argparse
+import asyncio
+
+from app.database import SessionLocal
+from app.services.analysis_pool import analysis_pool
+from app.services.gutendex_service import gutendex_service
+from app.services.reanalysis_service import DEFAULT_BATCH_SIZE, DEFAULT_CONCURRENCY, run_reanalysis, start_reanalysis
+
+async def main(batch_size: int, concurrency: int):
+    db = SessionLocal()
+    try:
+        job = start_reanalysis(db)
+        print(f"Job {job.job_id}: {job.processed}/{job.total} books already done")
+        job_id = job.job_id
+    finally:
+        db.close()
+
+    analysis_pool.start()
+    try:
+        return await run_reanalysis(job_id, batch_size=batch_size, concurrency=concurrency)
+    finally:
+        await gutendex_service.close()
+        analysis_pool.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-analyse profiles from older analysis versions")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="books written per transaction")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Gutenberg downloads at once")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("Scriptum - Profile Re-analysis")
+    print("="*60)
+
+    try:
+        progress = asyncio.run(main(args.batch_size, args.concurrency))
+    except KeyboardInterrupt:
+        print("\n\nRe-analysis stopped, run again to carry on")
+        raise SystemExit(1)
+
+    print(f"\n{'='*60}")
+    print("Re-analysis Finished")
+    print(f"{'='*60}")
+    for key, value in (progress or {}).items():
+        print(f"{key.replace('_', ' ').capitalize()}: {value}")
+    print(f"{'='*60}")
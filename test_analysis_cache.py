@@ -0,0 +1,87 @@
+"""
+Tests for caching analysis results by the hash of the text
+"""
+from datetime import datetime
+
+import numpy as np
+
+from app.models import AnalysisCacheEntry, Book
+from app.services import analysis_cache as analysis_cache_module
+from app.services.analysis_cache import AnalysisCache
+from app.services.stylometry_service import TIMELINE_METRICS
+
+METRICS = {"pacing_score": 0.5, "tone_score": 0.25}
+FREQUENCIES = np.array([0.1, 0.2, 0.3], dtype=np.float32)
+TIMELINE = np.ones((2, len(TIMELINE_METRICS)), dtype=np.float32)
+
+
+def put(cache, db, key, version="1.0"):
+    cache.put(db, key, METRICS, FREQUENCIES, TIMELINE, version)
+
+
+def entry(db, key, version="1.0"):
+    db.expire_all()
+    return db.get(AnalysisCacheEntry, (key, version))
+
+
+def test_get_returns_what_was_put(db):
+    cache = AnalysisCache()
+    put(cache, db, "a")
+
+    metrics, frequencies, timeline = cache.get(db, "a", "1.0")
+    assert metrics == METRICS
+    np.testing.assert_array_equal(frequencies, FREQUENCIES)
+    np.testing.assert_array_equal(timeline, TIMELINE)
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_other_versions_and_entries_without_a_timeline_are_misses(db):
+    cache = AnalysisCache()
+    put(cache, db, "a")
+    db.add(AnalysisCacheEntry(
+        text_hash="b", analysis_version="1.0", metrics=METRICS,
+        frequencies=FREQUENCIES.tobytes(), timeline=None, vocabulary_version="1"
+    ))
+    db.commit()
+
+    assert cache.get(db, "a", "2.0") is None
+    assert cache.get(db, "b", "1.0") is None
+    assert cache.get(db, "c", "1.0") is None
+    assert (cache.hits, cache.misses) == (0, 3)
+
+
+def test_hits_are_written_in_batches_without_committing_the_callers_session(db, monkeypatch):
+    monkeypatch.setattr(analysis_cache_module, "TOUCH_FLUSH_SIZE", 2)
+    cache = AnalysisCache()
+    put(cache, db, "a")
+    put(cache, db, "b")
+
+    db.add(Book(title="Pending", author="Author"))
+    db.flush()
+    cache.get(db, "a", "1.0")
+    cache.get(db, "a", "1.0")
+    assert cache._touches == {("a", "1.0"): 2}
+    db.rollback()
+    assert entry(db, "a").hit_count == 0
+    assert db.query(Book).count() == 0
+
+    cache.get(db, "b", "1.0")
+    assert cache._touches == {}
+    assert entry(db, "a").hit_count == 2
+    assert entry(db, "b").hit_count == 1
+
+
+def test_evict_counts_pending_hits_before_dropping_the_least_recently_used(db):
+    cache = AnalysisCache(max_entries=2)
+    for key in ("a", "b", "c"):
+        put(cache, db, key)
+    for day, key in enumerate(("a", "b", "c"), start=1):
+        db.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.text_hash == key).update({"last_used_at": datetime(2020, 1, day)})
+    db.commit()
+
+    cache.get(db, "a", "1.0")
+    assert cache.evict(db) == 1
+
+    assert entry(db, "b") is None
+    assert entry(db, "a").hit_count == 1
+    assert cache.stats(db)["entries"] == 2
@@ -0,0 +1,91 @@
+"""
+Tests for reading Project Gutenberg's catalog dumps into gutendex.com shaped books
+"""
+import gzip
+import io
+import tarfile
+
+import pytest
+
+from app.services.catalog_dump import parse_csv_author, read_catalog_dump
+
+CSV = (
+    "Text#,Type,Issued,Title,Language,Authors,Subjects,LoCC,Bookshelves\n"
+    '2701,Text,2001-07-01,"Moby Dick; Or, The Whale",en,"Melville, Herman, 1819-1891",'
+    '"Whaling -- Fiction; Sea stories",PS,"Best Books Ever Listings"\n'
+    "10,Sound,2005-01-01,An Audio Book,en,,,,\n"
+    '1342,Text,1998-06-01,"Pride and\nPrejudice",en,"Austen, Jane, 1775-1817; Smith, John [Illustrator]",,,\n'
+)
+
+RDF = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:dcterms="http://purl.org/dc/terms/"
+    xmlns:dcam="http://purl.org/dc/dcam/" xmlns:pgterms="http://www.gutenberg.org/2009/pgterms/">
+  <pgterms:ebook rdf:about="ebooks/2701">
+    <dcterms:title>Moby Dick; Or, The Whale</dcterms:title>
+    <dcterms:creator>
+      <pgterms:agent rdf:about="2009/agents/9">
+        <pgterms:name>Melville, Herman</pgterms:name>
+        <pgterms:birthdate>1819</pgterms:birthdate>
+        <pgterms:deathdate>1891</pgterms:deathdate>
+      </pgterms:agent>
+    </dcterms:creator>
+    <dcterms:subject><rdf:Description><dcam:memberOf rdf:resource="http://purl.org/dc/terms/LCSH"/>
+      <rdf:value>Whaling -- Fiction</rdf:value></rdf:Description></dcterms:subject>
+    <dcterms:subject><rdf:Description><dcam:memberOf rdf:resource="http://purl.org/dc/terms/LCC"/>
+      <rdf:value>PS</rdf:value></rdf:Description></dcterms:subject>
+    <dcterms:language><rdf:Description><rdf:value>en</rdf:value></rdf:Description></dcterms:language>
+    <dcterms:type><rdf:Description><rdf:value>Text</rdf:value></rdf:Description></dcterms:type>
+    <dcterms:hasFormat>
+      <pgterms:file rdf:about="https://www.gutenberg.org/ebooks/2701.txt.utf-8">
+        <dcterms:format><rdf:Description><rdf:value>text/plain; charset=utf-8</rdf:value></rdf:Description></dcterms:format>
+      </pgterms:file>
+    </dcterms:hasFormat>
+    <pgterms:marc520>A whaling voyage.</pgterms:marc520>
+    <pgterms:downloads>100</pgterms:downloads>
+  </pgterms:ebook>
+</rdf:RDF>
+"""
+
+
+def test_csv_dump_keeps_text_books(tmp_path):
+    path = tmp_path / "pg_catalog.csv.gz"
+    with gzip.open(path, "wt", encoding="utf-8") as file:
+        file.write(CSV)
+
+    books = list(read_catalog_dump(str(path)))
+
+    assert [book["id"] for book in books] == [2701, 1342]
+    moby, pride = books
+    assert moby["authors"] == [{"name": "Melville, Herman", "birth_year": 1819, "death_year": 1891}]
+    assert moby["subjects"] == ["Whaling -- Fiction", "Sea stories"]
+    assert moby["formats"]["text/plain; charset=utf-8"] == "https://www.gutenberg.org/ebooks/2701.txt.utf-8"
+    assert pride["title"] == "Pride and Prejudice"
+    assert pride["authors"][1] == {"name": "Smith, John", "birth_year": None, "death_year": None}
+
+
+def test_rdf_tarball_is_streamed(tmp_path):
+    path = tmp_path / "rdf-files.tar.bz2"
+    with tarfile.open(path, "w:bz2") as tar:
+        data = RDF.encode("utf-8")
+        member = tarfile.TarInfo("cache/epub/2701/pg2701.rdf")
+        member.size = len(data)
+        tar.addfile(member, io.BytesIO(data))
+
+    (book,) = read_catalog_dump(str(path))
+
+    assert book["id"] == 2701
+    assert book["authors"][0]["birth_year"] == 1819
+    assert book["subjects"] == ["Whaling -- Fiction"]
+    assert book["languages"] == ["en"]
+    assert book["formats"] == {"text/plain; charset=utf-8": "https://www.gutenberg.org/ebooks/2701.txt.utf-8"}
+    assert book["summaries"] == ["A whaling voyage."]
+
+
+def test_author_years_before_the_common_era():
+    assert parse_csv_author("Homer, 751? BCE-651? BCE") == {"name": "Homer", "birth_year": -751, "death_year": -651}
+    assert parse_csv_author("Anonymous")["name"] == "Anonymous"
+
+
+def test_unknown_dump_format():
+    with pytest.raises(ValueError):
+        read_catalog_dump("catalog.json")
@@ -0,0 +1,127 @@
+"""
+Tests for the subject and language facets and their stored counts
+"""
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.database import get_db
+from app.models import Book, FacetCount
+from app.routers import books
+from app.services.catalog_facets import (
+    LANGUAGE_FACET,
+    SUBJECT_FACET,
+    clean_facet_values,
+    facet_changes,
+    facet_values,
+    filter_by_facets,
+    set_book_facets,
+)
+from import_gutendex import prepare_book_facets
+
+
+def counts(db):
+    return {(row.facet, row.value): row.book_count for row in db.query(FacetCount)}
+
+
+def add_book(db, title):
+    book = Book(title=title, author="Author")
+    db.add(book)
+    db.flush()
+    return book
+
+
+def test_clean_facet_values_drops_blanks_and_repeats():
+    assert clean_facet_values([" Sea stories ", "", None, "Whaling", "Sea stories", "  "]) == ["Sea stories", "Whaling"]
+    assert clean_facet_values(None) == []
+
+
+def test_facet_changes_keep_their_order():
+    assert facet_changes(["b", "a", "c"], ["c", "d", "e"]) == (["d", "e"], ["b", "a"])
+    assert facet_changes([], ["a"]) == (["a"], [])
+
+
+def test_prepare_book_facets_gives_one_row_per_value():
+    book = {"id": 2701, "subjects": ["Whaling", "Whaling", " "], "languages": ["en"]}
+
+    assert prepare_book_facets(book) == [(2701, SUBJECT_FACET, "Whaling"), (2701, LANGUAGE_FACET, "en")]
+    assert prepare_book_facets({"id": 1}) == []
+
+
+def test_counts_follow_added_removed_and_deleted_books(db):
+    moby, typee = add_book(db, "Moby Dick"), add_book(db, "Typee")
+    set_book_facets(db, moby.book_id, ["Whaling", "Sea stories"], ["en"])
+    set_book_facets(db, typee.book_id, ["Sea stories"], ["en", "fr"])
+    db.commit()
+    assert counts(db) == {
+        (SUBJECT_FACET, "Whaling"): 1, (SUBJECT_FACET, "Sea stories"): 2,
+        (LANGUAGE_FACET, "en"): 2, (LANGUAGE_FACET, "fr"): 1
+    }
+
+    set_book_facets(db, moby.book_id, ["Sea stories", "Adventure"], ["en"])
+    db.commit()
+    assert counts(db)[(SUBJECT_FACET, "Adventure")] == 1
+    assert (SUBJECT_FACET, "Whaling") not in counts(db)
+
+    #Deleting a book clears its facets first
+    set_book_facets(db, typee.book_id, [], [])
+    db.commit()
+    assert counts(db) == {(SUBJECT_FACET, "Sea stories"): 1, (SUBJECT_FACET, "Adventure"): 1, (LANGUAGE_FACET, "en"): 1}
+
+
+def test_filter_by_facets_needs_both_values(db):
+    moby, typee, candide = add_book(db, "Moby Dick"), add_book(db, "Typee"), add_book(db, "Candide")
+    set_book_facets(db, moby.book_id, ["Sea stories"], ["en"])
+    set_book_facets(db, typee.book_id, ["Sea stories"], ["fr"])
+    set_book_facets(db, candide.book_id, ["Satire"], ["fr"])
+    db.commit()
+
+    def titles(**facets):
+        return sorted(book.title for book in filter_by_facets(db.query(Book), **facets))
+
+    assert titles(subject="Sea stories") == ["Moby Dick", "Typee"]
+    assert titles(language="fr") == ["Candide", "Typee"]
+    assert titles(subject="Sea stories", language="fr") == ["Typee"]
+    assert titles(subject="Whaling") == []
+    assert len(titles()) == 3
+
+
+def test_facets_endpoint_lists_the_largest_first(db):
+    for i, subjects in enumerate([["Sea stories", "Whaling"], ["Sea stories"], ["Satire"]]):
+        set_book_facets(db, add_book(db, f"Book {i}").book_id, subjects, ["en"])
+    db.commit()
+
+    app = FastAPI()
+    app.include_router(books.router)
+    app.dependency_overrides[get_db] = lambda: db
+    response = TestClient(app).get("/books/facets", params={"limit": 2})
+
+    assert response.status_code == 200
+    assert response.json() == {
+        SUBJECT_FACET: [{"value": "Sea stories", "count": 2}, {"value": "Satire", "count": 1}],
+        LANGUAGE_FACET: [{"value": "en", "count": 3}]
+    }
+    assert facet_values(db, limit=0)[SUBJECT_FACET] == [{"value": "Sea stories", "count": 2}]
+
+
+def test_import_from_gutendex_writes_the_facets_of_new_and_existing_books(db, monkeypatch):
+    async def get_book_by_id(gutenberg_id):
+        return {
+            "title": f"Book {gutenberg_id}",
+            "author": "Author",
+            "subjects": ["Sea stories"],
+            "languages": ["en"],
+            "download_count": 10
+        }
+
+    monkeypatch.setattr(books.gutendex_service, "get_book_by_id", get_book_by_id)
+    existing = add_book(db, "Book 2")
+    db.commit()
+
+    app = FastAPI()
+    app.include_router(books.router)
+    app.dependency_overrides[get_db] = lambda: db
+    client = TestClient(app)
+
+    assert client.post("/books/import-from-gutendex/1").json()["title"] == "Book 1"
+    assert client.post("/books/import-from-gutendex/2").json()["book_id"] == str(existing.book_id)
+    assert counts(db) == {(SUBJECT_FACET, "Sea stories"): 2, (LANGUAGE_FACET, "en"): 2}
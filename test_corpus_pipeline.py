@@ -0,0 +1,126 @@
+"""
+Tests for the download, analysis and write pipeline that analyses the unanalysed corpus
+"""
+import asyncio
+
+import pytest
+
+from app.models import Book, FunctionWordProfile, StylometricProfile
+from app.services import corpus_pipeline
+from app.services.analysis_pool import analyze_book_job
+from app.services.corpus_pipeline import CorpusPipeline, PipelineItem
+
+TEXT = "The sea was calm. She said nothing, and the ship sailed on into the night. " * 20
+
+
+class InlinePool:
+    """Analyses in this process, optionally waiting for a signal before each book"""
+
+    def __init__(self, gate=None):
+        self.max_workers = 1
+        self.gate = gate
+        self.started = 0
+
+    async def analyze_book(self, text):
+        self.started += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        return analyze_book_job(text)
+
+
+def add_books(db, count, **columns):
+    books = [Book(title=f"Book {i}", author="Author", analysed=False, **columns) for i in range(count)]
+    db.add_all(books)
+    db.commit()
+    return books
+
+
+def test_failed_downloads_are_left_unanalysed(db, monkeypatch):
+    good, empty, broken = add_books(db, 3)
+    broken_id = broken.book_id
+
+    async def load_book_text(session, book):
+        if book.book_id == broken_id:
+            raise OSError("connection reset")
+        if book.book_id == empty.book_id:
+            return None
+        book.text_file_path = "ab/stored.txt.gz"
+        return TEXT
+
+    monkeypatch.setattr(corpus_pipeline, "load_book_text", load_book_text)
+    monkeypatch.setattr(corpus_pipeline, "analysis_pool", InlinePool())
+
+    stats = asyncio.run(CorpusPipeline(download_concurrency=2, analysis_concurrency=1, write_batch_size=2).run())
+
+    db.expire_all()
+    assert {book.title: book.analysed for book in db.query(Book)} == {"Book 0": True, "Book 1": False, "Book 2": False}
+    assert db.get(Book, good.book_id).text_file_path == "ab/stored.txt.gz"
+    assert db.query(StylometricProfile).count() == db.query(FunctionWordProfile).count() == 1
+    assert (stats["download"]["done"], stats["download"]["skipped"], stats["download"]["failed"]) == (1, 1, 1)
+    assert stats["write"]["done"] == 1 and stats["write"]["skipped"] == 2
+
+
+def test_slow_analysis_holds_the_downloads_back(db, monkeypatch):
+    add_books(db, 20)
+    downloads = []
+
+    async def load_book_text(session, book):
+        downloads.append(book.book_id)
+        return TEXT
+
+    async def scenario():
+        gate = asyncio.Event()
+        pool = InlinePool(gate)
+        monkeypatch.setattr(corpus_pipeline, "analysis_pool", pool)
+        pipeline = CorpusPipeline(download_concurrency=2, analysis_concurrency=1, write_batch_size=5, select_batch_size=3)
+        run = asyncio.create_task(pipeline.run())
+        await asyncio.sleep(0.2)
+        #One text being analysed, one queued for it and one held by each downloader
+        waiting = len(downloads)
+        gate.set()
+        return waiting, await asyncio.wait_for(run, timeout=30)
+
+    monkeypatch.setattr(corpus_pipeline, "load_book_text", load_book_text)
+    waiting, stats = asyncio.run(scenario())
+
+    assert 3 <= waiting <= 4
+    assert stats["analyse"]["done"] == 20 and stats["write"]["done"] == 20
+    assert db.query(Book).filter(Book.analysed == True).count() == 20
+
+
+def test_a_failing_stage_stops_the_others(db, monkeypatch):
+    add_books(db, 5)
+
+    async def load_book_text(session, book):
+        return TEXT
+
+    def write_batch(self, session, batch):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(corpus_pipeline, "load_book_text", load_book_text)
+    monkeypatch.setattr(corpus_pipeline, "analysis_pool", InlinePool())
+    monkeypatch.setattr(CorpusPipeline, "_write_batch", write_batch)
+
+    async def scenario():
+        pipeline = CorpusPipeline(download_concurrency=2, analysis_concurrency=1, write_batch_size=1)
+        await asyncio.wait_for(pipeline.run(), timeout=30)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
+    assert db.query(Book).filter(Book.analysed == True).count() == 0
+
+
+def test_write_batch_marks_only_analysed_items(db):
+    analysed, failed = (book.book_id for book in add_books(db, 2))
+    result = analyze_book_job(TEXT)
+    batch = [
+        PipelineItem(analysed, "aa/one.txt.gz", 11, result=result, cache_key="a" * 64),
+        PipelineItem(failed, "bb/two.txt.gz", 12)
+    ]
+
+    assert CorpusPipeline(analysis_concurrency=1)._write_batch(db, batch) == 1
+
+    rows = {book.book_id: book for book in db.query(Book)}
+    assert (rows[analysed].analysed, rows[analysed].gutenberg_id) == (True, 11)
+    assert (rows[failed].analysed, rows[failed].text_file_path) == (False, "bb/two.txt.gz")
+    assert db.query(StylometricProfile.book_id).all() == [(analysed,)]
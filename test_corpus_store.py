@@ -0,0 +1,73 @@
+"""
+Tests for the local compressed corpus store
+"""
+import os
+
+from app.services.corpus_store import BLOB_SUFFIX, CorpusStore, is_blob_path
+
+
+def test_round_trip_and_deduplication(tmp_path):
+    store = CorpusStore(root=str(tmp_path), max_bytes=10 ** 9)
+    text = "Call me Ishmael. Some years ago — never mind how long precisely. " * 500
+
+    path = store.put(text)
+    assert is_blob_path(path) and path.endswith(BLOB_SUFFIX)
+    assert store.put(text) == path
+    assert store.get(path) == text
+
+    stats = store.stats()
+    assert stats["blobs"] == 1
+    assert stats["stored_bytes"] < stats["raw_bytes"]
+
+
+def test_writer_matches_put(tmp_path):
+    store = CorpusStore(root=str(tmp_path), max_bytes=10 ** 9)
+    chunks = ["Call me Ishmael. ", "Some years ago — ", "never mind how long precisely."] * 100
+
+    writer = store.writer()
+    for chunk in chunks:
+        writer.write(chunk)
+    path = writer.commit()
+
+    assert path == store.put("".join(chunks))
+    assert store.get(path) == "".join(chunks)
+    assert store.stats()["blobs"] == 1
+    assert [name for name in os.listdir(str(tmp_path)) if name.endswith(".tmp")] == []
+
+
+def test_missing_blob_is_a_miss(tmp_path):
+    store = CorpusStore(root=str(tmp_path))
+    path = store.put("Some text.")
+    os.remove(os.path.join(str(tmp_path), path))
+
+    assert store.get(path) is None
+    assert store.stats()["blobs"] == 0
+
+
+def test_least_recently_read_is_evicted(tmp_path):
+    texts = [os.urandom(3000).hex() for _ in range(3)]
+    store = CorpusStore(root=str(tmp_path), max_bytes=10 ** 9)
+    paths = [store.put(text) for text in texts[:2]]
+
+    #Reading the first text makes the second the least recently read
+    store.get(paths[0])
+    store.max_bytes = store.stats()["stored_bytes"] + 100
+    third = store.put(texts[2])
+
+    assert store.get(paths[1]) is None
+    assert store.get(paths[0]) == texts[0]
+    assert store.get(third) == texts[2]
+    assert store.evictions == 1
+
+
+def test_truncated_blob_is_a_miss(tmp_path):
+    store = CorpusStore(root=str(tmp_path), max_bytes=10 ** 9)
+    path = store.put("It was a bright cold day in April. " * 500)
+    full_path = os.path.join(str(tmp_path), path)
+    with open(full_path, "rb") as file:
+        data = file.read()
+    with open(full_path, "wb") as file:
+        file.write(data[:len(data) // 2])
+
+    assert store.get(path) is None
+    assert store.stats()["blobs"] == 0
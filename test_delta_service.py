@@ -0,0 +1,94 @@
+"""
+Tests for the in-memory Burrows' Delta index
+"""
+import uuid
+
+import numpy as np
+
+from app.models import Book, FunctionWordProfile
+from app.services import delta_service
+from app.services.delta_service import DeltaIndex, pack_frequencies
+from app.services.stylometry_service import FUNCTION_WORDS_VERSION
+
+
+def test_nearest_orders_books_by_delta():
+    index = DeltaIndex(n_features=3)
+    a, b, c = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    index.add_many([a, b, c], np.array([[1, 0, 0], [1, 0.1, 0], [0, 1, 1]]))
+
+    assert [book_id for book_id, _ in index.nearest(a)] == [b, c]
+    assert index.nearest(uuid.uuid4()) is None
+    assert index.nearest(a, limit=0) == []
+
+
+def test_z_scores_are_only_rebuilt_when_a_vector_changes():
+    index = DeltaIndex(n_features=2)
+    a, b = uuid.uuid4(), uuid.uuid4()
+    index.add_many([a, b], np.array([[1, 0], [0, 1]]))
+    index.nearest(a)
+    z_scores = index._z_scores
+
+    index.add(a, np.array([1, 0]))
+    assert index._z_scores is z_scores and len(index) == 2
+
+    index.add(a, np.array([0.5, 0.5]))
+    assert index._z_scores is None
+    np.testing.assert_allclose(index._sum, [0.5, 1.5])
+
+
+def test_sync_loads_new_rows_and_skips_the_unchanged(db):
+    a, b = Book(title="A", author="X"), Book(title="B", author="Y")
+    db.add_all([a, b])
+    db.flush()
+    db.add_all([
+        FunctionWordProfile(book_id=a.book_id, frequencies=pack_frequencies([1, 0]), vocabulary_version=FUNCTION_WORDS_VERSION),
+        FunctionWordProfile(book_id=b.book_id, frequencies=pack_frequencies([0, 1]), vocabulary_version=FUNCTION_WORDS_VERSION),
+        FunctionWordProfile(book_id=uuid.uuid4(), frequencies=pack_frequencies([9, 9]), vocabulary_version="old")
+    ])
+    db.commit()
+
+    index = DeltaIndex(n_features=2)
+    index.sync(db)
+    assert len(index) == 2 and index.nearest(a.book_id)[0][0] == b.book_id
+
+    index.nearest(a.book_id)
+    z_scores = index._z_scores
+    index.sync(db)
+    assert index._z_scores is z_scores
+
+
+def test_remove_takes_the_book_out_of_the_corpus_stats():
+    index = DeltaIndex(n_features=2)
+    a, b, c = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    index.add_many([a, b, c], np.array([[1, 0], [9, 9], [0, 1]]))
+    index.nearest(a)
+
+    index.remove(b)
+    index.remove(b)
+
+    assert len(index) == 2 and index._z_scores is None
+    assert index.nearest(b) is None
+    assert [book_id for book_id, _ in index.nearest(a)] == [c]
+    np.testing.assert_allclose(index._sum, [1, 1])
+
+
+def test_sync_drops_deleted_profiles_on_the_next_recount(db):
+    books = [Book(title=title, author="X") for title in ("A", "B")]
+    db.add_all(books)
+    db.flush()
+    for book, frequencies in zip(books, ([1, 0], [0, 1])):
+        db.add(FunctionWordProfile(book_id=book.book_id, frequencies=pack_frequencies(frequencies), vocabulary_version=FUNCTION_WORDS_VERSION))
+    db.commit()
+
+    index = DeltaIndex(n_features=2)
+    index.sync(db)
+    db.query(FunctionWordProfile).filter(FunctionWordProfile.book_id == books[1].book_id).delete()
+    db.commit()
+
+    index.sync(db)
+    assert len(index) == 2
+
+    index._recounted_at -= delta_service.RECOUNT_INTERVAL
+    index.sync(db)
+    assert len(index) == 1 and index.nearest(books[1].book_id) is None
+    np.testing.assert_allclose(index._sum, [1, 0])
@@ -0,0 +1,268 @@
+"""
+Tests for GutendexService against a local httpx.MockTransport instead of gutendex.com and gutenberg.org
+"""
+import asyncio
+import threading
+import time
+
+import httpx
+
+from app.services import gutendex_service as gutendex_module
+from app.services.gutendex_service import GutenbergTextCleaner, GutendexService
+
+BOOK = {
+    "id": 2701,
+    "title": "Moby Dick; Or, The Whale",
+    "authors": [{"name": "Melville, Herman"}],
+    "subjects": ["Whaling -- Fiction"],
+    "languages": ["en"],
+    "download_count": 100,
+    "formats": {"image/jpeg": "https://www.gutenberg.org/cover.jpg"}
+}
+
+BODY = "Call me Ishmael. " * 200
+RAW_TEXT = f"Header\n*** START OF THE PROJECT GUTENBERG EBOOK ***\n{BODY}\n*** END OF THE PROJECT GUTENBERG EBOOK ***\nLicense"
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_search_and_lookup_share_one_client():
+    connections = []
+
+    def handler(request):
+        connections.append(request.url.host)
+        if request.url.path == "/books/":
+            return httpx.Response(200, json={"results": [BOOK, BOOK]})
+        return httpx.Response(200, json=BOOK)
+
+    service = GutendexService(transport=httpx.MockTransport(handler))
+
+    async def scenario():
+        books = await service.search_books(search="whale", limit=1)
+        book = await service.get_book_by_id(2701)
+        client = service._get_client()
+        await service.get_book_by_id(2702)
+        assert service._get_client() is client
+        await service.close()
+        return books, book
+
+    books, book = run(scenario())
+    assert len(books) == 1
+    assert books[0]["author"] == "Melville, Herman"
+    assert book["cover_url"] == "https://www.gutenberg.org/cover.jpg"
+    assert connections == ["gutendex.com"] * 3
+
+
+def test_each_loop_gets_its_own_client_and_close_closes_them_all():
+    service = GutendexService(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=BOOK)))
+
+    async def get_client():
+        await service.get_book_by_id(2701)
+        return service._get_client()
+
+    #A loop that keeps running in another thread, like the one behind a test client
+    other = asyncio.new_event_loop()
+    thread = threading.Thread(target=other.run_forever, daemon=True)
+    thread.start()
+    try:
+        other_client = asyncio.run_coroutine_threadsafe(get_client(), other).result()
+        finished_client = run(get_client())
+
+        async def scenario():
+            client = await get_client()
+            assert client is not other_client and client is not finished_client
+            assert set(service._clients.values()) == {client, other_client}
+            await service.close()
+            return client
+
+        client = run(scenario())
+        assert client.is_closed and other_client.is_closed
+        assert service._clients == {}
+    finally:
+        other.call_soon_threadsafe(other.stop)
+        thread.join()
+        other.close()
+
+
+def test_metadata_cache_serves_stale_and_caches_misses():
+    now = [0.0]
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        if request.url.path == "/books/1/":
+            return httpx.Response(404)
+        return httpx.Response(200, json=BOOK)
+
+    service = GutendexService(transport=httpx.MockTransport(handler))
+    service.metadata_cache = gutendex_module.MetadataCache(ttl=10, stale_ttl=100, negative_ttl=5, clock=lambda: now[0])
+
+    async def scenario():
+        await service.get_book_by_id(2701)
+        assert await service.get_book_by_id(1) is None
+        await service.get_book_by_id(2701)
+        assert await service.get_book_by_id(1) is None
+        assert len(requests) == 2
+
+        #A stale entry is returned at once and refreshed in the background
+        now[0] = 50
+        assert (await service.get_book_by_id(2701))["title"] == BOOK["title"]
+        await asyncio.sleep(0.01)
+        assert len(requests) == 3
+        await service.get_book_by_id(2701)
+        assert len(requests) == 3
+
+        #Expired entries are fetched again
+        assert await service.get_book_by_id(1) is None
+        now[0] = 500
+        await service.get_book_by_id(2701)
+        assert len(requests) == 5
+        await service.close()
+
+    run(scenario())
+    stats = service.metadata_cache.stats()
+    assert stats["entries"] == 2 and stats["negative_entries"] == 1
+    assert (stats["hits"], stats["stale_hits"], stats["negative_hits"], stats["misses"]) == (2, 1, 1, 4)
+
+
+def test_concurrent_lookups_share_one_request():
+    requests = []
+
+    async def handler(request):
+        requests.append(request.url.path)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json=BOOK)
+
+    service = GutendexService(transport=httpx.MockTransport(handler))
+
+    async def scenario():
+        books = await asyncio.gather(*[service.get_book_by_id(2701) for _ in range(5)])
+        await service.close()
+        return books
+
+    books = run(scenario())
+    assert all(book["title"] == BOOK["title"] for book in books)
+    assert requests == ["/books/2701/"]
+    assert service.metadata_cache.stats()["coalesced"] == 4
+
+
+def test_get_book_text_falls_back_and_cleans():
+    def handler(request):
+        if request.url.path.startswith("/files/"):
+            return httpx.Response(404)
+        return httpx.Response(200, text=RAW_TEXT)
+
+    service = GutendexService(transport=httpx.MockTransport(handler))
+    text = run(service.get_book_text(2701))
+
+    assert text == BODY.strip()
+
+
+def test_cleaner_matches_whole_text_cleaning():
+    raw = (
+        "The Project Gutenberg EBook\r\n\r\n*** START OF THIS PROJECT GUTENBERG EBOOK ***\r\n\r\n\r\n"
+        "Produced by Someone\r\n\r\nCHAPTER 1  \r\n\r\n\r\n\r\n  Call me Ishmael.\r\n \r\nSome years ago.\r\n\r\n\r\n"
+        "*** END OF THIS PROJECT GUTENBERG EBOOK ***\r\nLicense"
+    )
+    expected = "CHAPTER 1  \r\n\n  Call me Ishmael.\r\n \r\nSome years ago."
+
+    whole = GutenbergTextCleaner()
+    assert whole.feed(raw) + whole.finish() == expected
+
+    #Splitting the download anywhere, down to single characters, gives the same text
+    streamed = GutenbergTextCleaner()
+    assert "".join(streamed.feed(char) for char in raw) + streamed.finish() == expected
+    assert streamed.ended
+
+
+def test_text_without_markers_is_kept():
+    cleaner = GutenbergTextCleaner()
+
+    assert cleaner.feed("\n\nFirst line\nSecond") + cleaner.finish() == "First line\nSecond"
+
+
+def test_stream_yields_chunks_and_stops_at_end_marker():
+    body = "".join(f"Line {i} of the book.\n" for i in range(2000))
+    raw = f"Header\n*** START OF THE PROJECT GUTENBERG EBOOK ***\n{body}*** END OF THE PROJECT GUTENBERG EBOOK ***\n" + "License\n" * 1000
+
+    async def handler(request):
+        return httpx.Response(200, content=raw.encode("utf-8"))
+
+    service = GutendexService(transport=httpx.MockTransport(handler))
+
+    async def scenario():
+        chunks = [chunk async for chunk in service.stream_book_text(2701)]
+        await service.close()
+        return chunks
+
+    chunks = run(scenario())
+    assert "".join(chunks) == body.strip()
+    assert all(chunk for chunk in chunks)
+
+
+def test_slow_url_is_hedged_and_the_working_pattern_remembered(monkeypatch):
+    monkeypatch.setattr(gutendex_module, "HEDGE_DELAY", 0.05)
+    requested = []
+    cancelled = []
+
+    async def handler(request):
+        requested.append(request.url.path)
+        if request.url.path.startswith("/files/"):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(request.url.path)
+                raise
+        return httpx.Response(200, text=RAW_TEXT)
+
+    service = GutendexService(transport=httpx.MockTransport(handler))
+
+    async def scenario():
+        started = time.monotonic()
+        first = await service.get_book_text(2701)
+        elapsed = time.monotonic() - started
+        requested.clear()
+        second = await service.get_book_text(2702)
+        #Every host slot is given back, including the cancelled request's
+        assert service._host_limit("https://www.gutenberg.org/")._value == gutendex_module.PER_HOST_LIMIT
+        await service.close()
+        return first, second, elapsed
+
+    first, second, elapsed = run(scenario())
+    assert first == second == BODY.strip()
+    assert elapsed < 1
+    assert cancelled == ["/files/2701/2701-0.txt"]
+    #2702 is in the same ID range, so the epub pattern is tried first and answers before the hedge delay
+    assert requested == ["/cache/epub/2702/pg2702.txt"]
+
+
+def test_missing_book_returns_none():
+    service = GutendexService(transport=httpx.MockTransport(lambda request: httpx.Response(404)))
+
+    assert run(service.get_book_by_id(1)) is None
+    assert run(service.get_book_text(1)) is None
+
+
+def test_per_host_limit(monkeypatch):
+    monkeypatch.setattr(gutendex_module, "PER_HOST_LIMIT", 2)
+    in_flight = 0
+    peak = 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json=BOOK)
+
+    service = GutendexService(transport=httpx.MockTransport(handler))
+
+    async def scenario():
+        await asyncio.gather(*[service.get_book_by_id(i) for i in range(8)])
+        await service.close()
+
+    run(scenario())
+    assert peak == 2
@@ -0,0 +1,123 @@
+"""
+Tests for fetching catalog pages in the bulk import script, with the page requests answered locally
+"""
+import asyncio
+import os
+
+import httpx
+import pytest
+from sqlalchemy import create_engine, text
+
+import import_gutendex
+from app.database import Base
+from import_gutendex import PAGE_SIZE, fetch_catalog_pages
+
+
+def fetched_pages(monkeypatch, failing=(), **kwargs):
+    requested = []
+
+    async def fetch_page(client, guard, page, params=None):
+        requested.append(page)
+        if page in failing:
+            raise httpx.ConnectError("unreachable")
+        return {"count": 5 * PAGE_SIZE, "results": [{"id": page}]}
+
+    monkeypatch.setattr(import_gutendex, "fetch_page", fetch_page)
+    monkeypatch.setattr(import_gutendex, "PAGE_ATTEMPTS", 1)
+    failed_pages = []
+
+    async def collect():
+        return [(page, total_pages) async for page, _, total_pages in fetch_catalog_pages(
+            max_books=None, workers=2, failed_pages=failed_pages, **kwargs
+        )]
+
+    return sorted(asyncio.run(collect())), sorted(requested), failed_pages
+
+
+def test_every_page_is_fetched_once(monkeypatch):
+    pages, requested, failed_pages = fetched_pages(monkeypatch)
+    assert pages == [(page, 5) for page in range(1, 6)]
+    assert requested == [1, 2, 3, 4, 5]
+    assert failed_pages == []
+
+
+def test_only_missing_pages_and_those_after_the_checkpoint_are_fetched(monkeypatch):
+    pages, requested, failed_pages = fetched_pages(monkeypatch, failing=(5,), start_page=4, retry_pages=[2, 9])
+    assert pages == [(2, 5), (4, 5)]
+    assert requested == [2, 4, 5]
+    assert failed_pages == [5]
+
+
+#The merge statements only run on PostgreSQL, so these tests need an empty database the test may create
+#tables in, for example TEST_POSTGRES_URL=postgresql://localhost/scriptum_test
+TEST_POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+needs_postgres = pytest.mark.skipif(not TEST_POSTGRES_URL, reason="TEST_POSTGRES_URL is not set")
+
+GUTENDEX_BOOK = {
+    "id": 2701,
+    "title": "Moby Dick; Or, The Whale",
+    "authors": [{"name": "Melville, Herman", "birth_year": 1819, "death_year": 1891}],
+    "subjects": ["Whaling -- Fiction"],
+    "languages": ["en"],
+    "summaries": ["A whaling voyage told by Ishmael."],
+    "download_count": 100,
+    "formats": {"text/plain; charset=utf-8": "https://www.gutenberg.org/ebooks/2701.txt.utf-8"}
+}
+
+CSV_DUMP = (
+    "Text#,Type,Issued,Title,Language,Authors,Subjects,LoCC,Bookshelves\n"
+    '2701,Text,2001-07-01,Moby Dick,en,"Melville, Herman, 1819-1891","Whaling -- Fiction",PS,\n'
+)
+
+SCRIPT_TABLES = ("catalog_sync_state", "catalog_sync_hashes", "books_staging", "book_facets_staging")
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    engine = create_engine(TEST_POSTGRES_URL)
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(import_gutendex, "DATABASE_URL", TEST_POSTGRES_URL)
+    try:
+        yield engine
+    finally:
+        with engine.begin() as connection:
+            for table in SCRIPT_TABLES:
+                connection.execute(text(f"DROP TABLE IF EXISTS {table} CASCADE"))
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+
+
+def import_from_gutendex(monkeypatch, books):
+    async def fetch_catalog_pages(*args, **kwargs):
+        yield 1, books, 1
+
+    monkeypatch.setattr(import_gutendex, "fetch_catalog_pages", fetch_catalog_pages)
+    asyncio.run(import_gutendex.import_catalog(max_books=None, mode="catalog"))
+
+
+def import_from_dump(tmp_path):
+    path = tmp_path / "pg_catalog.csv"
+    path.write_text(CSV_DUMP, encoding="utf-8")
+    asyncio.run(import_gutendex.import_catalog(dump=str(path)))
+
+
+@needs_postgres
+def test_dump_import_keeps_the_summary_from_gutendex(postgres, monkeypatch, tmp_path):
+    import_from_gutendex(monkeypatch, [GUTENDEX_BOOK])
+    import_from_dump(tmp_path)
+
+    with postgres.connect() as connection:
+        title, summary = connection.execute(text("SELECT title, summary FROM books WHERE gutenberg_id = 2701")).one()
+    #The dump's title shows its row was merged
+    assert title == "Moby Dick"
+    assert summary == "A whaling voyage told by Ishmael."
+
+
+@needs_postgres
+def test_dump_import_keeps_the_download_count(postgres, monkeypatch, tmp_path):
+    import_from_gutendex(monkeypatch, [GUTENDEX_BOOK])
+    import_from_dump(tmp_path)
+
+    with postgres.connect() as connection:
+        download_count = connection.execute(text("SELECT download_count FROM books WHERE gutenberg_id = 2701")).scalar()
+    assert download_count == 100
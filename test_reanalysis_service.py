@@ -0,0 +1,161 @@
+"""
+Tests for re-analysing the profiles of an older analysis version in resumable jobs
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from app.database import SessionLocal
+from app.models import Book, FunctionWordProfile, ReanalysisJob, StylometricProfile
+from app.services import reanalysis_service
+from app.services.analysis_pool import analyze_book_job
+from app.services.reanalysis_service import run_reanalysis, start_reanalysis
+from app.services.single_flight import advisory_key
+from app.services.stylometry_service import ANALYSIS_VERSION
+
+TEXT = "It was the best of times, it was the worst of times. Nobody said a word. " * 20
+
+
+class InlinePool:
+
+    async def analyze_book(self, text):
+        if "fail" in text:
+            raise ValueError("analysis failed")
+        return analyze_book_job(text)
+
+
+@pytest.fixture
+def texts(monkeypatch):
+    """Texts of the books by title, a missing title has no text"""
+    texts = {}
+
+    async def load_book_text(db, book):
+        text = texts.get(book.title)
+        if isinstance(text, Exception):
+            raise text
+        if text is not None:
+            book.text_file_path = f"{book.title}.txt.gz"
+        return text
+
+    monkeypatch.setattr(reanalysis_service, "load_book_text", load_book_text)
+    monkeypatch.setattr(reanalysis_service, "analysis_pool", InlinePool())
+    return texts
+
+
+def add_profiles(db, titles, version="0.9"):
+    books = []
+    for title in titles:
+        book = Book(title=title, author="Author", analysed=True)
+        db.add(book)
+        db.flush()
+        db.add(StylometricProfile(book_id=book.book_id, pacing_score=1, analysis_version=version))
+        books.append(book)
+    db.commit()
+    return books
+
+
+def test_job_updates_stale_profiles_in_batches(db, texts):
+    add_profiles(db, ["current"], version=ANALYSIS_VERSION)
+    add_profiles(db, ["a", "b", "missing", "broken"])
+    texts.update({"a": TEXT, "b": TEXT, "broken": "fail " + TEXT})
+    job = start_reanalysis(db)
+    assert job.total == 4
+
+    progress = asyncio.run(run_reanalysis(job.job_id, batch_size=3))
+
+    assert progress["status"] == "completed"
+    assert {key: progress[key] for key in ("processed", "updated", "skipped", "failed")} == {
+        "processed": 4, "updated": 2, "skipped": 1, "failed": 1
+    }
+    db.expire_all()
+    versions = dict(db.query(Book.title, StylometricProfile.analysis_version).join(StylometricProfile).all())
+    assert versions == {"current": ANALYSIS_VERSION, "a": ANALYSIS_VERSION, "b": ANALYSIS_VERSION, "missing": "0.9", "broken": "0.9"}
+    assert db.query(FunctionWordProfile).count() == 2
+    assert dict(db.query(Book.title, Book.text_file_path).filter(Book.title.in_(["a", "broken"]))) == {
+        "a": "a.txt.gz", "broken": "broken.txt.gz"
+    }
+
+
+def test_books_deleted_during_a_batch_are_skipped(db, texts, monkeypatch):
+    kept, deleted = add_profiles(db, ["kept", "deleted"])
+    texts.update({"kept": TEXT, "deleted": TEXT})
+    deleted_id = deleted.book_id
+    job = start_reanalysis(db)
+    load_book_text = reanalysis_service.load_book_text
+
+    async def load_and_delete(session, book):
+        if book.book_id == deleted_id:
+            #SQLite does not cascade the delete to the profile as PostgreSQL does
+            other = SessionLocal()
+            other.query(StylometricProfile).filter(StylometricProfile.book_id == deleted_id).delete()
+            other.query(Book).filter(Book.book_id == deleted_id).delete()
+            other.commit()
+            other.close()
+        return await load_book_text(session, book)
+
+    monkeypatch.setattr(reanalysis_service, "load_book_text", load_and_delete)
+    progress = asyncio.run(run_reanalysis(job.job_id))
+
+    assert progress["status"] == "completed"
+    assert (progress["processed"], progress["updated"], progress["skipped"]) == (2, 1, 1)
+    db.expire_all()
+    assert db.get(Book, deleted_id) is None
+    assert db.query(Book).count() == 1
+
+
+def test_unfinished_job_is_carried_on(db, texts):
+    books = add_profiles(db, ["a", "b"])
+    texts.update({"a": TEXT, "b": TEXT})
+    job = start_reanalysis(db)
+    first = min(book.book_id for book in books)
+    job.last_book_id = first
+    job.processed = 1
+    db.commit()
+
+    assert start_reanalysis(db).job_id == job.job_id
+    progress = asyncio.run(run_reanalysis(job.job_id))
+
+    assert (progress["processed"], progress["updated"]) == (2, 1)
+    db.expire_all()
+    assert db.query(StylometricProfile).filter(StylometricProfile.book_id == first).one().analysis_version == "0.9"
+
+
+def test_a_failing_batch_marks_the_job_failed(db, texts):
+    add_profiles(db, ["a"])
+    texts["a"] = OSError("disk full")
+    job = start_reanalysis(db)
+
+    with pytest.raises(OSError):
+        asyncio.run(run_reanalysis(job.job_id))
+
+    db.expire_all()
+    job = db.get(ReanalysisJob, job.job_id)
+    assert (job.status, job.error) == ("failed", "disk full")
+
+
+def test_a_job_runs_once_at_a_time(db, texts, monkeypatch):
+    add_profiles(db, ["a"])
+    job = start_reanalysis(db)
+    monkeypatch.setattr(reanalysis_service, "_active_jobs", {job.job_id})
+
+    assert asyncio.run(run_reanalysis(job.job_id)) is None
+    db.expire_all()
+    assert db.get(ReanalysisJob, job.job_id).processed == 0
+
+
+def test_a_job_held_by_another_worker_is_left_alone(db, texts, monkeypatch):
+    add_profiles(db, ["a"])
+    job = start_reanalysis(db)
+    locks = []
+
+    @asynccontextmanager
+    async def held_elsewhere(engine, key, timeout):
+        locks.append((key, timeout))
+        raise TimeoutError
+        yield
+
+    monkeypatch.setattr(reanalysis_service, "advisory_lock", held_elsewhere)
+
+    assert asyncio.run(run_reanalysis(job.job_id)) is None
+    assert locks == [(advisory_key("reanalysis", str(job.job_id)), 0)]
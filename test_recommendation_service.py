@@ -0,0 +1,100 @@
+"""
+Tests for generating the stored style recommendations and finding the users who need new ones
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models import Book, Rating, Recommendation, RecommendationRun, StylometricProfile, User
+from app.services import recommendation_service
+from app.services.recommendation_service import generate_recommendations, stale_user_ids
+from app.services.style_index import StyleIndex
+
+LONG_AGO = datetime(2020, 1, 1)
+
+
+@pytest.fixture(autouse=True)
+def fresh_style_index(monkeypatch):
+    monkeypatch.setattr(recommendation_service, "style_index", StyleIndex())
+
+
+def add_user(db, name):
+    user = User(email=f"{name}@example.com", username=name, password_hash="x")
+    db.add(user)
+    db.flush()
+    return user
+
+
+def add_book(db, title, pacing=None):
+    book = Book(title=title, author="Author")
+    db.add(book)
+    db.flush()
+    if pacing is not None:
+        db.add(StylometricProfile(
+            book_id=book.book_id, pacing_score=pacing, tone_score=5, vocabulary_richness=0.5, avg_sentence_length=15
+        ))
+    return book
+
+
+def rate(db, user, book, rating, at=LONG_AGO):
+    db.add(Rating(user_id=user.user_id, book_id=book.book_id, rating=rating, rated_at=at, updated_at=at))
+
+
+def test_recommendations_rank_unrated_books_by_style(db):
+    reader = add_user(db, "reader")
+    slow, slower, fast, fastest = (add_book(db, title, pacing) for title, pacing in [
+        ("Slow", 1), ("Slower", 1.5), ("Fast", 8), ("Fastest", 10)
+    ])
+    rate(db, reader, slow, 5)
+    db.commit()
+
+    stats = generate_recommendations(db, top_n=2)
+
+    assert stats["users_updated"] == 1 and stats["recommendations_written"] == 2
+    ranked = db.query(Recommendation.book_id).filter(Recommendation.user_id == reader.user_id).order_by(Recommendation.rank).all()
+    assert [book_id for (book_id,) in ranked] == [slower.book_id, fast.book_id]
+
+
+def test_users_are_stale_until_generated_even_without_recommendations(db):
+    reader = add_user(db, "reader")
+    unlucky = add_user(db, "unlucky")
+    rate(db, reader, add_book(db, "Analysed", 3), 4)
+    add_book(db, "Other", 5)
+    rate(db, unlucky, add_book(db, "Not analysed"), 4)
+    db.commit()
+
+    assert set(stale_user_ids(db)) == {reader.user_id, unlucky.user_id}
+
+    generate_recommendations(db)
+
+    assert stale_user_ids(db) == []
+    runs = dict(db.query(RecommendationRun.user_id, RecommendationRun.recommendations).all())
+    assert runs == {reader.user_id: 1, unlucky.user_id: 0}
+
+
+def test_a_new_rating_makes_the_user_stale_again(db):
+    reader = add_user(db, "reader")
+    rate(db, reader, add_book(db, "Analysed", 3), 4)
+    db.commit()
+    generate_recommendations(db)
+
+    rate(db, reader, add_book(db, "Later", 6), 2, at=datetime.utcnow() + timedelta(days=1))
+    db.commit()
+
+    assert stale_user_ids(db) == [reader.user_id]
+
+
+def test_admin_endpoints_are_refused_without_a_configured_token(monkeypatch):
+    from fastapi import HTTPException
+
+    from app import dependencies
+
+    monkeypatch.setattr(dependencies, "ADMIN_TOKEN", None)
+    for token in (None, "", "anything"):
+        with pytest.raises(HTTPException):
+            dependencies.require_admin(token)
+
+    monkeypatch.setattr(dependencies, "ADMIN_TOKEN", "secret")
+    with pytest.raises(HTTPException):
+        dependencies.require_admin("wrong")
+    dependencies.require_admin("secret")
@@ -0,0 +1,72 @@
+"""
+Tests for coalescing concurrent calls with SingleFlight
+"""
+import asyncio
+
+import pytest
+
+from app.services.single_flight import SingleFlight, advisory_key
+
+
+def test_concurrent_calls_share_one_run():
+    flights = SingleFlight()
+    calls = 0
+
+    async def download():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "text"
+
+    async def scenario():
+        results = await asyncio.gather(*[flights.run(84, download) for _ in range(5)])
+        later = await flights.run(84, download)
+        return results, later
+
+    results, later = asyncio.run(scenario())
+    assert results == ["text"] * 5
+    assert later == "text"
+    assert calls == 2
+    assert flights.stats() == {"in_flight": 0, "started": 2, "joined": 4}
+
+
+def test_errors_reach_every_caller():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("download failed")
+
+    async def scenario():
+        return await asyncio.gather(*[flights.run("book", fail) for _ in range(3)], return_exceptions=True)
+
+    errors = asyncio.run(scenario())
+    assert all(isinstance(error, ValueError) for error in errors)
+
+
+def test_cancelled_starter_does_not_cancel_the_others():
+    flights = SingleFlight()
+
+    async def analyse():
+        await asyncio.sleep(0.05)
+        return "profile"
+
+    async def scenario():
+        starter = asyncio.create_task(flights.run("book", analyse))
+        await asyncio.sleep(0)
+        joined = asyncio.create_task(flights.run("book", analyse))
+        await asyncio.sleep(0.01)
+        starter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await starter
+        return await joined
+
+    assert asyncio.run(scenario()) == "profile"
+
+
+def test_advisory_key_is_a_stable_bigint():
+    key = advisory_key("analyse", "0b6f3d1c")
+
+    assert key == advisory_key("analyse", "0b6f3d1c")
+    assert key != advisory_key("analyse", "0b6f3d1d")
+    assert -2 ** 63 <= key < 2 ** 63
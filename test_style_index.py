@@ -0,0 +1,108 @@
+"""
+Tests for the in-memory index of style profiles
+"""
+import uuid
+
+import numpy as np
+
+from app.models import Book, StylometricProfile
+from app.services import style_index as style_index_module
+from app.services.style_index import SIMILARITY_NAMES, StyleIndex
+
+
+def test_similar_books_come_first():
+    index = StyleIndex()
+    a, b, c = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    index.add_many([a, b, c], np.array([[1, 1, 1, 1], [2, 1, 1, 1], [9, 9, 9, 9]]))
+
+    (closest, score, similarities), (farthest, _, _) = index.similar(a)
+    assert (closest, farthest) == (b, c)
+    assert set(similarities) == set(SIMILARITY_NAMES) and 0 <= score <= 1
+    assert index.similar(uuid.uuid4()) is None
+
+
+def test_range_shrinks_when_the_extreme_book_is_reanalysed():
+    index = StyleIndex()
+    a, b, c = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    index.add_many([a, b, c], np.array([[0, 0, 0, 0], [5, 5, 5, 5], [100, 100, 100, 100]]))
+    index.matrix()
+
+    index.add(c, {"pacing_score": 10, "tone_score": 10, "vocabulary_richness": 10, "avg_sentence_length": 10})
+
+    _, normalized = index.matrix()
+    np.testing.assert_allclose(normalized[1], [0.5] * 4)
+
+
+def test_books_inside_the_range_are_scaled_in_place():
+    index = StyleIndex()
+    a, b = uuid.uuid4(), uuid.uuid4()
+    index.add_many([a, b], np.array([[0, 0, 0, 0], [10, 10, 10, 10]]))
+    index.matrix()
+
+    index.add(uuid.uuid4(), {"pacing_score": 5, "tone_score": 5, "vocabulary_richness": 5, "avg_sentence_length": 5})
+
+    assert index._normalized is not None
+    np.testing.assert_allclose(index.matrix()[1][2], [0.5] * 4)
+
+
+def add_profile(db, title, pacing):
+    book = Book(title=title, author="Author")
+    db.add(book)
+    db.flush()
+    db.add(StylometricProfile(book_id=book.book_id, pacing_score=pacing, tone_score=1, vocabulary_richness=1, avg_sentence_length=1))
+    db.commit()
+    return book
+
+
+def test_sync_adds_new_profiles_and_drops_deleted_ones(db, monkeypatch):
+    monkeypatch.setattr(style_index_module, "RECOUNT_INTERVAL", 0)
+    index = StyleIndex()
+    first, second = add_profile(db, "First", 1), add_profile(db, "Second", 2)
+    index.sync(db)
+    assert len(index) == 2
+
+    third = add_profile(db, "Third", 3)
+    index.sync(db)
+    assert len(index) == 3 and index.similar(third.book_id)[0][0] == second.book_id
+
+    db.query(StylometricProfile).filter(StylometricProfile.book_id == second.book_id).delete()
+    db.commit()
+    index.sync(db)
+
+    assert len(index) == 2
+    assert index.similar(second.book_id) is None
+    assert [book_id for book_id, _, _ in index.similar(third.book_id)] == [first.book_id]
+
+
+def test_profiles_are_only_recounted_once_per_interval(db):
+    index = StyleIndex()
+    first, second = add_profile(db, "First", 1), add_profile(db, "Second", 2)
+    index.sync(db)
+
+    db.query(StylometricProfile).filter(StylometricProfile.book_id == second.book_id).delete()
+    db.commit()
+    index.sync(db)
+    assert len(index) == 2
+
+    index._recounted_at -= style_index_module.RECOUNT_INTERVAL
+    index.sync(db)
+    assert len(index) == 1 and index.similar(second.book_id) is None
+
+
+def test_remove_moves_the_last_row_and_rescales_when_needed():
+    index = StyleIndex()
+    a, b, c, d = uuid.uuid4(), uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    index.add_many([a, b, c, d], np.array([[0, 0, 0, 0], [5, 5, 5, 5], [2, 2, 2, 2], [10, 10, 10, 10]]))
+    index.matrix()
+
+    index.remove(b)
+    assert len(index) == 3 and index._normalized is not None
+    assert index.similar(b) is None
+    assert [book_id for book_id, _, _ in index.similar(c)] == [a, d]
+
+    index.remove(d)
+    book_ids, normalized = index.matrix()
+    assert book_ids == [a, c]
+    np.testing.assert_allclose(normalized, [[0] * 4, [1] * 4])
+    index.remove(d)
+    assert len(index) == 2
@@ -0,0 +1,190 @@
+"""
+Checks the fused StylometryAnalyzer and its batch API give exactly the same metrics as the original multi-pass version
+"""
+import random
+import re
+
+import numpy as np
+import pytest
+
+from app.services.stylometry_service import (
+    ANALYSIS_VERSION,
+    PROFILE_DTYPE,
+    SAMPLED_VERSION_SUFFIX,
+    StylometryAnalyzer,
+    TIMELINE_METRICS,
+    is_sampled_version,
+    to_profile_rows,
+)
+from app.services.timeline_service import downsample_timeline, pack_timeline, unpack_timeline
+
+SAMPLE_TEXTS = [
+    "Hello world.",
+    "One sentence without a terminator",
+    "Wait... what?! No way!!! Really?",
+    '"Come here," she said. \'Now!\' He did not move; he only stared: silence.',
+    "   Leading and trailing whitespace.   \n\n",
+    "Dr.Who met Mr. Smith.It was odd . . . very odd!",
+    "Tabs\tand\nnew\r\nlines\x0bvertical\x0cfeed nbsp em-space. End",
+    "Ünïcödé wörds ÅND CAPS. İstanbul ǅemal!",
+    "...!!!???",
+    "No terminators here at all just words and more words",
+]
+
+
+def reference_analyze_text(text):
+    """The original multi-pass implementation, kept here as the parity reference (minus the raw word list)"""
+    if not text or len(text.strip()) == 0:
+        raise ValueError("Text cannot be empty")
+
+    words = text.split()
+    sentences = [s.strip() for s in re.split(r'[.!?]+', text) if s.strip()]
+
+    total_words = len(words)
+    total_sentences = len(sentences)
+    unique_words = len(set(word.lower() for word in words))
+
+    avg_sentence_length = total_words / total_sentences if total_sentences > 0 else 0
+    avg_word_length = sum(len(word) for word in words) / total_words if total_words > 0 else 0
+    lexical_diversity = unique_words / total_words if total_words > 0 else 0
+
+    if total_sentences > 1:
+        sentence_lengths = [len(s.split()) for s in sentences]
+        avg_len = sum(sentence_lengths) / len(sentence_lengths)
+        variance = sum((x - avg_len) ** 2 for x in sentence_lengths) / len(sentence_lengths)
+        pacing_score = min(100, variance)
+    else:
+        pacing_score = 50.0
+
+    punctuation_count = sum(1 for char in text if char in '!?.')
+    tone_score = min(100, (punctuation_count / total_sentences) * 10) if total_sentences > 0 else 50.0
+    vocabulary_richness = lexical_diversity * 100
+    dialogue_chars = text.count('"') + text.count("'")
+    dialogue_percentage = min(100, (dialogue_chars / len(text)) * 200) if len(text) > 0 else 0
+    punctuation_density = sum(1 for char in text if char in ',.!?;:') / total_words if total_words > 0 else 0
+
+    return {
+        "pacing_score": round(pacing_score, 2),
+        "tone_score": round(tone_score, 2),
+        "vocabulary_richness": round(vocabulary_richness, 2),
+        "avg_sentence_length": round(avg_sentence_length, 2),
+        "avg_word_length": round(avg_word_length, 2),
+        "lexical_diversity": round(lexical_diversity, 4),
+        "punctuation_density": round(punctuation_density, 4),
+        "dialogue_percentage": round(dialogue_percentage, 2),
+        "total_words": total_words,
+        "total_sentences": total_sentences,
+        "unique_words": unique_words
+    }
+
+
+def random_text(seed, n_words=5000):
+    """Builds a messy pseudo-novel with dialogue, odd spacing and runs of punctuation"""
+    rng = random.Random(seed)
+    vocab = ["the", "The", "whale", "Ahab", "sea", "said", "don't", "Mr.", "e.g.", '"Call', 'me"',
+             "'tis", "however,", "end;", "note:", "wait!", "why?", "...", "?!", "—", "ﬁne", "Ishmael."]
+    separators = [" ", " ", " ", "  ", "\n", "\n\n", "\t", " ", " . ", "! "]
+    return "".join(rng.choice(vocab) + rng.choice(separators) for _ in range(n_words))
+
+
+@pytest.mark.parametrize("text", SAMPLE_TEXTS)
+def test_matches_reference_on_samples(text):
+    assert StylometryAnalyzer().analyze_text(text) == reference_analyze_text(text)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_reference_on_random_texts(seed):
+    text = random_text(seed)
+    assert StylometryAnalyzer().analyze_text(text) == reference_analyze_text(text)
+
+
+@pytest.mark.parametrize("text", ["", "   \n\t  "])
+def test_empty_text_is_rejected(text):
+    with pytest.raises(ValueError):
+        StylometryAnalyzer().analyze_text(text)
+
+
+def test_analyze_many_matches_analyze_text():
+    analyzer = StylometryAnalyzer()
+    texts = SAMPLE_TEXTS + [random_text(seed) for seed in range(20)]
+    results = analyzer.analyze_many(texts)
+
+    assert len(results) == len(texts)
+    for text, record in zip(texts, results.tolist()):
+        expected = analyzer.analyze_text(text)
+        assert dict(zip(PROFILE_DTYPE.names, record)) == {name: expected[name] for name in PROFILE_DTYPE.names}
+
+
+def test_analyze_many_rejects_empty_text():
+    with pytest.raises(ValueError):
+        StylometryAnalyzer().analyze_many(["Fine text.", "  "])
+
+
+def test_to_profile_rows():
+    results = StylometryAnalyzer().analyze_many(["Hello world. Bye!", "One more sentence here."])
+    rows = to_profile_rows(["a", "b"], results, analysis_version="2.0")
+
+    assert [row["book_id"] for row in rows] == ["a", "b"]
+    assert rows[0]["total_sentences"] == 2
+    assert rows[1]["analysis_version"] == "2.0"
+    assert type(rows[0]["pacing_score"]) is float
+
+
+def test_analyze_sample_falls_back_to_exact_on_short_text():
+    analyzer = StylometryAnalyzer()
+    text = random_text(1, n_words=2000)
+    estimates, intervals = analyzer.analyze_sample(text)
+
+    assert estimates == {name: analyzer.analyze_text(text)[name] for name in PROFILE_DTYPE.names}
+    assert all(low == high for low, high in intervals.values())
+
+
+def test_analyze_sample_intervals_cover_exact_values():
+    analyzer = StylometryAnalyzer()
+    text = random_text(7, n_words=200000)
+    exact = analyzer.analyze_text(text)
+    estimates, intervals = analyzer.analyze_sample(text, seed=3)
+
+    for name in ("avg_sentence_length", "avg_word_length", "total_words", "unique_words", "lexical_diversity"):
+        low, high = intervals[name]
+        assert low <= estimates[name] <= high
+        assert low <= exact[name] <= high
+
+
+def test_sampled_version():
+    assert is_sampled_version(ANALYSIS_VERSION + SAMPLED_VERSION_SUFFIX)
+    assert not is_sampled_version(ANALYSIS_VERSION)
+    assert not is_sampled_version(None)
+
+
+@pytest.mark.parametrize("text", SAMPLE_TEXTS)
+def test_single_window_timeline_matches_analyze_text(text):
+    analyzer = StylometryAnalyzer()
+    metrics, timeline = analyzer.analyze_with_timeline(text)
+
+    assert metrics == analyzer.analyze_text(text)
+    assert timeline.shape == (1, len(TIMELINE_METRICS))
+    window = dict(zip(TIMELINE_METRICS, timeline[0].tolist()))
+    for name in ("pacing_score", "avg_sentence_length", "punctuation_density"):
+        assert window[name] == pytest.approx(metrics[name], abs=0.01)
+
+
+def test_timeline_windows():
+    analyzer = StylometryAnalyzer()
+    words = random_text(2, n_words=6000).split()
+
+    #A last window of at least half the window size gets its own row, a shorter one joins the previous window
+    assert len(analyzer.timeline(" ".join(words[:5600]), window_words=1000)) == 6
+    assert len(analyzer.timeline(" ".join(words[:5400]), window_words=1000)) == 5
+    timeline = analyzer.timeline(" ".join(words), window_words=1000)
+    assert np.array_equal(unpack_timeline(pack_timeline(timeline)), timeline)
+
+
+def test_downsample_timeline():
+    timeline = np.arange(40, dtype=np.float32).reshape(10, 4)
+
+    assert downsample_timeline(timeline, 20) is timeline
+    downsampled = downsample_timeline(timeline, 3)
+    assert downsampled.shape == (3, 4)
+    assert downsampled[0].tolist() == timeline[:3].mean(axis=0).tolist()
+    assert downsampled[2].tolist() == timeline[6:].mean(axis=0).tolist()
@@ -0,0 +1,134 @@
+"""
+Tests for the rate limit, backoff and circuit breaker in front of Gutendex and Gutenberg
+"""
+import asyncio
+
+import httpx
+import pytest
+
+from app.services.gutendex_service import GutendexService
+from app.services.upstream_guard import CircuitBreaker, CircuitOpenError, TokenBucket, UpstreamGuard, retry_after_seconds
+
+
+def test_token_bucket_queues_after_the_burst():
+    now = [0.0]
+    bucket = TokenBucket(rate=2, burst=2, clock=lambda: now[0])
+
+    assert [bucket.reserve() for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    now[0] = 10
+    assert bucket.reserve() == 0.0
+
+
+def test_breaker_opens_then_lets_one_trial_through():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    now[0] = 31
+    assert breaker.allow()
+    assert breaker.state == "half_open" and not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opened == 2
+
+    now[0] = 62
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_retry_after_seconds_and_dates():
+    assert retry_after_seconds("3") == 3.0
+    assert retry_after_seconds("Wed, 21 Oct 2015 07:28:10 GMT", now=1445412480) == 10.0
+    assert retry_after_seconds("100000") == 120.0
+    assert retry_after_seconds("soon") is None
+    assert retry_after_seconds(None) is None
+
+
+def test_throttled_request_is_retried_after_retry_after():
+    responses = [httpx.Response(429, headers={"Retry-After": "0"}), httpx.Response(200, json={"id": 84, "title": "Frankenstein"})]
+
+    service = GutendexService(transport=httpx.MockTransport(lambda request: responses.pop(0)))
+    service.upstream = UpstreamGuard(backoff_base=0)
+
+    async def scenario():
+        book = await service.get_book_by_id(84)
+        await service.close()
+        return book
+
+    assert asyncio.run(scenario())["title"] == "Frankenstein"
+    stats = service.upstream.stats()["gutendex.com"]
+    assert (stats["requests"], stats["retries"], stats["throttled_responses"], stats["breaker"]) == (2, 1, 1, "closed")
+
+
+def test_open_breaker_fails_fast():
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        raise httpx.ConnectError("connection refused")
+
+    service = GutendexService(transport=httpx.MockTransport(handler))
+    service.upstream = UpstreamGuard(max_retries=0, backoff_base=0, failure_threshold=2)
+
+    async def scenario():
+        for query in ("a", "b"):
+            with pytest.raises(httpx.ConnectError):
+                await service.search_books(search=query)
+        with pytest.raises(CircuitOpenError):
+            await service.search_books(search="c")
+        await service.close()
+
+    asyncio.run(scenario())
+    assert len(requests) == 2
+    assert service.upstream.stats()["gutendex.com"]["rejected"] == 1
+
+
+def test_expired_metadata_is_served_while_upstream_fails():
+    now = [0.0]
+    responses = [httpx.Response(200, json={"id": 84, "title": "Frankenstein"}), httpx.Response(500)]
+
+    service = GutendexService(transport=httpx.MockTransport(lambda request: responses.pop(0)))
+    service.upstream = UpstreamGuard(max_retries=0)
+    service.metadata_cache._clock = lambda: now[0]
+
+    async def scenario():
+        await service.get_book_by_id(84)
+        now[0] = 10 ** 6
+        book = await service.get_book_by_id(84)
+        await service.close()
+        return book
+
+    assert asyncio.run(scenario())["title"] == "Frankenstein"
+    assert service.metadata_cache.stats()["fallback_hits"] == 1
+
+
+def test_cancelled_trial_lets_the_next_request_try():
+    guard = UpstreamGuard(max_retries=0, backoff_base=0, failure_threshold=1, reset_timeout=0)
+    url = "https://gutendex.com/books"
+
+    async def refused():
+        raise httpx.ConnectError("connection refused")
+
+    async def hangs():
+        await asyncio.Event().wait()
+
+    async def ok():
+        return httpx.Response(200)
+
+    async def scenario():
+        with pytest.raises(httpx.ConnectError):
+            await guard.send(url, refused)
+        trial = asyncio.create_task(guard.send(url, hangs))
+        await asyncio.sleep(0.01)
+        assert guard.stats()["gutendex.com"]["breaker"] == "half_open"
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return await guard.send(url, ok)
+
+    assert asyncio.run(scenario()).status_code == 200
+    assert guard.stats()["gutendex.com"]["breaker"] == "closed"